@@ -21,4 +21,6 @@ urlpatterns=[
 
     path('delete-message/<str:gk>/<str:pk>/',views.message_delete_page,name='delete-message'),
     path('edit-message/<str:gk>/<str:pk>/',views.message_edit_page,name='edit-message'),
+
+    path('metrics/', views.metrics_page, name='metrics'),
 ]
\ No newline at end of file
@@ -1,19 +1,28 @@
+from asyncio import gather
 from datetime import timedelta
+from hmac import compare_digest
 
 from django.conf.global_settings import SESSION_COOKIE_NAME
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import render,redirect
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseForbidden
 from django.core.signals import request_finished
 from django.dispatch import receiver
 
 from database.FileDatabase import FileDatabase
 # from database.FirebaseDatabase import FirebaseDatabase
+# from database.ReplicatedFirebaseDatabase import ReplicatedFirebaseDatabase
+# from database.SQLiteDatabase import SQLiteDatabase
 from database.Interop import DatabaseInterop
+# from database.CachedDatabase import CachedDatabase
+from database.InstrumentedDatabase import InstrumentedDatabase
+from database.AsyncInterop import AsyncDatabaseInterop, ExecutorDatabase
+# from database.AsyncFirebaseDatabase import AsyncFirebaseDatabase
 from database.cookie import Cookie
+from database.password_hasher import HasherBusy
 from .forms import RoomForm, UserEditForm, EmailUserCreationForm, RequestForm
 from django.contrib import messages
-from os import mkdir
+from os import getenv, mkdir
 from os.path import exists
 
 if not exists("file_db"):
@@ -22,15 +31,30 @@ if not exists("file_db"):
 useDatabase: DatabaseInterop = FileDatabase(
     "file_db/users.dat",
     "file_db/groups.dat",
-    "file_db/messages.dat",
+    "file_db/messages",
     "file_db/auth.dat",
+    "file_db/journal.log",
+    background_interval=1,
 )
+# Shared by every worker process, unlike FileDatabase which has to be the only process using file_db
+# useDatabase: DatabaseInterop = SQLiteDatabase("file_db/shadowtalk.sqlite3")
+# FirebaseDatabase serving the rooms in use from listener fed copies, room loads then cost no round trips
+# useDatabase: DatabaseInterop = ReplicatedFirebaseDatabase()
+# Answers the repeated access, group and profile reads from memory, worth it on remote backends such as FirebaseDatabase
+# useDatabase = CachedDatabase(useDatabase)
+# Latency of every call is served at /metrics, DATABASE_METRICS_SAMPLE_RATE below 1 only times that share of them
+useDatabase = InstrumentedDatabase(useDatabase, float(getenv("DATABASE_METRICS_SAMPLE_RATE", "1")))
+# Scrapers send it as "Authorization: Bearer <token>", while it is unset /metrics only answers requests from this host
+METRICS_TOKEN = getenv("DATABASE_METRICS_TOKEN")
+# Used by the async views, runs useDatabase off the event loop
+useAsyncDatabase: AsyncDatabaseInterop = ExecutorDatabase(useDatabase)
+# useAsyncDatabase: AsyncDatabaseInterop = AsyncFirebaseDatabase(useDatabase)
 
 @receiver(request_finished)
 def on_close(sender, **kwargs):
     useDatabase.deinit()
 
-def login_page(request):
+async def login_page(request):
     page = 'login'
     if request.COOKIES.get(SESSION_COOKIE_NAME) is not None:
         return redirect('home')
@@ -42,11 +66,15 @@ def login_page(request):
     form = request.POST
     email = form.get('email').lower()
     password = form.get('password')
-    if not useDatabase.user_exists_email(email):
+    if not await useAsyncDatabase.user_exists_email(email):
         messages.error(request, 'User does not exist')
         return redirect(page)
 
-    token = useDatabase.user_login(email, password)
+    try:
+        token = await useAsyncDatabase.user_login(email, password)
+    except HasherBusy:
+        messages.error(request, 'Too many people are signing in right now, try again in a moment')
+        return redirect(page)
     if token is None:
         messages.error(request, 'Login failed')
         return redirect(page)
@@ -69,7 +97,7 @@ def logout_page(request):
     return redirect('home')
 
 
-def register_page(request):
+async def register_page(request):
     page = 'register'
     if request.method != 'POST':
         form = EmailUserCreationForm()
@@ -83,7 +111,7 @@ def register_page(request):
         messages.error(request, email_validation)
         return redirect(page)
 
-    if useDatabase.user_exists_email(email):
+    if await useAsyncDatabase.user_exists_email(email):
         messages.error(request, 'User already exists')
         return redirect(page)
 
@@ -99,7 +127,11 @@ def register_page(request):
         messages.error(request, name_validation)
         return redirect(page)
 
-    token = useDatabase.user_create(email, name, password, None)
+    try:
+        token = await useAsyncDatabase.user_create(email, name, password, None)
+    except HasherBusy:
+        messages.error(request, 'Too many people are signing up right now, try again in a moment')
+        return redirect(page)
     if token is None:
         messages.error(request, 'Failed to create account')
         return redirect(page)
@@ -115,36 +147,50 @@ def register_page(request):
     return response
 
 @login_required(login_url='/login')
-def home_page(request):
-    """
-    Currently I have turned off message searching, because the UI will also have to be configured different for those
-    """
+async def home_page(request):
     raw_query = request.GET.get('q')
     query = raw_query if raw_query is not None else ''
+    raw_page = request.GET.get('page')
+    page = int(raw_page) if raw_page is not None and raw_page.isdigit() else 0
      
-    rooms = useDatabase.group_search(request.user, query)
+    rooms = await useAsyncDatabase.group_search(request.user, query)
     room_count = len(rooms)
+    found_messages = await useAsyncDatabase.message_search(request.user, query, page) if query != '' else []
 
     return render(request,'base/home.html', {
         'rooms':rooms,
         'room_count':room_count,
+        'query':query,
+        'page':page,
+        'found_messages':found_messages,
     })
 
 @login_required(login_url='/login')
-def room_page(request, pk):
+async def room_page(request, pk):
     if pk is None:
         return redirect('home')
-    room = useDatabase.group_get(request.user, pk)
-    room_messages = useDatabase.message_get(request.user, room.id, None, 64)
+    room = await useAsyncDatabase.group_get(request.user, pk)
+    if room is None:
+        return redirect('home')
 
     if request.method != 'POST':
+        participant_ids = room.admin_ids + room.member_ids
+        # Both reads are independent, so they are waited on together
+        room_messages, participants = await gather(
+            useAsyncDatabase.message_get(request.user, room.id, None, 64),
+            useAsyncDatabase.user_public_get_many(participant_ids)
+        )
         return render(request, 'base/room.html', {
             'room': room,
             'room_messages': room_messages,
-            'participants': room.member_ids
+            'participants': [
+                (user_id, user)
+                for user_id, user in zip(participant_ids, participants)
+                if user is not None
+            ]
         })
 
-    _ = useDatabase.message_send(
+    _ = await useAsyncDatabase.message_send(
         request.user,
         room.id,
         request.POST.get('body'),
@@ -281,17 +327,18 @@ def landing_page(request):
     return render(request,'base/landing_page.html')
 
 @login_required(login_url='/login')
-def requests_page(request):
+async def requests_page(request):
     if request.method == 'POST':
         request_id = request.POST.get('request_id')
         print(request_id)
-        if not useDatabase.request_send(request.user, request_id):
+        if not await useAsyncDatabase.request_send(request.user, request_id):
             messages.error(request, "Failed to send request")
         return redirect('requests-page')
-    requests = list(map(
-        lambda user_id: useDatabase.user_public_get(user_id),
-        useDatabase.request_get(request.user)
-    ))
+    requests = [
+        user
+        for user in await useAsyncDatabase.user_public_get_many(await useAsyncDatabase.request_get(request.user))
+        if user is not None
+    ]
     requests_count = len(requests)
     form = RequestForm()
     return render(request, 'base/requests_page.html', {
@@ -302,4 +349,15 @@ def requests_page(request):
 
 
 def download_page(request):
-    return render(request, 'base/download.html')
\ No newline at end of file
+    return render(request, 'base/download.html')
+
+
+def metrics_allowed(request) -> bool:
+    if METRICS_TOKEN is not None:
+        return compare_digest(request.headers.get('Authorization', ''), f"Bearer {METRICS_TOKEN}")
+    return request.META.get('REMOTE_ADDR') in ('127.0.0.1', '::1')
+
+def metrics_page(request):
+    if not metrics_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(useDatabase.metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
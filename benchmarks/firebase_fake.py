@@ -0,0 +1,423 @@
+from copy import deepcopy
+from threading import Lock
+from time import sleep
+from types import SimpleNamespace
+from typing import Any, Callable, Optional
+
+from google.api_core.exceptions import ServiceUnavailable
+from google.cloud.firestore import ArrayUnion, ArrayRemove
+
+
+class Fault:
+    def __init__(self, count: int, operation: Optional[str], error: Optional[Exception], stall: float):
+        self.count = count
+        self.operation = operation
+        self.error = error
+        self.stall = stall
+
+
+class Network:
+    """
+    Counts the requests the fakes below receive, each one a round trip to Google, and optionally makes each of them
+    take latency seconds. Concurrent requests wait out their latency side by side.
+    fail and stall inject faults into the next requests of one operation (get, set, update, delete, query, get_all,
+    listen, transaction) or of any
+    """
+    latency: float
+    round_trips: int
+    # While set, listener events queue up until deliver(), as if they were still on their way
+    hold_events: bool
+
+    def __init__(self, latency: float = 0):
+        self.latency = latency
+        self.round_trips = 0
+        self.hold_events = False
+        self.held: list[tuple[Callable, tuple]] = []
+        self.faults: list[Fault] = []
+        self.lock = Lock()
+
+    def fail(self, count: int, operation: Optional[str] = None, error: Optional[Exception] = None):
+        with self.lock:
+            self.faults.append(Fault(count, operation, error or ServiceUnavailable("injected fault"), 0))
+
+    def stall(self, count: int, seconds: float, operation: Optional[str] = None):
+        with self.lock:
+            self.faults.append(Fault(count, operation, None, seconds))
+
+    def heal(self):
+        with self.lock:
+            self.faults = []
+
+    def call(self, operation: str = ""):
+        fault = None
+        with self.lock:
+            self.round_trips += 1
+            for candidate in self.faults:
+                if candidate.count > 0 and candidate.operation in (None, operation):
+                    candidate.count -= 1
+                    fault = candidate
+                    break
+        if self.latency > 0 or fault is not None and fault.stall > 0:
+            sleep(self.latency + (fault.stall if fault is not None else 0))
+        if fault is not None and fault.error is not None:
+            raise fault.error
+
+    def reset(self) -> int:
+        with self.lock:
+            round_trips = self.round_trips
+            self.round_trips = 0
+            return round_trips
+
+    def dispatch(self, callback: Callable, *args):
+        with self.lock:
+            if self.hold_events:
+                self.held.append((callback, args))
+                return
+        callback(*args)
+
+    def deliver(self):
+        with self.lock:
+            held = self.held
+            self.held = []
+            self.hold_events = False
+        for callback, args in held:
+            callback(*args)
+
+
+class Registration:
+    """What listen and on_snapshot hand back, closing it stops the events"""
+    def __init__(self, listeners: list, callback: Callable):
+        self.listeners = listeners
+        self.callback = callback
+        listeners.append(callback)
+
+    def close(self):
+        if self.callback in self.listeners:
+            self.listeners.remove(self.callback)
+
+    unsubscribe = close
+
+
+"""Firestore"""
+class FakeDocumentSnapshot:
+    def __init__(self, identifier: str, data: Optional[dict], update_time: Optional[int] = None):
+        self.id = identifier
+        self._data = data
+        self.update_time = update_time
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def get(self, field: str) -> Any:
+        if self._data is None:
+            return None
+        return deepcopy(self._data[field])
+
+    def to_dict(self) -> Optional[dict]:
+        return deepcopy(self._data)
+
+
+class FakeDocumentReference:
+    def __init__(self, collection: "FakeCollectionReference", identifier: str):
+        self.collection = collection
+        self.id = identifier
+
+    def snapshot(self, field_paths: Optional[list[str]] = None) -> FakeDocumentSnapshot:
+        data = self.collection.documents.get(self.id)
+        if data is not None and field_paths is not None:
+            data = {field: data[field] for field in field_paths if field in data}
+        return FakeDocumentSnapshot(self.id, deepcopy(data), self.collection.update_times.get(self.id))
+
+    def changed(self):
+        """Call with the lock held after every write, returns the notification to send once it is released"""
+        self.collection.firestore.clock += 1
+        if self.id in self.collection.documents:
+            self.collection.update_times[self.id] = self.collection.firestore.clock
+        else:
+            self.collection.update_times.pop(self.id, None)
+        snapshot = self.snapshot()
+        return [(callback, snapshot) for callback in list(self.collection.listeners.get(self.id, []))]
+
+    def notify(self, notifications):
+        for callback, snapshot in notifications:
+            self.collection.network.dispatch(callback, [snapshot], [], None)
+
+    def on_snapshot(self, callback: Callable) -> Registration:
+        self.collection.network.call("listen")
+        with self.collection.lock:
+            registration = Registration(self.collection.listeners.setdefault(self.id, []), callback)
+            snapshot = self.snapshot()
+        self.collection.network.dispatch(callback, [snapshot], [], None)
+        return registration
+
+    def get(self, field_paths: Optional[list[str]] = None) -> FakeDocumentSnapshot:
+        self.collection.network.call("get")
+        with self.collection.lock:
+            return self.snapshot(field_paths)
+
+    def set(self, data: dict):
+        self.collection.network.call("set")
+        with self.collection.lock:
+            self.collection.documents[self.id] = deepcopy(data)
+            notifications = self.changed()
+        self.notify(notifications)
+
+    def update(self, data: dict):
+        self.collection.network.call("update")
+        with self.collection.lock:
+            document = self.collection.documents.get(self.id)
+            if document is None:
+                raise KeyError(f"No document to update: {self.id}")
+            for field, value in data.items():
+                if isinstance(value, ArrayUnion):
+                    current = document.get(field, [])
+                    document[field] = current + [item for item in value.values if item not in current]
+                elif isinstance(value, ArrayRemove):
+                    document[field] = [item for item in document.get(field, []) if item not in value.values]
+                else:
+                    document[field] = deepcopy(value)
+            notifications = self.changed()
+        self.notify(notifications)
+
+    def delete(self):
+        self.collection.network.call("delete")
+        with self.collection.lock:
+            self.collection.documents.pop(self.id, None)
+            notifications = self.changed()
+        self.notify(notifications)
+
+
+class FakeQuery:
+    def __init__(self, collection: "FakeCollectionReference", field: str, operator: str, value: Any):
+        self.collection = collection
+        self.field = field
+        self.operator = operator
+        self.value = value
+
+    def matches(self, data: dict) -> bool:
+        if self.operator == "==":
+            return data.get(self.field) == self.value
+        if self.operator == "in":
+            return data.get(self.field) in self.value
+        if self.operator == "array_contains":
+            return self.value in data.get(self.field, [])
+        raise NotImplementedError(self.operator)
+
+    def stream(self):
+        self.collection.network.call("query")
+        with self.collection.lock:
+            matched = [
+                FakeDocumentSnapshot(identifier, deepcopy(data))
+                for identifier, data in self.collection.documents.items()
+                if self.matches(data)
+            ]
+        yield from matched
+
+
+class FakeCollectionReference:
+    def __init__(self, firestore: "FakeFirestore"):
+        self.firestore = firestore
+        self.network = firestore.network
+        self.lock = firestore.lock
+        self.documents: dict[str, dict] = {}
+        self.update_times: dict[str, int] = {}
+        self.listeners: dict[str, list[Callable]] = {}
+
+    def document(self, identifier: str) -> FakeDocumentReference:
+        return FakeDocumentReference(self, identifier)
+
+    def where(self, field: str, operator: str, value: Any) -> FakeQuery:
+        return FakeQuery(self, field, operator, value)
+
+
+class FakeFirestore:
+    """The parts of google.cloud.firestore.Client FirebaseDatabase uses, kept in memory"""
+    def __init__(self, network: Network):
+        self.network = network
+        self.lock = Lock()
+        self.collections: dict[str, FakeCollectionReference] = {}
+        # Stands in for the server's commit timestamps
+        self.clock = 0
+
+    def collection(self, name: str) -> FakeCollectionReference:
+        with self.lock:
+            if name not in self.collections:
+                self.collections[name] = FakeCollectionReference(self)
+            return self.collections[name]
+
+    def get_all(self, references: list[FakeDocumentReference], field_paths: Optional[list[str]] = None):
+        # Batched, a single round trip however many documents are asked for
+        self.network.call("get_all")
+        with self.lock:
+            snapshots = [reference.snapshot(field_paths) for reference in references]
+        yield from snapshots
+
+
+"""Realtime Database"""
+def split(path: str) -> list[str]:
+    return [part for part in path.split("/") if part != ""]
+
+
+class FakeRealtimeQuery:
+    def __init__(self, reference: "FakeReference", child: str):
+        self.reference = reference
+        self.child = child
+        self.start = None
+        self.end = None
+        self.first = None
+        self.last = None
+
+    # firebase_admin's query methods update the query in place and return it, so do these
+    def start_at(self, start):
+        if start is None:
+            raise ValueError('Start value must not be None.')
+        self.start = start
+        return self
+
+    def end_at(self, end):
+        if end is None:
+            raise ValueError('End value must not be None.')
+        self.end = end
+        return self
+
+    def equal_to(self, value):
+        if value is None:
+            raise ValueError('Equal to value must not be None.')
+        self.start = self.end = value
+        return self
+
+    def limit_to_first(self, limit: int):
+        self.first = limit
+        return self
+
+    def limit_to_last(self, limit: int):
+        self.last = limit
+        return self
+
+    def get(self) -> Optional[dict]:
+        children = self.reference.get() or {}
+        ordered = sorted(children.items(), key=lambda item: (item[1].get(self.child) is None, item[1].get(self.child)))
+        ordered = [
+            (key, value)
+            for key, value in ordered
+            if (self.start is None or value.get(self.child) is not None and value.get(self.child) >= self.start)
+            and (self.end is None or value.get(self.child) is not None and value.get(self.child) <= self.end)
+        ]
+        if self.first is not None:
+            ordered = ordered[:self.first]
+        if self.last is not None:
+            ordered = ordered[-self.last:]
+        return dict(ordered)
+
+
+class FakeReference:
+    def __init__(self, realtime: "FakeRealtime", path: str):
+        self.realtime = realtime
+        self.path = split(path)
+
+    def node(self, path: list[str]) -> Any:
+        node = self.realtime.tree
+        for part in path:
+            if not isinstance(node, dict) or part not in node:
+                return None
+            node = node[part]
+        return node
+
+    def write(self, path: list[str], value: Any):
+        if len(path) == 0:
+            self.realtime.tree = value if isinstance(value, dict) else {}
+            return
+        node = self.realtime.tree
+        for part in path[:-1]:
+            if not isinstance(node.get(part), dict):
+                node[part] = {}
+            node = node[part]
+        if value is None:
+            node.pop(path[-1], None)
+        else:
+            node[path[-1]] = deepcopy(value)
+
+    def events(self, written: list[str], value: Any, event_type: str = "put") -> list:
+        """Call with the lock held after writing value at written, returns the events to send once it is released"""
+        events = []
+        for path, callbacks in self.realtime.listeners.items():
+            listened = split(path)
+            if written[:len(listened)] == listened:
+                event = SimpleNamespace(event_type=event_type, path="/" + "/".join(written[len(listened):]), data=value)
+            elif listened[:len(written)] == written:
+                event = SimpleNamespace(event_type="put", path="/", data=deepcopy(self.node(listened)))
+            else:
+                continue
+            events.extend((callback, event) for callback in list(callbacks))
+        return events
+
+    def notify(self, events: list):
+        for callback, event in events:
+            self.realtime.network.dispatch(callback, event)
+
+    def get(self) -> Any:
+        self.realtime.network.call("get")
+        with self.realtime.lock:
+            return deepcopy(self.node(self.path))
+
+    def set(self, value: Any):
+        self.realtime.network.call("set")
+        with self.realtime.lock:
+            self.write(self.path, value)
+            events = self.events(self.path, deepcopy(value))
+        self.notify(events)
+
+    def update(self, values: dict):
+        # Multi-path, every key may be a path below this node and None deletes, all applied at once
+        self.realtime.network.call("update")
+        with self.realtime.lock:
+            for child, value in values.items():
+                self.write(self.path + split(child), value)
+            events = self.events(self.path, deepcopy(values), "patch")
+        self.notify(events)
+
+    def delete(self):
+        self.realtime.network.call("delete")
+        with self.realtime.lock:
+            self.write(self.path, None)
+            events = self.events(self.path, None)
+        self.notify(events)
+
+    def listen(self, callback: Callable) -> Registration:
+        # Starts with the whole node, then every change below it
+        self.realtime.network.call("listen")
+        with self.realtime.lock:
+            registration = Registration(self.realtime.listeners.setdefault("/".join(self.path), []), callback)
+            initial = SimpleNamespace(event_type="put", path="/", data=deepcopy(self.node(self.path)))
+        self.realtime.network.dispatch(callback, initial)
+        return registration
+
+    def transaction(self, transaction_update) -> Any:
+        # As firebase_admin does it, read the value, then write the update only if nobody changed the value since
+        while True:
+            current = self.get()
+            value = transaction_update(deepcopy(current))
+            self.realtime.network.call("transaction")
+            with self.realtime.lock:
+                if self.node(self.path) == current:
+                    self.write(self.path, value)
+                    events = self.events(self.path, deepcopy(value))
+                    break
+        self.notify(events)
+        return value
+
+    def order_by_child(self, child: str) -> FakeRealtimeQuery:
+        return FakeRealtimeQuery(self, child)
+
+
+class FakeRealtime:
+    """Stands in for firebase_admin.db.reference, call it with a path as FirebaseDatabase does"""
+    def __init__(self, network: Network):
+        self.network = network
+        self.lock = Lock()
+        self.tree: dict = {}
+        self.listeners: dict[str, list[Callable]] = {}
+
+    def __call__(self, path: str = "/") -> FakeReference:
+        return FakeReference(self, path)
@@ -0,0 +1,53 @@
+from time import perf_counter
+
+from benchmarks.firebase_fake import Network, FakeFirestore, FakeRealtime
+from database.FirebaseDatabase import FirebaseDatabase, request_scope
+from database.cookie import Cookie
+from database.user import USER_GROUP_IDS, USER_INTERACTED_GROUP_IDS, USER_PINNED_GROUP_IDS, USER_REQUESTS
+
+# A typical round trip from a server to Firebase
+LATENCY = 0.02
+
+
+def run():
+    network = Network()
+    database = FirebaseDatabase(FakeFirestore(network), FakeRealtime(network))
+    cookie = Cookie("owner", "owner@shadowtalk.com", "Owner")
+    database.user_collection.document(cookie.id).set({
+        USER_GROUP_IDS: [],
+        USER_INTERACTED_GROUP_IDS: [],
+        USER_PINNED_GROUP_IDS: [],
+        USER_REQUESTS: []
+    })
+    group = database.group_private_create("Bench", cookie.id)
+    database.message_send(cookie, group.id, "hello", False, None, None)
+    message_id = database.message_get(cookie, group.id, None, 1)[0].id
+
+    operations = [
+        ("user_has_group_access", lambda: database.user_has_group_access(cookie.id, group.id)),
+        ("group_get", lambda: database.group_get(cookie, group.id)),
+        ("message_send", lambda: database.message_send(cookie, group.id, "hi", False, None, None)),
+        ("message_get", lambda: database.message_get(cookie, group.id, None, 20)),
+        ("message_edit", lambda: database.message_edit(cookie, group.id, message_id, "hey")),
+        ("message_get_with_id", lambda: database.message_get_with_id(cookie, group.id, message_id)),
+    ]
+
+    network.latency = LATENCY
+    print(f"{'operation':>22} {'round trips':>12} {'ms':>8} {'in request':>11} {'ms':>8}")
+    for name, operation in operations:
+        network.reset()
+        start = perf_counter()
+        operation()
+        alone = (network.reset(), (perf_counter() - start) * 1e3)
+        # As the view of a request which already checked access would see it
+        with request_scope():
+            database.user_has_group_access(cookie.id, group.id)
+            network.reset()
+            start = perf_counter()
+            operation()
+            scoped = (network.reset(), (perf_counter() - start) * 1e3)
+        print(f"{name:>22} {alone[0]:>12} {alone[1]:>8.1f} {scoped[0]:>11} {scoped[1]:>8.1f}")
+
+
+if __name__ == '__main__':
+    run()
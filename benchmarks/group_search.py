@@ -0,0 +1,41 @@
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from benchmarks.login import open_database
+from database.cookie import Cookie
+from database.group import Group
+
+GROUP_COUNTS = [100, 1_000, 10_000]
+OTHER_GROUPS = 100_000
+QUERIES = ["Group 4242", "Project", "zzz", "Gr"]
+REPEAT = 200
+
+
+def run():
+    print(f"{'groups':>8} {'query':>12} {'search (us)':>12}")
+    for group_count in GROUP_COUNTS:
+        with TemporaryDirectory() as directory:
+            database = open_database(directory)
+            database.user_create("owner@shadowtalk.com", "Owner", "password")
+            user_id = database.user_ids_by_email["owner@shadowtalk.com"]
+            cookie = Cookie(user_id, "owner@shadowtalk.com", "Owner")
+            for i in range(group_count):
+                database.group_private_create(f"Group {i}", user_id)
+            # Groups the user is not in still share trigrams with the queries
+            for i in range(OTHER_GROUPS):
+                group = Group.private(f"Project {i}", [])
+                database.groups[group.id] = group
+                database.group_roles[group.id] = {}
+                database.group_names.add(group.id, group.name)
+
+            for query in QUERIES:
+                start = perf_counter()
+                for _ in range(REPEAT):
+                    database.group_search(cookie, query)
+                elapsed = (perf_counter() - start) / REPEAT * 1e6
+                print(f"{group_count:>8} {query:>12} {elapsed:>12.1f}")
+            database.log.close()
+
+
+if __name__ == '__main__':
+    run()
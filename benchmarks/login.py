@@ -0,0 +1,50 @@
+from os.path import join
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from database.FileDatabase import FileDatabase
+from database.user import User
+
+USER_COUNTS = [1_000, 10_000, 100_000]
+LOOKUPS = 10_000
+LOGINS = 20
+
+
+def open_database(directory: str) -> FileDatabase:
+    return FileDatabase(
+        join(directory, "users.dat"),
+        join(directory, "groups.dat"),
+        join(directory, "messages"),
+        join(directory, "auth.dat"),
+        join(directory, "journal.log"),
+    )
+
+def populate(directory: str, user_count: int):
+    database = open_database(directory)
+    database.user_create("target@shadowtalk.com", "Target", "password")
+    for i in range(user_count - 1):
+        user = User(f"user{i}@shadowtalk.com", f"User {i}")
+        database.users[user.id] = user
+    database.checkpoint()
+    database.log.close()
+
+def per_call(function, repeat: int) -> float:
+    start = perf_counter()
+    for _ in range(repeat):
+        function()
+    return (perf_counter() - start) / repeat * 1e6
+
+def run():
+    print(f"{'users':>10} {'exists_email (us)':>20} {'login (us)':>12}")
+    for user_count in USER_COUNTS:
+        with TemporaryDirectory() as directory:
+            populate(directory, user_count)
+            database = open_database(directory)
+            exists = per_call(lambda: database.user_exists_email("missing@shadowtalk.com"), LOOKUPS)
+            login = per_call(lambda: database.user_login("target@shadowtalk.com", "password"), LOGINS)
+            database.log.close()
+        print(f"{user_count:>10} {exists:>20.3f} {login:>12.1f}")
+
+
+if __name__ == '__main__':
+    run()
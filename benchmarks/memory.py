@@ -0,0 +1,92 @@
+import tracemalloc
+from typing import Optional
+
+import msgpack
+
+from database.message import Message
+
+MESSAGE_COUNT = 200_000
+AUTHOR_COUNT = 500
+# Every tenth message replies to one of a few popular messages
+REPLY_EVERY = 10
+QUOTED_COUNT = 20
+
+
+class DictMessage:
+    """Message as it was before slots, attributes in a per-instance __dict__ and every string its own copy"""
+
+    def __init__(
+            self,
+            identifier: str,
+            index: int,
+            author_id: str,
+            author_name: str,
+            content: str,
+            is_author_admin: bool,
+            is_reply: bool,
+            reply_to_user: Optional[str],
+            reply_to_content: Optional[str]
+    ):
+        self.id = identifier
+        self.index = index
+        self.author_id = author_id
+        self.author_name = author_name
+        self.content = content
+        self.is_author_admin = is_author_admin
+        self.is_reply = is_reply
+        self.reply_to_user = reply_to_user
+        self.reply_to_content = reply_to_content
+
+
+def records() -> bytes:
+    """Messages the way a shard holds them, decoding gives every record its own strings"""
+    packer = msgpack.Packer()
+    chunks = []
+    for i in range(MESSAGE_COUNT):
+        author = i % AUTHOR_COUNT
+        is_reply = i % REPLY_EVERY == 0
+        message = Message.generate(
+            f"{author:08x}-0000-4000-8000-000000000000",
+            f"User {author}",
+            f"message number {i}",
+            False,
+            is_reply,
+            f"User {i % QUOTED_COUNT}" if is_reply else None,
+            f"a message quoted by many replies {i % QUOTED_COUNT}" if is_reply else None,
+            i + 1
+        )
+        chunks.append(packer.pack([
+            message.id,
+            message.index,
+            message.author_id,
+            message.author_name,
+            message.content,
+            message.is_author_admin,
+            message.is_reply,
+            message.reply_to_user,
+            message.reply_to_content,
+        ]))
+    return b"".join(chunks)
+
+def bytes_per_message(model, data: bytes) -> float:
+    tracemalloc.start()
+    unpacker = msgpack.Unpacker(raw=False)
+    unpacker.feed(data)
+    messages = {}
+    for record in unpacker:
+        message = model(*record)
+        messages[message.id] = message
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size / len(messages)
+
+
+def run():
+    data = records()
+    print(f"{'messages':>10} {'model':>10} {'bytes/message':>14}")
+    for name, model in [("dict", DictMessage), ("slots", Message)]:
+        print(f"{MESSAGE_COUNT:>10} {name:>10} {bytes_per_message(model, data):>14.0f}")
+
+
+if __name__ == '__main__':
+    run()
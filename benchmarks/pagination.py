@@ -0,0 +1,41 @@
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from benchmarks.login import open_database
+from database.cookie import Cookie
+from database.message import Message
+
+MESSAGE_COUNTS = [100, 10_000, 1_000_000]
+PAGE_SIZE = 64
+REPEAT = 1_000
+
+
+def run():
+    print(f"{'messages':>10} {'latest page (us)':>18} {'cursor page (us)':>18}")
+    for message_count in MESSAGE_COUNTS:
+        with TemporaryDirectory() as directory:
+            database = open_database(directory)
+            database.user_create("owner@shadowtalk.com", "Owner", "password")
+            user_id = database.user_ids_by_email["owner@shadowtalk.com"]
+            cookie = Cookie(user_id, "owner@shadowtalk.com", "Owner")
+            group = database.group_private_create("Bench", user_id)
+            for i in range(message_count):
+                message = Message.generate(user_id, "Owner", f"message {i}", True, False, index=i + 1)
+                database.messages.put(group.id, message)
+            middle = database.messages.index(group.id).message_ids[message_count // 2]
+
+            start = perf_counter()
+            for _ in range(REPEAT):
+                database.message_get(cookie, group.id, None, PAGE_SIZE)
+            latest = (perf_counter() - start) / REPEAT * 1e6
+
+            start = perf_counter()
+            for _ in range(REPEAT):
+                database.message_get(cookie, group.id, middle, PAGE_SIZE)
+            cursor = (perf_counter() - start) / REPEAT * 1e6
+            database.log.close()
+        print(f"{message_count:>10} {latest:>18.2f} {cursor:>18.2f}")
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,61 @@
+import json
+from multiprocessing import get_context
+from multiprocessing.pool import Pool
+from os.path import join
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from database.SQLiteDatabase import SQLiteDatabase
+from database.cookie import Cookie
+
+WORKER_COUNTS = [1, 4, 8]
+GROUPS = 8
+SENDS_PER_WORKER = 500
+READS_PER_WORKER = 2_000
+PAGE_SIZE = 32
+
+
+def populate(location: str) -> tuple[Cookie, list[str]]:
+    database = SQLiteDatabase(location)
+    token = database.user_create("owner@shadowtalk.com", "Owner", "password")
+    cookie = Cookie(json.loads(token)["uid"], "owner@shadowtalk.com", "Owner")
+    group_ids = [database.group_private_create(f"Bench {i}", cookie.id).id for i in range(GROUPS)]
+    database.close()
+    return cookie, group_ids
+
+def send(arguments: tuple) -> int:
+    location, worker, cookie, group_ids = arguments
+    database = SQLiteDatabase(location)
+    for i in range(SENDS_PER_WORKER):
+        database.message_send(cookie, group_ids[(worker + i) % len(group_ids)], f"message {i}", False, None, None)
+    return SENDS_PER_WORKER
+
+def read(arguments: tuple) -> int:
+    location, worker, cookie, group_ids = arguments
+    database = SQLiteDatabase(location)
+    for i in range(READS_PER_WORKER):
+        database.message_get(cookie, group_ids[(worker + i) % len(group_ids)], None, PAGE_SIZE)
+    return READS_PER_WORKER
+
+def throughput(pool: Pool, function, arguments: list[tuple]) -> float:
+    start = perf_counter()
+    operations = sum(pool.map(function, arguments))
+    return operations / (perf_counter() - start)
+
+def run():
+    print(f"{'workers':>8} {'sends/s':>10} {'page reads/s':>14}")
+    for worker_count in WORKER_COUNTS:
+        with TemporaryDirectory() as directory:
+            location = join(directory, "shadowtalk.sqlite3")
+            cookie, group_ids = populate(location)
+            arguments = [(location, worker, cookie, group_ids) for worker in range(worker_count)]
+            # Workers are spawned, a forked child closing an inherited SQLite handle drops the parent's file locks
+            with get_context("spawn").Pool(worker_count) as pool:
+                pool.map(abs, range(worker_count))
+                sends = throughput(pool, send, arguments)
+                reads = throughput(pool, read, arguments)
+        print(f"{worker_count:>8} {sends:>10.0f} {reads:>14.0f}")
+
+
+if __name__ == '__main__':
+    run()
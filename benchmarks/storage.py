@@ -0,0 +1,79 @@
+import pickle
+from os.path import getsize, join
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from database import storage
+from database.group import Group
+from database.message import Message
+from database.user import User
+
+USER_COUNT = 100_000
+GROUP_COUNT = 10_000
+MESSAGE_COUNT = 1_000_000
+REPEATS = 3
+
+
+def users() -> dict[str, User]:
+    result = {}
+    for i in range(USER_COUNT):
+        user = User(f"user{i}@shadowtalk.com", f"User {i}")
+        user.group_ids = [f"group {(i + j) % GROUP_COUNT}" for j in range(5)]
+        result[user.id] = user
+    return result
+
+def groups() -> dict[str, Group]:
+    result = {}
+    for i in range(GROUP_COUNT):
+        group = Group.generate(f"Group {i}")
+        group.member_ids = [f"user {(i + j) % USER_COUNT}" for j in range(50)]
+        result[group.id] = group
+    return result
+
+def messages() -> dict[str, Message]:
+    result = {}
+    for i in range(MESSAGE_COUNT):
+        message = Message.generate(f"user {i % 500}", f"User {i % 500}", f"message number {i}", False, False, index=i + 1)
+        result[message.id] = message
+    return result
+
+def best_of(function) -> float:
+    best = None
+    for _ in range(REPEATS):
+        start = perf_counter()
+        function()
+        duration = perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best * 1e3
+
+
+def run():
+    print(f"{'file':>10} {'records':>9} {'pickle (MB)':>12} {'msgpack (MB)':>13} {'pickle load (ms)':>17} {'msgpack load (ms)':>18}")
+    datasets = [
+        ("users", users(), storage.dump_users, storage.load_users),
+        ("groups", groups(), storage.dump_groups, storage.load_groups),
+        ("messages", messages(), storage.dump_messages, storage.load_messages),
+    ]
+    with TemporaryDirectory() as directory:
+        for name, data, dump, load in datasets:
+            pickle_location = join(directory, f"{name}.pickle")
+            msgpack_location = join(directory, f"{name}.dat")
+            with open(pickle_location, 'wb') as f:
+                pickle.dump(data, f)
+            with open(msgpack_location, 'wb') as f:
+                f.write(dump(data))
+
+            def load_pickle():
+                with open(pickle_location, 'rb') as f:
+                    pickle.load(f)
+
+            pickle_load = best_of(load_pickle)
+            msgpack_load = best_of(lambda: load(msgpack_location))
+            print(
+                f"{name:>10} {len(data):>9} {getsize(pickle_location) / 1e6:>12.1f} "
+                f"{getsize(msgpack_location) / 1e6:>13.1f} {pickle_load:>17.1f} {msgpack_load:>18.1f}"
+            )
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,43 @@
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from benchmarks.login import open_database
+from database.message import Message
+
+MESSAGE_COUNT = 1_000_000
+# Messages written by each of the two wiped authors, everybody else shares the rest
+AUTHOR_MESSAGES = [10, 1_000, 100_000]
+
+
+def run():
+    print(f"{'messages':>10} {'wiped':>8} {'rebuild (ms)':>14} {'author index (ms)':>18}")
+    for author_messages in AUTHOR_MESSAGES:
+        with TemporaryDirectory() as directory:
+            database = open_database(directory)
+            database.user_create("owner@shadowtalk.com", "Owner", "password")
+            user_id = database.user_ids_by_email["owner@shadowtalk.com"]
+            group = database.group_private_create("Bench", user_id)
+            authors = ["old", "new"]
+            for i in range(MESSAGE_COUNT):
+                author_id = authors[i % 2] if i < author_messages * 2 else f"user {i % 500}"
+                message = Message.generate(author_id, author_id, f"message {i}", False, False, index=i + 1)
+                database.messages.put(group.id, message)
+
+            # What user_wipe_all_group_messages used to do, rebuild the group without the author
+            start = perf_counter()
+            database.messages.create(group.id, dict(
+                (message_id, message)
+                for message_id, message in database.messages[group.id].items()
+                if message.author_id != "old"
+            ))
+            rebuild = (perf_counter() - start) * 1e3
+
+            start = perf_counter()
+            database.messages.wipe_author(group.id, "new")
+            author_index = (perf_counter() - start) * 1e3
+            database.log.close()
+        print(f"{MESSAGE_COUNT:>10} {author_messages:>8} {rebuild:>14.1f} {author_index:>18.1f}")
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,319 @@
+"""
+Synthetic workload for any DatabaseInterop.
+
+generate() fills a database through its public API: users, groups whose sizes follow a Zipf distribution, and
+messages sent to groups picked with Zipfian activity. replay() then runs a seeded mix of sends, page reads, searches,
+joins/leaves and wipes against it and reports throughput and latency percentiles per method.
+
+    python -m benchmarks.workload --backend file --output results.json
+"""
+import argparse
+import json
+import platform
+import subprocess
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from itertools import accumulate
+from os.path import join
+from random import Random
+from statistics import quantiles
+from tempfile import TemporaryDirectory
+from threading import Lock, Thread
+from time import perf_counter
+from typing import Callable, Optional
+
+from benchmarks.login import open_database
+from database.Interop import DatabaseInterop, Token
+from database.cookie import Cookie
+from database.locks import ReadWriteLock
+
+VOCABULARY = [
+    "hello", "meeting", "tomorrow", "lunch", "project", "deadline", "coffee", "review", "release", "weekend",
+    "bug", "deploy", "call", "today", "thanks", "shadow", "talk", "group", "photo", "party",
+    "game", "movie", "music", "travel", "ticket", "train", "late", "sorry", "great", "cool",
+]
+PAGE_SIZE = 20
+
+# Relative weight of every operation in the replayed mix
+DEFAULT_MIX = {
+    "message_send": 40,
+    "message_get": 35,
+    "message_search": 10,
+    "user_join_group": 5,
+    "user_leave_group": 5,
+    "user_wipe_all_group_messages": 5,
+}
+# DatabaseInterop reports a rejected mutation by returning False rather than raising, those count as errors too
+MUTATIONS = {"message_send", "user_join_group", "user_leave_group", "user_wipe_all_group_messages"}
+
+
+class Zipf:
+    """Picks ranks 0..n-1 with probability proportional to 1 / (rank + 1) ** exponent"""
+
+    def __init__(self, n: int, exponent: float):
+        self.cumulative = list(accumulate(1 / (rank + 1) ** exponent for rank in range(n)))
+
+    def __call__(self, random: Random) -> int:
+        return bisect_left(self.cumulative, random.random() * self.cumulative[-1])
+
+
+class Dataset:
+    """What generate() created, and the membership replay() keeps up to date as users join and leave"""
+    cookies: list[Cookie]
+    group_ids: list[str]
+    members: list[set[int]]
+    # Oldest message of the last page read in each group, the cursor of the next page further back
+    cursors: dict[str, str]
+    # Held exclusively while a user joins or leaves the group, so no operation is issued for a member who just left
+    group_locks: list[ReadWriteLock]
+
+    def __init__(self, cookies: list[Cookie], group_ids: list[str], members: list[set[int]]):
+        self.cookies = cookies
+        self.group_ids = group_ids
+        self.members = members
+        self.cursors = {}
+        self.lock = Lock()
+        self.group_locks = [ReadWriteLock() for _ in group_ids]
+
+
+def cookie_from_token(token: Token) -> Cookie:
+    return Cookie.from_dict(json.loads(token))
+
+def sentence(random: Random, words: Zipf) -> str:
+    return " ".join(VOCABULARY[words(random)] for _ in range(random.randint(3, 12)))
+
+def generate(
+        database: DatabaseInterop,
+        users: int,
+        groups: int,
+        messages: int,
+        seed: int = 0,
+        memberships: int = 3,
+        exponent: float = 1.1,
+        decode_token: Callable[[Token], Cookie] = cookie_from_token
+) -> Dataset:
+    random = Random(seed)
+    popularity = Zipf(groups, exponent)
+    words = Zipf(len(VOCABULARY), 1.0)
+
+    # Creating a user hashes its password, which is what dominates the setup, so hash several at once
+    with ThreadPoolExecutor(4) as executor:
+        tokens = list(executor.map(
+            lambda i: database.user_create(f"bench{i}@shadowtalk.com", f"Bench {i}", "password"),
+            range(users)
+        ))
+    cookies = [decode_token(token) for token in tokens]
+
+    group_ids = []
+    members = []
+    for i in range(groups):
+        creator = random.randrange(users)
+        group = database.group_private_create(f"Group {i} {VOCABULARY[i % len(VOCABULARY)]}", cookies[creator].id)
+        group_ids.append(group.id)
+        members.append({creator})
+    # Every user joins a few groups picked by popularity, so a handful of groups end up with most members
+    for user in range(users):
+        for _ in range(memberships):
+            group = popularity(random)
+            if user not in members[group]:
+                database.user_join_group(cookies[user], group_ids[group])
+                members[group].add(user)
+
+    for _ in range(messages):
+        group = popularity(random)
+        author = random.choice(tuple(members[group]))
+        database.message_send(cookies[author], group_ids[group], sentence(random, words), False, None, None)
+    return Dataset(cookies, group_ids, members)
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = {}
+        self.errors: dict[str, int] = {}
+        self.lock = Lock()
+
+    def call(self, method: str, function: Callable, *args):
+        start = perf_counter()
+        try:
+            result = function(*args)
+        except Exception as e:
+            result = e
+        duration = perf_counter() - start
+        with self.lock:
+            self.latencies.setdefault(method, []).append(duration)
+            if isinstance(result, Exception) or (method in MUTATIONS and not result):
+                self.errors[method] = self.errors.get(method, 0) + 1
+        return None if isinstance(result, Exception) else result
+
+
+def operation(database: DatabaseInterop, dataset: Dataset, recorder: Recorder, method: str, random: Random,
+              popularity: Zipf, words: Zipf):
+    group = popularity(random)
+    if method == "user_join_group" or method == "user_leave_group":
+        with dataset.group_locks[group].write():
+            change_membership(database, dataset, recorder, group, random)
+    else:
+        with dataset.group_locks[group].read():
+            member_operation(database, dataset, recorder, method, group, random, words)
+
+def change_membership(database: DatabaseInterop, dataset: Dataset, recorder: Recorder, group: int, random: Random):
+    # Keeps the membership stable, whoever is picked joins if they are out and leaves if they are in
+    group_id = dataset.group_ids[group]
+    user = random.randrange(len(dataset.cookies))
+    with dataset.lock:
+        joined = user in dataset.members[group]
+        if joined and len(dataset.members[group]) == 1:
+            return
+    if joined:
+        if recorder.call("user_leave_group", database.user_leave_group, dataset.cookies[user], group_id, False):
+            with dataset.lock:
+                dataset.members[group].discard(user)
+    elif recorder.call("user_join_group", database.user_join_group, dataset.cookies[user], group_id):
+        with dataset.lock:
+            dataset.members[group].add(user)
+
+def member_operation(database: DatabaseInterop, dataset: Dataset, recorder: Recorder, method: str, group: int,
+                     random: Random, words: Zipf):
+    group_id = dataset.group_ids[group]
+    with dataset.lock:
+        members = tuple(dataset.members[group])
+    member = dataset.cookies[random.choice(members)] if len(members) != 0 else None
+
+    if member is None:
+        return
+    elif method == "message_send":
+        recorder.call(method, database.message_send, member, group_id, sentence(random, words), False, None, None)
+    elif method == "message_get":
+        # Half the reads open a group at its newest messages, the others scroll back from the last page read
+        cursor = dataset.cursors.get(group_id) if random.random() < 0.5 else None
+        page = recorder.call(method, database.message_get, member, group_id, cursor, PAGE_SIZE)
+        if page:
+            dataset.cursors[group_id] = page[0].id
+        elif cursor is not None:
+            dataset.cursors.pop(group_id, None)
+    elif method == "message_search":
+        query = " ".join(VOCABULARY[words(random)] for _ in range(random.randint(1, 2)))
+        recorder.call(method, database.message_search, member, query)
+    elif method == "user_wipe_all_group_messages":
+        recorder.call(method, database.user_wipe_all_group_messages, member, group_id)
+
+def replay(
+        database: DatabaseInterop,
+        dataset: Dataset,
+        operations: int,
+        seed: int = 0,
+        mix: Optional[dict[str, int]] = None,
+        threads: int = 1,
+        exponent: float = 1.1
+) -> dict:
+    mix = DEFAULT_MIX if mix is None else mix
+    methods = list(mix.keys())
+    cumulative = list(accumulate(mix.values()))
+    popularity = Zipf(len(dataset.group_ids), exponent)
+    words = Zipf(len(VOCABULARY), 1.0)
+    recorder = Recorder()
+
+    def worker(worker_seed: int, amount: int):
+        random = Random(worker_seed)
+        for _ in range(amount):
+            method = methods[bisect_left(cumulative, random.random() * cumulative[-1])]
+            operation(database, dataset, recorder, method, random, popularity, words)
+
+    workers = [
+        Thread(target=worker, args=(seed * 1000 + i, operations // threads + (i < operations % threads)))
+        for i in range(threads)
+    ]
+    start = perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    duration = perf_counter() - start
+    return report(recorder, duration)
+
+def report(recorder: Recorder, duration: float) -> dict:
+    methods = {}
+    calls = 0
+    for method, latencies in sorted(recorder.latencies.items()):
+        calls += len(latencies)
+        if len(latencies) > 1:
+            percentiles = quantiles(latencies, n=100, method="inclusive")
+            p50, p95, p99 = percentiles[49], percentiles[94], percentiles[98]
+        else:
+            p50 = p95 = p99 = latencies[0]
+        methods[method] = {
+            "calls": len(latencies),
+            "errors": recorder.errors.get(method, 0),
+            "throughput": len(latencies) / duration,
+            "mean_us": sum(latencies) / len(latencies) * 1e6,
+            "p50_us": p50 * 1e6,
+            "p95_us": p95 * 1e6,
+            "p99_us": p99 * 1e6,
+        }
+    return {
+        "duration_s": duration,
+        "operations": calls,
+        "throughput": calls / duration,
+        "methods": methods,
+    }
+
+def commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def open_backend(backend: str, directory: str) -> DatabaseInterop:
+    if backend == "file":
+        return open_database(directory)
+    if backend == "sqlite":
+        from database.SQLiteDatabase import SQLiteDatabase
+        return SQLiteDatabase(join(directory, "bench.sqlite3"))
+    raise ValueError(f"Unknown backend {backend}")
+
+def print_report(result: dict):
+    print(f"{'method':>30} {'calls':>7} {'errors':>7} {'ops/s':>9} {'p50 (us)':>10} {'p95 (us)':>10} {'p99 (us)':>10}")
+    for method, stats in result["methods"].items():
+        print(
+            f"{method:>30} {stats['calls']:>7} {stats['errors']:>7} {stats['throughput']:>9.0f} "
+            f"{stats['p50_us']:>10.0f} {stats['p95_us']:>10.0f} {stats['p99_us']:>10.0f}"
+        )
+    print(f"{result['operations']} operations in {result['duration_s']:.2f} s, {result['throughput']:.0f} ops/s")
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=["file", "sqlite"], default="file")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--groups", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=20_000)
+    parser.add_argument("--operations", type=int, default=20_000)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Also write the results as JSON to this file")
+    arguments = parser.parse_args()
+
+    with TemporaryDirectory() as directory:
+        database = open_backend(arguments.backend, directory)
+        start = perf_counter()
+        dataset = generate(database, arguments.users, arguments.groups, arguments.messages, arguments.seed)
+        print(f"Generated {arguments.messages} messages in {perf_counter() - start:.1f} s")
+        result = replay(database, dataset, arguments.operations, arguments.seed, threads=arguments.threads)
+        database.close()
+
+    print_report(result)
+    if arguments.output is not None:
+        result["backend"] = arguments.backend
+        result["config"] = vars(arguments)
+        result["commit"] = commit()
+        result["python"] = platform.python_version()
+        result["timestamp"] = datetime.now(timezone.utc).isoformat()
+        with open(arguments.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,117 @@
+from typing import Any, Optional
+
+from firebase_admin import firestore_async
+from google.cloud.firestore import AsyncClient, AsyncCollectionReference
+
+from database.AsyncInterop import ExecutorDatabase
+from database.FirebaseDatabase import FirebaseDatabase, group_from_snapshot, group_access
+from database.cookie import Cookie
+from database.resilience import Resilience
+from database.group import Group, GROUP_NAME, GROUP_ADMIN_IDS, GROUP_MEMBER_IDS
+from database.user import USER_GROUP_IDS, USER_REQUESTS
+from firebase_config import USER_COLLECTION, GROUP_COLLECTION
+
+class AsyncFirebaseDatabase(ExecutorDatabase):
+    """
+    FirebaseDatabase for ASGI views. Firestore reads go through the async Firestore client and never occupy a thread,
+    firebase_admin has no async client for the Realtime Database or Auth so those calls still run on the executor.
+    The reads share the deadline, retries and circuit breaker of database.resilience
+    """
+    firestore: AsyncClient
+    user_collection: AsyncCollectionReference
+    group_collection: AsyncCollectionReference
+    resilience: Resilience
+
+    def __init__(self, database: FirebaseDatabase, workers: int = 32):
+        super().__init__(database, workers)
+        self.firestore = firestore_async.client(database.firebase)
+        self.resilience = database.resilience
+        self.user_collection = self.firestore.collection(USER_COLLECTION)
+        self.group_collection = self.firestore.collection(GROUP_COLLECTION)
+
+    async def __get(self, document, field_paths: Optional[list[str]] = None, stale: bool = True):
+        """stale=False for reads that decide access, as in ResilientDocument.get"""
+        return await self.resilience.call_async(
+            "firestore",
+            "firestore_get",
+            lambda: document.get(field_paths),
+            True,
+            f"firestore:{document.path}:{field_paths}" if stale else None
+        )
+
+    async def __get_all(self, documents: list, field_paths: Optional[list[str]] = None, stale: bool = True) -> list[Any]:
+        async def read():
+            return [snapshot async for snapshot in self.firestore.get_all(documents, field_paths=field_paths)]
+        return await self.resilience.call_async(
+            "firestore",
+            "firestore_get_all",
+            read,
+            True,
+            f"firestore:{sorted(document.path for document in documents)}:{field_paths}" if stale else None
+        )
+
+    async def user_has_group_access(self, uid: str, group_id: str) -> str:
+        try:
+            group = await self.__get(
+                self.group_collection.document(group_id),
+                [GROUP_MEMBER_IDS, GROUP_ADMIN_IDS],
+                stale=False
+            )
+        except Exception as e:
+            print(e)
+            return "none"
+        return group_access(uid, group)
+
+    async def group_get(self, cookie: Cookie, group_id: str) -> Optional[Group]:
+        try:
+            group = await self.__get(self.group_collection.document(group_id), stale=False)
+        except Exception as e:
+            print(e)
+            return None
+        if group_access(cookie.id, group) == "none":
+            return None
+        return group_from_snapshot(group)
+
+    async def group_get_many(self, cookie: Cookie, group_ids: list[str]) -> list[Optional[Group]]:
+        groups = {}
+        try:
+            for group in await self.__get_all(
+                [self.group_collection.document(group_id) for group_id in set(group_ids)],
+                stale=False
+            ):
+                if group_access(cookie.id, group) != "none":
+                    groups[group.id] = group_from_snapshot(group)
+        except Exception as e:
+            print(e)
+        return [groups.get(group_id) for group_id in group_ids]
+
+    async def group_search(self, cookie: Cookie, search_query: str) -> list[Group]:
+        try:
+            user_record = await self.__get(self.user_collection.document(cookie.id), [USER_GROUP_IDS])
+            group_ids = user_record.get(USER_GROUP_IDS)
+            matched = set()
+            for group in await self.__get_all(
+                [self.group_collection.document(group_id) for group_id in group_ids],
+                [GROUP_NAME]
+            ):
+                if group.exists and search_query in group.get(GROUP_NAME):
+                    matched.add(group.id)
+            if len(matched) == 0:
+                return []
+            # get_all answers in no particular order, the results follow the user's groups as in FirebaseDatabase
+            snapshots = {
+                group.id: group
+                for group in await self.__get_all([self.group_collection.document(group_id) for group_id in matched])
+            }
+            return [group_from_snapshot(snapshots.pop(group_id)) for group_id in group_ids if group_id in snapshots]
+        except Exception as e:
+            print(e)
+            return []
+
+    async def request_get(self, cookie: Cookie) -> list[str]:
+        try:
+            user_record = await self.__get(self.user_collection.document(cookie.id), [USER_REQUESTS])
+            return user_record.get(USER_REQUESTS)
+        except Exception as e:
+            print(e)
+            return []
@@ -0,0 +1,152 @@
+from asyncio import get_running_loop
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from functools import partial
+from typing import Optional
+
+from database.Interop import DatabaseInterop, Token, OutgoingMessage
+from database.group import Group
+from database.message import Message
+from database.user import PublicUser, PrivateUser
+from database.cookie import Cookie
+
+class AsyncDatabaseInterop:
+    """
+    Awaitable counterpart of DatabaseInterop for ASGI views, the methods take the same arguments and return the same
+    values. Cookie encoding and input validation do no I/O and stay on DatabaseInterop
+    """
+    async def deinit(self): pass
+
+    """User Interaction"""
+    async def user_public_get(self, user_id: str) -> Optional[PublicUser]: pass
+    async def user_public_get_many(self, user_ids: list[str]) -> list[Optional[PublicUser]]: pass
+    async def user_exists(self, user_id: str) -> bool: pass
+    async def user_exists_email(self, email: str) -> bool: pass
+    async def user_authenticate(self, email: str, password: str) -> bool: pass
+    async def user_create(
+            self,
+            email: str,
+            display_name: str,
+            password: str,
+            profile_picture: Optional[str] = None
+    ) -> Optional[Token]: pass
+    async def user_verify(self, cookie: Cookie) -> bool: pass
+    async def user_login(self, email: str, password: str) -> Optional[Token]: pass
+    async def user_change_password(self, user_id: str, new_password: str) -> bool: pass
+
+    async def user_get(self, cookie: Cookie) -> Optional[PrivateUser]: pass
+    """User Edit actions"""
+    async def user_change_username(self, cookie: Cookie, new_user_name: str) -> bool: pass
+    async def user_change_email(self, cookie: Cookie, new_email: str) -> bool: pass
+    async def user_change_profile_picture(self, cookie: Cookie, new_profile_picture: str) -> bool: pass
+
+    """User group interactions"""
+    async def user_groups_get(self, cookie: Cookie, search_query: str) -> list[Group]: pass
+    async def user_interacted_groups_get(self, cookie: Cookie, search_query: str) -> list[Group]: pass
+    async def user_join_group(self, cookie: Cookie, group_id: str) -> bool: pass
+    async def user_leave_group(self, cookie: Cookie, group_id: str, wipe_messages: bool) -> bool: pass
+    async def user_pin_group(self, cookie: Cookie, group_id: str) -> bool: pass
+    async def user_unpin_group(self, cookie: Cookie, group_id: str) -> bool: pass
+    async def user_admin_promote_group(self, cookie: Cookie, group_id: str) -> bool: pass
+    async def user_admin_demote_group(self, cookie: Cookie, group_id: str) -> bool: pass
+    async def user_wipe_all_messages(self, cookie: Cookie) -> bool: pass
+    async def user_wipe_all_group_messages(self, cookie: Cookie, group_id: str) -> bool: pass
+    async def user_wipe_all_left_group_messages(self, cookie: Cookie) -> bool: pass
+
+    """User message interaction"""
+    async def user_has_group_access(self, uid: str, group_id: str) -> str: pass
+    async def message_send(
+            self,
+            cookie: Cookie,
+            group_id: str,
+            content: str,
+            is_reply: bool,
+            reply_to_user: Optional[str],
+            reply_to_content: Optional[str]
+    ) -> bool: pass
+    async def message_send_many(self, cookie: Cookie, group_id: str, messages: list[OutgoingMessage]) -> bool: pass
+    async def message_get(
+            self,
+            cookie: Cookie,
+            group_id: str,
+            pagination_last_message_key: Optional[str] = None,
+            amount: int = 1,
+            after: bool = False
+    ) -> list[Message]: pass
+    async def message_get_with_id(self, cookie: Cookie, group_id: str, message_id: str) -> Optional[Message]: pass
+    async def message_edit(self, cookie: Cookie, group_id: str, message_id: str, new_content: str) -> bool: pass
+    async def message_delete(self, cookie: Cookie, group_id: str, message_id: str) -> bool: pass
+    async def message_get_by_author(self, cookie: Cookie, group_id: str, author_id: str) -> list[Message]: pass
+    async def message_search(
+            self,
+            cookie: Cookie,
+            search_query: str,
+            page: int = 0,
+            amount: int = 20
+    ) -> list[tuple[str, Message]]: pass
+
+    """Group Interaction"""
+    async def group_private_create(self, name: str, creator_id: str) -> Optional[Group]: pass
+    async def group_contact_create(
+            self,
+            user1_id: str,
+            user1_name: str,
+            user2_id: str,
+            user2_name: str
+    ) -> Optional[Group]: pass
+    async def group_delete(self, cookie: Cookie, group_id: str) -> bool: pass
+    async def group_get(self, cookie: Cookie, group_id: str) -> Optional[Group]: pass
+    async def group_get_many(self, cookie: Cookie, group_ids: list[str]) -> list[Optional[Group]]: pass
+    async def group_search(self, cookie: Cookie, search_query: str) -> list[Group]: pass
+    async def group_rename(self, cookie: Cookie, group_id: str, new_group_name: str) -> bool: pass
+
+    """User request Interaction"""
+    async def request_send(self, cookie: Cookie, to_id: str) -> bool: pass
+    async def request_get(self, cookie: Cookie) -> list[str]: pass
+    async def request_exists(self, cookie: Cookie, to_id: str) -> bool: pass
+    async def request_cancel(self, cookie: Cookie, to_id: str) -> bool: pass
+
+
+class ExecutorDatabase(AsyncDatabaseInterop):
+    """
+    Any DatabaseInterop made awaitable by running its blocking calls on a pool of worker threads, so the event loop
+    keeps serving other requests meanwhile. Password hashing goes through the database's own *_async functions
+    """
+    database: DatabaseInterop
+
+    def __init__(self, database: DatabaseInterop, workers: int = 32):
+        self.database = database
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="database")
+
+    async def run(self, function, *args, **kwargs):
+        # The view's context goes along, so per request state such as FirebaseDatabase.request_scope is seen
+        context = copy_context()
+        return await get_running_loop().run_in_executor(self.executor, partial(context.run, function, *args, **kwargs))
+
+    async def user_authenticate(self, email: str, password: str) -> bool:
+        return await self.database.user_authenticate_async(email, password)
+
+    async def user_create(
+            self,
+            email: str,
+            display_name: str,
+            password: str,
+            profile_picture: Optional[str] = None
+    ) -> Optional[Token]:
+        return await self.database.user_create_async(email, display_name, password, profile_picture)
+
+    async def user_login(self, email: str, password: str) -> Optional[Token]:
+        return await self.database.user_login_async(email, password)
+
+def __offload(name: str):
+    async def method(self: ExecutorDatabase, *args, **kwargs):
+        return await self.run(getattr(self.database, name), *args, **kwargs)
+    method.__name__ = name
+    method.__qualname__ = f"ExecutorDatabase.{name}"
+    return method
+
+# Every other method only has to move the matching DatabaseInterop call off the event loop
+for name in list(vars(AsyncDatabaseInterop)):
+    if not name.startswith("_") and name not in vars(ExecutorDatabase):
+        setattr(ExecutorDatabase, name, __offload(name))
+del name
@@ -0,0 +1,248 @@
+from threading import Lock
+from typing import Any, Callable, Hashable, Optional
+
+from cachetools import TTLCache
+
+from database.Interop import DatabaseInterop, OutgoingMessage
+from database.cookie import Cookie
+from database.group import Group
+from database.metrics import labelled, StatKey
+from database.user import PublicUser
+
+MISSING = object()
+
+class EntityCache:
+    """
+    Least recently used cache of one kind of entity whose entries also expire after ttl seconds.
+    A value read from the database is only stored if nothing in this cache was invalidated while it was being read,
+    otherwise a read racing a write could put the value from before the write back
+    """
+    hits: int
+    misses: int
+    version: int
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.entries = TTLCache(max_entries, ttl)
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.version = 0
+
+    def get(self, key: Hashable) -> Any:
+        with self.lock:
+            value = self.entries.get(key, MISSING)
+            if value is MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value, version: int):
+        with self.lock:
+            if version == self.version:
+                self.entries[key] = value
+
+    def read_through(self, key: Hashable, load: Callable[[], Any]) -> Any:
+        value = self.get(key)
+        if value is not MISSING:
+            return value
+        version = self.version
+        value = load()
+        # Missing entities are not remembered, they may be created under the same key any moment
+        if value is not None:
+            self.put(key, value, version)
+        return value
+
+    def invalidate(self, key: Hashable):
+        with self.lock:
+            self.version += 1
+            self.entries.pop(key, None)
+
+    def invalidate_where(self, matches: Callable[[Hashable], bool]):
+        with self.lock:
+            self.version += 1
+            for key in [key for key in self.entries.keys() if matches(key)]:
+                self.entries.pop(key, None)
+
+class CachedDatabase(DatabaseInterop):
+    """
+    Wraps any DatabaseInterop with bounded caches of group access, groups and public user profiles.
+    A successful mutation through this wrapper invalidates every entry it can change before returning, so a caller
+    always reads back its own writes. Writes made by other processes are only seen once the entry expires after ttl
+    """
+    database: DatabaseInterop
+
+    def __init__(self, database: DatabaseInterop, max_entries: int = 10_000, ttl: float = 30):
+        self.database = database
+        self.access = EntityCache(max_entries, ttl)
+        self.groups = EntityCache(max_entries, ttl)
+        self.public_users = EntityCache(max_entries, ttl)
+        super().__init__()
+
+    def __getattr__(self, name: str):
+        return getattr(self.database, name)
+
+    def stats(self) -> dict[StatKey, float]:
+        stats = dict(self.database.stats()) if hasattr(self.database, "stats") else {}
+        for name, cache in [("access", self.access), ("groups", self.groups), ("public_users", self.public_users)]:
+            stats[labelled("cache_hits_total", cache=name)] = cache.hits
+            stats[labelled("cache_misses_total", cache=name)] = cache.misses
+            stats[labelled("cache_entries", cache=name)] = len(cache.entries)
+        return stats
+
+    def __invalidate_membership(self, user_id: str, group_id: str):
+        self.access.invalidate((user_id, group_id))
+        self.groups.invalidate(group_id)
+
+    """Cached reads"""
+    def user_has_group_access(self, uid: str, group_id: str) -> str:
+        return self.access.read_through(
+            (uid, group_id),
+            lambda: self.database.user_has_group_access(uid, group_id)
+        )
+
+    def group_get(self, cookie: Cookie, group_id: str) -> Optional[Group]:
+        if self.user_has_group_access(cookie.id, group_id) == "none":
+            return None
+        return self.groups.read_through(group_id, lambda: self.database.group_get(cookie, group_id))
+
+    def group_get_many(self, cookie: Cookie, group_ids: list[str]) -> list[Optional[Group]]:
+        accessible = [
+            group_id
+            for group_id in group_ids
+            if self.user_has_group_access(cookie.id, group_id) != "none"
+        ]
+        found = {}
+        missing = []
+        for group_id in accessible:
+            group = self.groups.get(group_id)
+            if group is MISSING:
+                missing.append(group_id)
+            else:
+                found[group_id] = group
+        if len(missing) != 0:
+            version = self.groups.version
+            for group_id, group in zip(missing, self.database.group_get_many(cookie, missing)):
+                if group is not None:
+                    found[group_id] = group
+                    self.groups.put(group_id, group, version)
+        return [found.get(group_id) for group_id in group_ids]
+
+    def user_public_get(self, user_id: str) -> Optional[PublicUser]:
+        return self.public_users.read_through(user_id, lambda: self.database.user_public_get(user_id))
+
+    def user_public_get_many(self, user_ids: list[str]) -> list[Optional[PublicUser]]:
+        found = {}
+        missing = []
+        for user_id in user_ids:
+            user = self.public_users.get(user_id)
+            if user is MISSING:
+                missing.append(user_id)
+            else:
+                found[user_id] = user
+        if len(missing) != 0:
+            version = self.public_users.version
+            for user_id, user in zip(missing, self.database.user_public_get_many(missing)):
+                if user is not None:
+                    found[user_id] = user
+                    self.public_users.put(user_id, user, version)
+        return [found.get(user_id) for user_id in user_ids]
+
+    """Mutations which change a cached entity"""
+    def user_change_username(self, cookie: Cookie, new_user_name: str) -> bool:
+        changed = self.database.user_change_username(cookie, new_user_name)
+        if changed:
+            self.public_users.invalidate(cookie.id)
+        return changed
+
+    def user_change_profile_picture(self, cookie: Cookie, new_profile_picture: str) -> bool:
+        changed = self.database.user_change_profile_picture(cookie, new_profile_picture)
+        if changed:
+            self.public_users.invalidate(cookie.id)
+        return changed
+
+    def user_join_group(self, cookie: Cookie, group_id: str) -> bool:
+        changed = self.database.user_join_group(cookie, group_id)
+        if changed:
+            self.__invalidate_membership(cookie.id, group_id)
+        return changed
+
+    def user_leave_group(self, cookie: Cookie, group_id: str, wipe_messages: bool) -> bool:
+        changed = self.database.user_leave_group(cookie, group_id, wipe_messages)
+        if changed:
+            self.__invalidate_membership(cookie.id, group_id)
+        return changed
+
+    def user_admin_promote_group(self, cookie: Cookie, group_id: str) -> bool:
+        changed = self.database.user_admin_promote_group(cookie, group_id)
+        if changed:
+            self.__invalidate_membership(cookie.id, group_id)
+        return changed
+
+    def user_admin_demote_group(self, cookie: Cookie, group_id: str) -> bool:
+        changed = self.database.user_admin_demote_group(cookie, group_id)
+        if changed:
+            self.__invalidate_membership(cookie.id, group_id)
+        return changed
+
+    def message_send(
+            self,
+            cookie: Cookie,
+            group_id: str,
+            content: str,
+            is_reply: bool,
+            reply_to_user: Optional[str],
+            reply_to_content: Optional[str]
+    ) -> bool:
+        sent = self.database.message_send(cookie, group_id, content, is_reply, reply_to_user, reply_to_content)
+        # The group carries its last message
+        if sent:
+            self.groups.invalidate(group_id)
+        return sent
+
+    def message_send_many(self, cookie: Cookie, group_id: str, messages: list[OutgoingMessage]) -> bool:
+        sent = self.database.message_send_many(cookie, group_id, messages)
+        if sent:
+            self.groups.invalidate(group_id)
+        return sent
+
+    def message_edit(self, cookie: Cookie, group_id: str, message_id: str, new_content: str) -> bool:
+        edited = self.database.message_edit(cookie, group_id, message_id, new_content)
+        if edited:
+            self.groups.invalidate(group_id)
+        return edited
+
+    def message_delete(self, cookie: Cookie, group_id: str, message_id: str) -> bool:
+        deleted = self.database.message_delete(cookie, group_id, message_id)
+        if deleted:
+            self.groups.invalidate(group_id)
+        return deleted
+
+    def group_delete(self, cookie: Cookie, group_id: str) -> bool:
+        deleted = self.database.group_delete(cookie, group_id)
+        if deleted:
+            self.groups.invalidate(group_id)
+            self.access.invalidate_where(lambda key: key[1] == group_id)
+        return deleted
+
+    def group_rename(self, cookie: Cookie, group_id: str, new_group_name: str) -> bool:
+        renamed = self.database.group_rename(cookie, group_id, new_group_name)
+        if renamed:
+            self.groups.invalidate(group_id)
+        return renamed
+
+def __delegate(name: str) -> Callable:
+    def method(self: CachedDatabase, *args, **kwargs):
+        return getattr(self.database, name)(*args, **kwargs)
+    method.__name__ = name
+    return method
+
+# Everything else goes straight to the wrapped database, the interface's own stubs must not answer in its place
+for name, value in list(vars(DatabaseInterop).items()):
+    if name.startswith("_") or name in vars(CachedDatabase):
+        continue
+    if isinstance(value, staticmethod):
+        setattr(CachedDatabase, name, property(lambda self, name=name: getattr(self.database, name)))
+    elif callable(value):
+        setattr(CachedDatabase, name, __delegate(name))
+del name, value
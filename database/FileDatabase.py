@@ -1,24 +1,36 @@
+import atexit
 import json
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from os import getenv
-from os.path import exists
+from os import getenv, rename
+from os.path import exists, dirname, join, isfile
 from smtplib import SMTP_SSL
 from ssl import create_default_context
+from threading import Lock
+from time import monotonic, perf_counter
 from typing import Optional, TypeVar, Callable
 
+from asgiref.sync import sync_to_async
 from jwt import encode
 
 from .cookie import Cookie
-from scrypt import hash
 from bcrypt import gensalt
 import pickle
 import re
 
-from database.Interop import DatabaseInterop
+from database import storage
+from database.Interop import DatabaseInterop, OutgoingMessage
 from database.user import User, PrivateUser, PublicUser
 from database.group import Group
+from database.checkpointer import Checkpointer
+from database.files import write_atomically
+from database.locks import ReadWriteLock, LockStripes
 from database.message import Message
+from database.message_search import terms
+from database.message_store import MessageStore
+from database.password_hasher import PasswordHasher, HasherBusy
+from database.trigram_index import TrigramIndex
+from database.wal import WriteAheadLog
 
 T = TypeVar("T")
 def find_index(to_iter: list[T], expression: Callable[[T], bool]) -> Optional[int]:
@@ -33,68 +45,416 @@ def create_if_not_exist(name: str, default_data, mode='w'):
     f.write(default_data)
     f.close()
 
+# Write-ahead log records, each one is (kind, key, value) and a value of None means the key was removed
+LOG_USER = "user"
+LOG_AUTH = "auth"
+LOG_GROUP = "group"
+LOG_GROUP_MESSAGES = "group_messages"
+LOG_MESSAGE = "message"
+LOG_WIPE = "wipe"
+# Narrow group and user changes, so their cost does not grow with the size of the group or user they touch
+LOG_LAST_MESSAGE = "last_message"
+LOG_GROUP_NAME = "group_name"
+LOG_MEMBER = "member"
+LOG_USER_GROUP = "user_group"
+
+STORE_USERS = "users"
+STORE_AUTH = "auth"
+STORE_GROUPS = "groups"
+STORE_MESSAGES = "messages"
+
+LOG_STORES = {
+    LOG_USER: STORE_USERS,
+    LOG_AUTH: STORE_AUTH,
+    LOG_GROUP: STORE_GROUPS,
+    LOG_GROUP_MESSAGES: STORE_MESSAGES,
+    LOG_MESSAGE: STORE_MESSAGES,
+    LOG_WIPE: STORE_MESSAGES,
+    LOG_LAST_MESSAGE: STORE_GROUPS,
+    LOG_GROUP_NAME: STORE_GROUPS,
+    LOG_MEMBER: STORE_GROUPS,
+    LOG_USER_GROUP: STORE_USERS,
+}
+
 ID = TypeVar("ID")
 Token = TypeVar("Token")
 class FileDatabase(DatabaseInterop):
     users: dict[str, User]
+    user_ids_by_email: dict[str, str]
     auth: dict[str, tuple[str, str]]
     groups: dict[str, Group]
-    messages: dict[str, dict[str, Message]]
+    # group_id -> {user_id -> "admin" | "member"}, mirrors the admin_ids and member_ids lists of every group
+    group_roles: dict[str, dict[str, str]]
+    group_names: TrigramIndex
+    messages: MessageStore
 
     user_db_location: str
     group_db_location: str
     messages_db_location: str
     auth_db_location: str
 
-    def __init__(self, user_db_location: str, group_db_location: str, messages_db_location: str, auth_db_location: str):
-        create_if_not_exist(user_db_location, pickle.dumps({}), 'wb')
-        create_if_not_exist(group_db_location, pickle.dumps({}), 'wb')
-        create_if_not_exist(messages_db_location, pickle.dumps({}), 'wb')
-        create_if_not_exist(auth_db_location, pickle.dumps({}), 'wb')
-
-        with open(user_db_location, 'rb') as f:
-            self.users = pickle.load(f)
-        with open(group_db_location, 'rb') as f:
-            self.groups = pickle.load(f)
-        with open(messages_db_location, 'rb') as f:
-            self.messages = pickle.load(f)
-        with open(auth_db_location, 'rb') as f:
-            self.auth = pickle.load(f)
+    log: WriteAheadLog
+    checkpoint_bytes: int
+    checkpoint_interval: float
+    last_checkpoint: float
+
+    # Stores mutated since the last checkpoint, the message store tracks its dirty groups itself
+    dirty_stores: set[str]
+    flushes_performed: int
+    flushes_skipped: int
+
+    checkpoints_performed: int
+    last_checkpoint_duration: float
+    last_checkpoint_size: int
+    checkpoint_duration_total: float
+    checkpoint_size_total: int
+
+    # Persists on its own thread when a background interval is given, otherwise deinit persists inline
+    checkpointer: Optional[Checkpointer]
+
+    # Lock order is mutation_lock -> group_locks(group_id) -> metadata_lock, mutations hold mutation_lock shared so
+    # a checkpoint can take it exclusively and capture a consistent snapshot without stopping readers
+    mutation_lock: ReadWriteLock
+    group_locks: LockStripes
+    metadata_lock: ReadWriteLock
+
+    def __init__(
+            self,
+            user_db_location: str,
+            group_db_location: str,
+            messages_db_location: str,
+            auth_db_location: str,
+            log_db_location: Optional[str] = None,
+            checkpoint_bytes: int = 16 * 1024 * 1024,
+            checkpoint_interval: float = 300,
+            max_resident_messages: int = 1_000_000,
+            hasher: Optional[PasswordHasher] = None,
+            background_interval: Optional[float] = None
+    ):
+        create_if_not_exist(user_db_location, storage.dump_users({}), 'wb')
+        create_if_not_exist(group_db_location, storage.dump_groups({}), 'wb')
+        create_if_not_exist(auth_db_location, storage.dump_auth({}), 'wb')
+
+        self.users = storage.load_users(user_db_location)
+        self.groups = storage.load_groups(group_db_location)
+        self.auth = storage.load_auth(auth_db_location)
+        for group in self.groups.values():
+            if not hasattr(group, "last_message_index"):
+                group.last_message_index = 0
+
+        self.mutation_lock = ReadWriteLock()
+        self.group_locks = LockStripes()
+        self.metadata_lock = ReadWriteLock()
+        self.checkpoint_lock = Lock()
+        self.stats_lock = Lock()
+
+        self.messages = MessageStore(messages_db_location, max_resident_messages, self.group_locks)
+        self.__migrate_messages(messages_db_location + ".dat")
 
         self.user_db_location = user_db_location
         self.group_db_location = group_db_location
         self.messages_db_location = messages_db_location
         self.auth_db_location = auth_db_location
+
+        if log_db_location is None:
+            log_db_location = join(dirname(auth_db_location), "journal.log")
+        self.dirty_stores = set()
+        self.flushes_performed = 0
+        self.flushes_skipped = 0
+        self.last_flush_duration = 0
+        self.flush_duration_total = 0
+        self.checkpoints_performed = 0
+        self.last_checkpoint_duration = 0
+        self.last_checkpoint_size = 0
+        self.checkpoint_duration_total = 0
+        self.checkpoint_size_total = 0
+
+        self.log = WriteAheadLog(log_db_location)
+        for record in self.log.replay():
+            self.__apply(record)
+            self.__mark_dirty(record[0], record[1])
+        self.user_ids_by_email = dict((user.email, user.id) for user in self.users.values())
+        self.group_roles = {}
+        self.group_names = TrigramIndex()
+        for group in self.groups.values():
+            self.__index_roles(group)
+            self.group_names.add(group.id, group.name)
+        self.hasher = PasswordHasher() if hasher is None else hasher
+        self.checkpoint_bytes = checkpoint_bytes
+        self.checkpoint_interval = checkpoint_interval
+        self.last_checkpoint = monotonic()
+
+        self.checkpointer = None
+        if background_interval is not None:
+            self.checkpointer = Checkpointer(self.persist, background_interval)
+            self.checkpointer.start()
+            atexit.register(self.checkpointer.stop)
         super().__init__()
 
     def deinit(self):
-        with open(self.user_db_location, 'wb') as f:
-            pickle.dump(self.users, f)
-        with open(self.group_db_location, 'wb') as f:
-            pickle.dump(self.groups, f)
-        with open(self.messages_db_location, 'wb') as f:
-            pickle.dump(self.messages, f)
-        with open(self.auth_db_location, 'wb') as f:
-            pickle.dump(self.auth, f)
+        if self.checkpointer is not None:
+            self.checkpointer.wake()
+        else:
+            self.persist()
+
+    def close(self):
+        if self.checkpointer is not None:
+            self.checkpointer.stop()
+        self.log.close()
+
+    def persist(self):
+        """Makes the log durable and checkpoints once it grew past checkpoint_bytes or checkpoint_interval passed"""
+        start = perf_counter()
+        flushed = self.log.flush()
+        flush_duration = perf_counter() - start
+        if len(self.dirty_stores) != 0 and (
+            self.log.size() >= self.checkpoint_bytes or
+            monotonic() - self.last_checkpoint >= self.checkpoint_interval
+        ):
+            flushed = self.checkpoint(blocking=False) or flushed
+
+        with self.stats_lock:
+            if flushed:
+                self.flushes_performed += 1
+                self.last_flush_duration = flush_duration
+                self.flush_duration_total += flush_duration
+            else:
+                self.flushes_skipped += 1
+
+    def checkpoint(self, blocking: bool = True) -> bool:
+        """Compacts the write-ahead log into the snapshot files, only rewriting the stores which changed"""
+        if not self.checkpoint_lock.acquire(blocking=blocking):
+            return False
+        try:
+            start = perf_counter()
+            snapshots = []
+            with self.mutation_lock.write():
+                stores = set(self.dirty_stores)
+                if STORE_USERS in stores:
+                    snapshots.append((self.user_db_location, storage.dump_users(self.users)))
+                if STORE_GROUPS in stores:
+                    snapshots.append((self.group_db_location, storage.dump_groups(self.groups)))
+                if STORE_AUTH in stores:
+                    snapshots.append((self.auth_db_location, storage.dump_auth(self.auth)))
+                self.dirty_stores.clear()
+                self.log.rotate()
+
+            # Mutations carry on into the new log segment while the snapshot is written. Shards are saved group by
+            # group and may already hold some of those mutations, which is fine as replaying a record is idempotent
+            size = 0
+            try:
+                for location, data in snapshots:
+                    write_atomically(location, data)
+                    size += len(data)
+                size += self.messages.save()
+            except Exception:
+                # The rotated segment is kept, the next checkpoint writes these stores again before discarding it
+                with self.mutation_lock.write():
+                    self.dirty_stores.update(stores)
+                raise
+            self.log.discard_rotated()
+            self.last_checkpoint = monotonic()
+
+            duration = perf_counter() - start
+            with self.stats_lock:
+                self.checkpoints_performed += 1
+                self.last_checkpoint_duration = duration
+                self.last_checkpoint_size = size
+                self.checkpoint_duration_total += duration
+                self.checkpoint_size_total += size
+            return True
+        finally:
+            self.checkpoint_lock.release()
+
+    def stats(self) -> dict[str, float]:
+        with self.stats_lock:
+            return {
+                "flushes_performed": self.flushes_performed,
+                "flushes_skipped": self.flushes_skipped,
+                "last_flush_duration": self.last_flush_duration,
+                "flush_duration_total": self.flush_duration_total,
+                "log_bytes_written": self.log.bytes_written,
+                "checkpoints_performed": self.checkpoints_performed,
+                "last_checkpoint_duration": self.last_checkpoint_duration,
+                "last_checkpoint_size": self.last_checkpoint_size,
+                "checkpoint_duration_total": self.checkpoint_duration_total,
+                "checkpoint_size_total": self.checkpoint_size_total,
+            }
+
+    def __mark_dirty(self, kind: str, key):
+        self.dirty_stores.add(LOG_STORES[kind])
+
+    def __access(self, uid: str, group_id: str) -> str:
+        roles = self.group_roles.get(group_id)
+        if roles is None:
+            return "none"
+        return roles.get(uid, "none")
+
+    def __index_roles(self, group: Group):
+        roles = dict((member_id, "member") for member_id in group.member_ids)
+        roles.update((admin_id, "admin") for admin_id in group.admin_ids)
+        self.group_roles[group.id] = roles
+
+    def __migrate_messages(self, legacy_location: str):
+        """Splits the single messages.dat pickle used before sharding into one shard per group"""
+        if not isfile(legacy_location):
+            return
+        with open(legacy_location, 'rb') as f:
+            legacy_messages = pickle.load(f)
+        for group_id, messages in legacy_messages.items():
+            self.messages.create(group_id, messages)
+        self.messages.save()
+        rename(legacy_location, legacy_location + ".migrated")
+
+    def __log(self, kind: str, key, value):
+        self.log.append((kind, key, value))
+        self.__mark_dirty(kind, key)
+
+    def __log_user(self, user_id: str):
+        self.__log(LOG_USER, user_id, self.users[user_id])
+
+    def __log_group(self, group_id: str):
+        self.__log(LOG_GROUP, group_id, self.groups[group_id])
+
+    def __log_member(self, group_id: str, user_id: str):
+        self.__log(LOG_MEMBER, (group_id, user_id), self.group_roles[group_id].get(user_id))
+
+    def __log_user_group(self, user_id: str, list_name: str, group_id: str):
+        """Records whether group_id is now in one of the user's group id lists, None when it was removed"""
+        present = group_id in getattr(self.users[user_id], list_name)
+        self.__log(LOG_USER_GROUP, (user_id, list_name, group_id), True if present else None)
+
+    def __set_last_message(self, group: Group, message: Message, author_name: str):
+        group.last_message_index = message.index
+        group.last_message_id = message.id
+        group.last_message_content = message.content
+        group.last_message_author_name = author_name
+        self.__log(LOG_LAST_MESSAGE, group.id, (message.index, message.id, message.content, author_name))
+
+    def __apply(self, record: tuple):
+        kind, key, value = record
+        if kind == LOG_USER:
+            self.users[key] = value
+        elif kind == LOG_AUTH:
+            if value is None:
+                self.auth.pop(key, None)
+            else:
+                self.auth[key] = value
+        elif kind == LOG_GROUP:
+            if value is None:
+                self.groups.pop(key, None)
+            else:
+                self.groups[key] = value
+        elif kind == LOG_GROUP_MESSAGES:
+            if value is None:
+                self.messages.delete(key)
+            else:
+                self.messages.create(key, value)
+        elif kind == LOG_MESSAGE:
+            group_id, message_id = key
+            if self.messages.get(group_id) is None:
+                return
+            if value is None:
+                self.messages.remove(group_id, message_id)
+            else:
+                self.messages.put(group_id, value)
+        elif kind == LOG_WIPE:
+            group_id, author_id = key
+            if self.messages.get(group_id) is None:
+                return
+            self.messages.wipe_author(group_id, author_id)
+        elif kind == LOG_LAST_MESSAGE:
+            group = self.groups.get(key)
+            if group is None:
+                return
+            (
+                group.last_message_index,
+                group.last_message_id,
+                group.last_message_content,
+                group.last_message_author_name
+            ) = value
+        elif kind == LOG_GROUP_NAME:
+            group = self.groups.get(key)
+            if group is not None:
+                group.name = value
+        elif kind == LOG_MEMBER:
+            # Applies the member's role as a whole, so replaying it over a snapshot which already has it is harmless
+            group_id, user_id = key
+            group = self.groups.get(group_id)
+            if group is None:
+                return
+            for ids in (group.admin_ids, group.member_ids):
+                if user_id in ids:
+                    ids.remove(user_id)
+            if value == "admin":
+                group.admin_ids.append(user_id)
+            elif value == "member":
+                group.member_ids.append(user_id)
+        elif kind == LOG_USER_GROUP:
+            user_id, list_name, group_id = key
+            user = self.users.get(user_id)
+            if user is None:
+                return
+            group_ids = getattr(user, list_name)
+            if value is None and group_id in group_ids:
+                group_ids.remove(group_id)
+            elif value is not None and group_id not in group_ids:
+                group_ids.append(group_id)
 
     def user_public_get(self, user_id: str) -> Optional[PublicUser]:
-        return PublicUser.from_user(self.users[user_id])
+        with self.metadata_lock.read():
+            return PublicUser.from_user(self.users[user_id])
+
+    def user_public_get_many(self, user_ids: list[str]) -> list[Optional[PublicUser]]:
+        with self.metadata_lock.read():
+            return [
+                PublicUser.from_user(self.users[user_id]) if user_id in self.users else None
+                for user_id in user_ids
+            ]
 
     def user_exists(self, user_id: str) -> bool:
-        return self.users.get(user_id) is not None
+        with self.metadata_lock.read():
+            return self.users.get(user_id) is not None
 
     def user_exists_email(self, email: str) -> bool:
-        for user in self.users.values():
-            if user.email == email:
-                return True
-        return False
+        with self.metadata_lock.read():
+            return email in self.user_ids_by_email
+
+    def __auth_record(self, email: str) -> Optional[tuple[bytes, str]]:
+        with self.metadata_lock.read():
+            return self.auth.get(email)
 
     def user_authenticate(self, email: str, password: str) -> bool:
-        actual_hash, salt = self.auth.get(email)
-        new_hash = hash(password, salt)
-        if new_hash == actual_hash:
-            return True
-        return False
+        record = self.__auth_record(email)
+        if record is None:
+            return False
+        actual_hash, salt = record
+        try:
+            return self.hasher.verify(password, salt, actual_hash).result()
+        except HasherBusy as e:
+            print(e)
+            return False
+
+    async def user_authenticate_async(self, email: str, password: str) -> bool:
+        # The locks block (a checkpoint holds them while it encodes every store), so the sections taking them run on
+        # a worker thread and only the hash is awaited on the event loop
+        record = await sync_to_async(self.__auth_record, thread_sensitive=False)(email)
+        if record is None:
+            return False
+        actual_hash, salt = record
+        return await self.hasher.verify_async(password, salt, actual_hash)
+
+    def __user_insert(self, user: User, password_hash: bytes, salt: bytes) -> Optional[Token]:
+        with self.mutation_lock.read(), self.metadata_lock.write():
+            # Checked under the same lock as the insert, a check made by the caller beforehand can be raced
+            if user.email in self.user_ids_by_email:
+                return None
+            self.users[user.id] = user
+            self.user_ids_by_email[user.email] = user.id
+            self.auth[user.email] = (password_hash, salt.decode())
+            self.__log_user(user.id)
+            self.__log(LOG_AUTH, user.email, self.auth[user.email])
+        return json.dumps(Cookie(user.id, user.email, user.name).to_dict())
 
     def user_create(
             self,
@@ -104,16 +464,32 @@ class FileDatabase(DatabaseInterop):
             profile_picture: Optional[str] = None
     ) -> Optional[Token]:
         user = User(email, display_name, profile_picture)
-        self.users[user.id] = user
         salt = gensalt()
-        self.auth[email] = (hash(password, salt), salt.decode())
-        return json.dumps(Cookie(user.id, email, display_name).to_dict())
+        try:
+            password_hash = self.hasher.hash(password, salt).result()
+        except HasherBusy as e:
+            print(e)
+            return None
+        return self.__user_insert(user, password_hash, salt)
+
+    async def user_create_async(
+            self,
+            email: str,
+            display_name: str,
+            password: str,
+            profile_picture: Optional[str] = None
+    ) -> Optional[Token]:
+        user = User(email, display_name, profile_picture)
+        salt = gensalt()
+        password_hash = await self.hasher.hash_async(password, salt)
+        return await sync_to_async(self.__user_insert, thread_sensitive=False)(user, password_hash, salt)
 
     def encode_cookie(self, cookie: Cookie) -> str:
         return json.dumps(cookie.to_dict())
 
     def user_verify(self, cookie: Cookie) -> bool:
-        user_record = self.users[cookie.id]
+        with self.metadata_lock.read():
+            user_record = self.users[cookie.id]
         if user_record.is_verified_email:
             return True
 
@@ -142,25 +518,39 @@ class FileDatabase(DatabaseInterop):
             server.login(getenv("EMAIL"), getenv("EMAIL_PASS"))
             server.sendmail(getenv("EMAIL"), user_record.email, message.as_string())
 
+    def __login_token(self, email: str) -> Token:
+        with self.metadata_lock.read():
+            user = self.users[self.user_ids_by_email[email]]
+            return json.dumps(Cookie(user.id, email, user.name).to_dict())
+
     def user_login(self, email: str, password: str) -> Optional[Token]:
         if not self.user_authenticate(email, password):
             return None
-        user = None
-        for iter_user in self.users.values():
-            if iter_user.email == email:
-                user = iter_user
-        return json.dumps(Cookie(user.id, email, user.name).to_dict())
+        return self.__login_token(email)
 
-    def user_change_password(self, user_id: str, new_password: str) -> bool:
-        if self.users.get(user_id) is None:
-            return False
+    async def user_login_async(self, email: str, password: str) -> Optional[Token]:
+        if not await self.user_authenticate_async(email, password):
+            return None
+        return await sync_to_async(self.__login_token, thread_sensitive=False)(email)
 
+    def user_change_password(self, user_id: str, new_password: str) -> bool:
         salt = gensalt()
-        self.auth[self.users[user_id].email] = (
-            hash(new_password, salt),
-            salt.decode()
-        )
-        return True
+        try:
+            password_hash = self.hasher.hash(new_password, salt).result()
+        except HasherBusy as e:
+            print(e)
+            return False
+        with self.mutation_lock.read(), self.metadata_lock.write():
+            if self.users.get(user_id) is None:
+                return False
+
+            email = self.users[user_id].email
+            self.auth[email] = (
+                password_hash,
+                salt.decode()
+            )
+            self.__log(LOG_AUTH, email, self.auth[email])
+            return True
 
 
     @staticmethod
@@ -188,134 +578,174 @@ class FileDatabase(DatabaseInterop):
         return "Invalid url"
 
     def user_get(self, cookie: Cookie) -> Optional[PrivateUser]:
-        return PrivateUser.from_user(self.users[cookie.id])
+        with self.metadata_lock.read():
+            return PrivateUser.from_user(self.users[cookie.id])
 
     def user_change_username(self, cookie: Cookie, new_user_name: str) -> bool:
-        if self.users.get(cookie.id) is None:
-            return False
+        with self.mutation_lock.read(), self.metadata_lock.write():
+            if self.users.get(cookie.id) is None:
+                return False
 
-        self.users[cookie.id].name = new_user_name
-        return True
+            self.users[cookie.id].name = new_user_name
+            self.__log_user(cookie.id)
+            return True
 
     def user_change_email(self, cookie: Cookie, new_email: str) -> bool:
-        if self.users.get(cookie.id) is None:
-            return False
-
-        old_email = self.users[cookie.id].email
-        self.auth[new_email] = self.auth[old_email]
-        del self.auth[old_email]
-
-        self.users[cookie.id].email = new_email
-        self.users[cookie.id].is_verified_email = False
-        return True
+        with self.mutation_lock.read(), self.metadata_lock.write():
+            if self.users.get(cookie.id) is None:
+                return False
+
+            if new_email in self.user_ids_by_email:
+                return False
+
+            old_email = self.users[cookie.id].email
+            self.auth[new_email] = self.auth[old_email]
+            del self.auth[old_email]
+
+            self.users[cookie.id].email = new_email
+            self.users[cookie.id].is_verified_email = False
+            del self.user_ids_by_email[old_email]
+            self.user_ids_by_email[new_email] = cookie.id
+            self.__log(LOG_AUTH, old_email, None)
+            self.__log(LOG_AUTH, new_email, self.auth[new_email])
+            self.__log_user(cookie.id)
+            return True
 
     def user_change_profile_picture(self, cookie: Cookie, new_profile_picture: str) -> bool:
-        if self.users.get(cookie.id) is None:
-            return False
+        with self.mutation_lock.read(), self.metadata_lock.write():
+            if self.users.get(cookie.id) is None:
+                return False
 
-        self.users[cookie.id].profile_picture = new_profile_picture
+            self.users[cookie.id].profile_picture = new_profile_picture
+            self.__log_user(cookie.id)
+            return True
 
     def user_groups_get(self, cookie: Cookie, search_query: str) -> list[Group]:
-        return list(map(
-            lambda group_id: self.groups[group_id],
-            self.users[cookie.id].group_ids
-        ))
+        with self.metadata_lock.read():
+            return list(map(
+                lambda group_id: self.groups[group_id],
+                self.users[cookie.id].group_ids
+            ))
 
     def user_interacted_groups_get(self, cookie: Cookie, search_query: str) -> list[Group]:
-        return list(map(
-            lambda group_id: self.groups[group_id],
-            self.users[cookie.id].interacted_group_ids
-        ))
+        with self.metadata_lock.read():
+            return list(map(
+                lambda group_id: self.groups[group_id],
+                self.users[cookie.id].interacted_group_ids
+            ))
 
     def user_join_group(self, cookie: Cookie, group_id: str) -> bool:
-        if self.users.get(cookie.id) is None:
-            return False
-        if self.groups.get(group_id) is None:
-            return False
-
-        self.users[cookie.id].group_ids.append(group_id)
-        self.groups[group_id].member_ids.append(cookie.id)
-        return True
+        with self.mutation_lock.read(), self.metadata_lock.write():
+            if self.users.get(cookie.id) is None:
+                return False
+            if self.groups.get(group_id) is None:
+                return False
+            if cookie.id in self.group_roles[group_id]:
+                return False
+
+            self.users[cookie.id].group_ids.append(group_id)
+            self.groups[group_id].member_ids.append(cookie.id)
+            self.group_roles[group_id][cookie.id] = "member"
+            self.__log_user_group(cookie.id, "group_ids", group_id)
+            self.__log_member(group_id, cookie.id)
+            return True
 
     def user_leave_group(self, cookie: Cookie, group_id: str, wipe_messages: bool) -> bool:
-        if self.user_has_group_access(cookie.id, group_id) == "none":
-            return False
+        with self.mutation_lock.read(), self.metadata_lock.write():
+            access = self.__access(cookie.id, group_id)
+            if access == "none":
+                return False
+
+            self.users[cookie.id].group_ids.remove(group_id)
+            if access == "admin":
+                self.groups[group_id].admin_ids.remove(cookie.id)
+            else:
+                self.groups[group_id].member_ids.remove(cookie.id)
+            del self.group_roles[group_id][cookie.id]
+            self.__log_user_group(cookie.id, "group_ids", group_id)
+            self.__log_member(group_id, cookie.id)
 
-        self.users[cookie.id].group_ids.remove(group_id)
-        try:
-            self.groups[group_id].admin_ids.remove(cookie.id)
-        except ValueError:
-            self.groups[group_id].member_ids.remove(cookie.id)
-
-        return True
+            return True
 
     def user_pin_group(self, cookie: Cookie, group_id: str) -> bool:
-        if self.user_has_group_access(cookie.id, group_id) == "none":
-            return False
-        self.users[cookie.id].pinned_group_ids.append(group_id)
-        return True
+        with self.mutation_lock.read(), self.metadata_lock.write():
+            if self.__access(cookie.id, group_id) == "none":
+                return False
+            # Pinning twice keeps a single pin, like the SQLite backend
+            if group_id in self.users[cookie.id].pinned_group_ids:
+                return True
+            self.users[cookie.id].pinned_group_ids.append(group_id)
+            self.__log_user_group(cookie.id, "pinned_group_ids", group_id)
+            return True
 
     def user_unpin_group(self, cookie: Cookie, group_id: str) -> bool:
-        if self.user_has_group_access(cookie.id, group_id) == "none":
-            return False
-
-        self.users[cookie.id].pinned_group_ids.remove(group_id)
-        return True
+        with self.mutation_lock.read(), self.metadata_lock.write():
+            if self.__access(cookie.id, group_id) == "none":
+                return False
+            if group_id not in self.users[cookie.id].pinned_group_ids:
+                return False
+
+            self.users[cookie.id].pinned_group_ids.remove(group_id)
+            self.__log_user_group(cookie.id, "pinned_group_ids", group_id)
+            return True
 
     def user_admin_promote_group(self, cookie: Cookie, group_id: str) -> bool:
-        if self.user_has_group_access(cookie.id, group_id) == "none":
-            return False
+        with self.mutation_lock.read(), self.metadata_lock.write():
+            if self.__access(cookie.id, group_id) != "member":
+                return False
 
-        self.groups[group_id].admin_ids.append(cookie.id)
-        self.groups[group_id].member_ids.remove(cookie.id)
+            self.groups[group_id].admin_ids.append(cookie.id)
+            self.groups[group_id].member_ids.remove(cookie.id)
+            self.group_roles[group_id][cookie.id] = "admin"
+            self.__log_member(group_id, cookie.id)
+            return True
 
     def user_admin_demote_group(self, cookie: Cookie, group_id: str) -> bool:
-        if self.user_has_group_access(cookie.id, group_id) == "none":
-            return False
+        with self.mutation_lock.read(), self.metadata_lock.write():
+            if self.__access(cookie.id, group_id) != "admin":
+                return False
 
-        self.groups[group_id].admin_ids.remove(cookie.id)
-        self.groups[group_id].member_ids.append(cookie.id)
+            self.groups[group_id].admin_ids.remove(cookie.id)
+            self.groups[group_id].member_ids.append(cookie.id)
+            self.group_roles[group_id][cookie.id] = "member"
+            self.__log_member(group_id, cookie.id)
+            return True
 
     def user_wipe_all_messages(self, cookie: Cookie) -> bool:
-        if self.users.get(cookie.id) is None:
-            return False
-        for group_id in self.users[cookie.id].group_ids:
+        with self.metadata_lock.read():
+            if self.users.get(cookie.id) is None:
+                return False
+            group_ids = list(self.users[cookie.id].group_ids)
+        for group_id in group_ids:
             self.user_wipe_all_group_messages(cookie, group_id)
         return True
 
     def user_wipe_all_group_messages(self, cookie: Cookie, group_id: str) -> bool:
-        if self.messages.get(group_id) is None:
-            return False
+        with self.mutation_lock.read(), self.group_locks(group_id):
+            if self.messages.get(group_id) is None:
+                return False
 
-        self.messages[group_id] = dict(
-            (_, message)
-            for _, message in self.messages[group_id].items()
-            if message.author_id != cookie.id
-        )
-        return True
+            if self.messages.wipe_author(group_id, cookie.id) != 0:
+                self.__log(LOG_WIPE, (group_id, cookie.id), None)
+            return True
 
     def user_wipe_all_left_group_messages(self, cookie: Cookie) -> bool:
-        if self.users.get(cookie.id) is None:
-            return False
-        user = self.users[cookie.id]
-        for interacted_group_id in user.interacted_group_ids:
-            if interacted_group_id in user.group_ids:
-                continue
-            self.user_wipe_all_group_messages(cookie, interacted_group_id)
+        with self.metadata_lock.read():
+            if self.users.get(cookie.id) is None:
+                return False
+            user = self.users[cookie.id]
+            left_group_ids = [
+                interacted_group_id
+                for interacted_group_id in user.interacted_group_ids
+                if interacted_group_id not in user.group_ids
+            ]
+        for left_group_id in left_group_ids:
+            self.user_wipe_all_group_messages(cookie, left_group_id)
         return True
 
     def user_has_group_access(self, uid: str, group_id: str) -> str:
-        if self.groups.get(group_id) is None:
-            return "none"
-        if self.users.get(uid):
-            return "none"
-        group = self.groups[group_id]
-
-        if uid in group.admin_ids:
-            return "admin"
-        if uid in group.member_ids:
-            return "member"
-        return "none"
+        with self.metadata_lock.read():
+            return self.__access(uid, group_id)
 
     def message_send(
             self,
@@ -326,171 +756,310 @@ class FileDatabase(DatabaseInterop):
             reply_to_user: Optional[str],
             reply_to_content: Optional[str]
     ) -> bool:
-        if self.user_has_group_access(cookie.id, group_id) == "none":
-            return False
-        message = Message.generate(
-            cookie.id,
-            cookie.name,
-            content,
-            self.user_has_group_access(cookie.id, group_id) == "admin",
-            is_reply,
-            reply_to_user,
-            reply_to_content
-        )
-        self.messages[group_id][message.id] = message
-        self.groups[group_id].last_message_id = message.id
-        self.groups[group_id].last_message_content = message.content
-        self.groups[group_id].last_message_author_name = cookie.name
-        return True
+        with self.mutation_lock.read(), self.group_locks(group_id):
+            with self.metadata_lock.read():
+                access = self.__access(cookie.id, group_id)
+                if access == "none":
+                    return False
+                last_message_index = self.groups[group_id].last_message_index
+            message = Message.generate(
+                cookie.id,
+                cookie.name,
+                content,
+                access == "admin",
+                is_reply,
+                reply_to_user,
+                reply_to_content,
+                max(last_message_index, self.messages.index(group_id).last_index()) + 1
+            )
+            self.messages.put(group_id, message)
+            self.__log(LOG_MESSAGE, (group_id, message.id), message)
+
+            with self.metadata_lock.write():
+                self.__set_last_message(self.groups[group_id], message, cookie.name)
+            return True
+
+    def message_send_many(self, cookie: Cookie, group_id: str, messages: list[OutgoingMessage]) -> bool:
+        with self.mutation_lock.read(), self.group_locks(group_id):
+            with self.metadata_lock.read():
+                access = self.__access(cookie.id, group_id)
+                if access == "none":
+                    return False
+                last_message_index = self.groups[group_id].last_message_index
+            if len(messages) == 0:
+                return True
+            index = max(last_message_index, self.messages.index(group_id).last_index())
+            for content, is_reply, reply_to_user, reply_to_content in messages:
+                index += 1
+                message = Message.generate(
+                    cookie.id,
+                    cookie.name,
+                    content,
+                    access == "admin",
+                    is_reply,
+                    reply_to_user,
+                    reply_to_content,
+                    index
+                )
+                self.messages.put(group_id, message)
+                self.__log(LOG_MESSAGE, (group_id, message.id), message)
+
+            # The group only records the last message, so it is written once for the whole batch
+            with self.metadata_lock.write():
+                self.__set_last_message(self.groups[group_id], message, cookie.name)
+            return True
 
     def message_get(
             self,
             cookie: Cookie,
             group_id: str,
             pagination_last_message_key: Optional[str] = None,
-            amount: int = 1
+            amount: int = 1,
+            after: bool = False
     ) -> list[Message]:
-        if self.user_has_group_access(cookie.id, group_id) != "admin":
-            return []
-        if self.messages.get(group_id) is None:
-            return []
-
-        messages = list(self.messages[group_id].values())
-        pagination_index = None
-        for i, message in enumerate(messages):
-            if pagination_last_message_key == message.id:
-                pagination_index = i
-                break
-        if pagination_index is None:
-            return []
-
-        return messages[max(0, pagination_index - amount): pagination_index]
+        with self.group_locks(group_id):
+            if self.user_has_group_access(cookie.id, group_id) == "none":
+                return []
+            if self.messages.get(group_id) is None:
+                return []
+            messages = self.messages[group_id]
+
+            cursor = None
+            if pagination_last_message_key is not None:
+                if messages.get(pagination_last_message_key) is None:
+                    return []
+                cursor = messages[pagination_last_message_key].index
+
+            index = self.messages.index(group_id)
+            message_ids = index.after(cursor, amount) if after else index.before(cursor, amount)
+            return [messages[message_id] for message_id in message_ids]
 
     def message_get_with_id(self, cookie: Cookie, group_id: str, message_id: str) -> Optional[Message]:
-        if self.user_has_group_access(cookie.id, group_id) == "none":
-            return None
-        if self.messages[group_id].get(message_id) is None:
-            return None
+        with self.group_locks(group_id):
+            if self.user_has_group_access(cookie.id, group_id) == "none":
+                return None
+            if self.messages[group_id].get(message_id) is None:
+                return None
 
-        return self.messages[group_id][message_id]
+            return self.messages[group_id][message_id]
 
     def message_edit(self, cookie: Cookie, group_id: str, message_id: str, new_content: str) -> bool:
-        if self.user_has_group_access(cookie.id, group_id) == "none":
-            return False
-        if self.messages.get(group_id) is None:
-            return False
-        if self.messages[group_id].get(message_id) is None:
-            return False
-
-        message = self.messages[group_id][message_id]
-        if message.author_id != cookie.id:
-            return False
-
-        self.messages[group_id][message_id].content = new_content
-        return True
+        with self.mutation_lock.read(), self.group_locks(group_id):
+            if self.user_has_group_access(cookie.id, group_id) == "none":
+                return False
+            if self.messages.get(group_id) is None:
+                return False
+            if self.messages[group_id].get(message_id) is None:
+                return False
+
+            message = self.messages[group_id][message_id]
+            if message.author_id != cookie.id:
+                return False
+
+            message.content = new_content
+            self.messages.put(group_id, message)
+            self.__log(LOG_MESSAGE, (group_id, message_id), message)
+            return True
 
     def message_delete(self, cookie: Cookie, group_id: str, message_id: str) -> bool:
-        if self.user_has_group_access(cookie.id, group_id) == "none":
-            return False
-        if self.messages.get(group_id) is None:
-            return False
-        if self.messages[group_id].get(message_id) is None:
-            return False
+        with self.mutation_lock.read(), self.group_locks(group_id):
+            access = self.user_has_group_access(cookie.id, group_id)
+            if access == "none":
+                return False
+            if self.messages.get(group_id) is None:
+                return False
+            if self.messages[group_id].get(message_id) is None:
+                return False
+
+            message = self.messages[group_id][message_id]
+            if message.author_id != cookie.id and access != "admin":
+                return False
+
+            self.messages.remove(group_id, message_id)
+            self.__log(LOG_MESSAGE, (group_id, message_id), None)
+            return True
 
-        message = self.messages[group_id][message_id]
-        if message.author_id != cookie.id and self.user_has_group_access(cookie.id, group_id) != "admin":
-            return False
+    def message_get_by_author(self, cookie: Cookie, group_id: str, author_id: str) -> list[Message]:
+        with self.group_locks(group_id):
+            if self.user_has_group_access(cookie.id, group_id) == "none":
+                return []
+            if self.messages.get(group_id) is None:
+                return []
+            return self.messages.by_author(group_id, author_id)
 
-        del self.messages[group_id][message_id]
-        return True
+    def message_search(
+            self,
+            cookie: Cookie,
+            search_query: str,
+            page: int = 0,
+            amount: int = 20
+    ) -> list[tuple[str, Message]]:
+        query_terms = terms(search_query)
+        if len(query_terms) == 0:
+            return []
+        with self.metadata_lock.read():
+            if self.users.get(cookie.id) is None:
+                return []
+            group_ids = list(self.users[cookie.id].group_ids)
+
+        # Ranked on the search indexes alone, only the messages of the requested page are read afterwards
+        results = []
+        for group_id in group_ids:
+            with self.group_locks(group_id):
+                results.extend(
+                    (score, index, group_id, message_id)
+                    for score, index, message_id in self.messages.search(group_id, query_terms)
+                )
+        # Equally relevant messages come newest first
+        results.sort(key=lambda result: (-result[0], -result[1]))
+        results = results[page * amount:(page + 1) * amount]
+
+        page_ids: dict[str, set[str]] = {}
+        for _, _, group_id, message_id in results:
+            page_ids.setdefault(group_id, set()).add(message_id)
+        messages = {}
+        for group_id, message_ids in page_ids.items():
+            with self.group_locks(group_id):
+                messages[group_id] = self.messages.messages_with_ids(group_id, message_ids)
+        return [
+            (group_id, messages[group_id][message_id])
+            for _, _, group_id, message_id in results
+            if message_id in messages[group_id]
+        ]
 
     def group_private_create(self, name: str, creator_id: str) -> Optional[Group]:
-        if self.users.get(creator_id) is None:
-            return None
         group = Group.private(name, [creator_id])
-        self.groups[group.id] = group
-        self.messages[group.id] = {}
-
-        self.users[creator_id].group_ids.append(group.id)
-        self.users[creator_id].interacted_group_ids.append(group.id)
-        return group
+        with self.mutation_lock.read(), self.group_locks(group.id), self.metadata_lock.write():
+            if self.users.get(creator_id) is None:
+                return None
+            self.groups[group.id] = group
+            self.__index_roles(group)
+            self.group_names.add(group.id, group.name)
+            self.messages.create(group.id)
+
+            self.users[creator_id].group_ids.append(group.id)
+            self.users[creator_id].interacted_group_ids.append(group.id)
+            self.__log_group(group.id)
+            self.__log(LOG_GROUP_MESSAGES, group.id, {})
+            self.__log_user(creator_id)
+            return group
 
     def group_contact_create(self, user1_id: str, user1_name: str, user2_id: str, user2_name: str) -> Optional[Group]:
-        if self.users.get(user1_id) is None or self.users.get(user2_id) is None:
-            return None
         group = Group.private(f"{user1_name} & {user2_name}", [user1_id, user2_id])
-        self.groups[group.id] = group
-        self.messages[group.id] = {}
-
-        self.users[user1_id].group_ids.append(group.id)
-        self.users[user1_id].interacted_group_ids.append(group.id)
-        self.users[user2_id].group_ids.append(group.id)
-        self.users[user2_id].interacted_group_ids.append(group.id)
-        return group
+        with self.mutation_lock.read(), self.group_locks(group.id), self.metadata_lock.write():
+            if self.users.get(user1_id) is None or self.users.get(user2_id) is None:
+                return None
+            self.groups[group.id] = group
+            self.__index_roles(group)
+            self.group_names.add(group.id, group.name)
+            self.messages.create(group.id)
+
+            self.users[user1_id].group_ids.append(group.id)
+            self.users[user1_id].interacted_group_ids.append(group.id)
+            self.users[user2_id].group_ids.append(group.id)
+            self.users[user2_id].interacted_group_ids.append(group.id)
+            self.__log_group(group.id)
+            self.__log(LOG_GROUP_MESSAGES, group.id, {})
+            self.__log_user(user1_id)
+            self.__log_user(user2_id)
+            return group
 
     def group_delete(self, cookie: Cookie, group_id: str) -> bool:
-        if self.user_has_group_access(cookie.id, group_id) != "admin":
-            return False
-        if self.groups.get(group_id) is None or self.messages.get(group_id) is None:
-            return False
-        del self.messages[group_id]
-        group = self.groups[group_id]
-
-        for member_id in group.member_ids:
-            self.users[member_id].group_ids.remove(group.id)
-            self.users[member_id].interacted_group_ids.remove(group.id)
-        for admin_id in group.admin_ids:
-            self.users[admin_id].group_ids.remove(group.id)
-            self.users[admin_id].interacted_group_ids.remove(group.id)
-
-        del self.groups[group_id]
-        return True
+        with self.mutation_lock.read(), self.group_locks(group_id), self.metadata_lock.write():
+            if self.__access(cookie.id, group_id) != "admin":
+                return False
+            if self.groups.get(group_id) is None or self.messages.get(group_id) is None:
+                return False
+            self.messages.delete(group_id)
+
+            for user_id in self.group_roles.pop(group_id):
+                user = self.users[user_id]
+                user.group_ids.remove(group_id)
+                self.__log_user_group(user_id, "group_ids", group_id)
+                if group_id in user.interacted_group_ids:
+                    user.interacted_group_ids.remove(group_id)
+                    self.__log_user_group(user_id, "interacted_group_ids", group_id)
+
+            del self.groups[group_id]
+            self.group_names.remove(group_id)
+            self.__log(LOG_GROUP_MESSAGES, group_id, None)
+            self.__log(LOG_GROUP, group_id, None)
+            return True
 
     def group_get(self, cookie: Cookie, group_id: str) -> Optional[Group]:
-        if self.user_has_group_access(cookie.id, group_id) == "none":
-            return None
-        if self.groups.get(group_id) is None:
-            return None
-        return self.groups[group_id]
+        with self.metadata_lock.read():
+            if self.__access(cookie.id, group_id) == "none":
+                return None
+            if self.groups.get(group_id) is None:
+                return None
+            return self.groups[group_id]
+
+    def group_get_many(self, cookie: Cookie, group_ids: list[str]) -> list[Optional[Group]]:
+        with self.metadata_lock.read():
+            return [
+                self.groups.get(group_id) if self.__access(cookie.id, group_id) != "none" else None
+                for group_id in group_ids
+            ]
 
     def group_search(self, cookie: Cookie, search_query: str) -> list[Group]:
-        if self.users.get(cookie.id) is None:
-            return []
-        groups = list(filter(
-            lambda group: search_query in group.name,
-            map(
-            lambda group_id: self.groups[group_id],
-            self.users[cookie.id].group_ids
-        )))
-        return groups
+        with self.metadata_lock.read():
+            if self.users.get(cookie.id) is None:
+                return []
+            group_ids = self.users[cookie.id].group_ids
+            # Verify whichever side is smaller, the user's groups or the groups sharing the query's rarest trigram
+            candidates = self.group_names.rarest(search_query)
+            if candidates is None or len(group_ids) <= len(candidates):
+                return [self.groups[group_id] for group_id in group_ids if search_query in self.groups[group_id].name]
+
+            matches = set(
+                group_id
+                for group_id in candidates
+                if cookie.id in self.group_roles[group_id] and search_query in self.groups[group_id].name
+            )
+            if len(matches) > 1:
+                # Keep the order of the user's groups like the scan above
+                return [self.groups[group_id] for group_id in group_ids if group_id in matches]
+            return [self.groups[group_id] for group_id in matches]
 
     def group_rename(self, cookie: Cookie, group_id: str, new_group_name: str) -> bool:
-        if self.user_has_group_access(cookie.id, group_id) != "admin":
-            return False
-        self.groups[group_id].name = new_group_name
+        with self.mutation_lock.read(), self.metadata_lock.write():
+            if self.__access(cookie.id, group_id) != "admin":
+                return False
+            self.groups[group_id].name = new_group_name
+            self.group_names.add(group_id, new_group_name)
+            self.__log(LOG_GROUP_NAME, group_id, new_group_name)
+            return True
 
     def request_send(self, cookie: Cookie, to_id: str) -> bool:
-        if self.users.get(to_id) is None:
-            return False
-        if self.users.get(cookie.id) is None:
-            return False
-
-        self.users[to_id].requests.append(cookie.id)
+        with self.mutation_lock.read(), self.metadata_lock.write():
+            if self.users.get(to_id) is None:
+                return False
+            if self.users.get(cookie.id) is None:
+                return False
+
+            self.users[to_id].requests.append(cookie.id)
+            self.__log_user(to_id)
+            return True
 
     def request_get(self, cookie: Cookie) -> list[str]:
-        return self.users[cookie.id].requests
+        with self.metadata_lock.read():
+            return list(self.users[cookie.id].requests)
 
     def request_exists(self, cookie: Cookie, to_id: str) -> bool:
-        if self.users.get(to_id) is None:
-            return False
-        if self.users.get(cookie.id) is None:
-            return False
-        return cookie.id in self.users[to_id].requests
+        with self.metadata_lock.read():
+            if self.users.get(to_id) is None:
+                return False
+            if self.users.get(cookie.id) is None:
+                return False
+            return cookie.id in self.users[to_id].requests
 
     def request_cancel(self, cookie: Cookie, to_id: str) -> bool:
-        if self.users.get(to_id) is None:
-            return False
-        if self.users.get(cookie.id) is None:
-            return False
-
-        self.users[to_id].requests.remove(cookie.id)
+        with self.mutation_lock.read(), self.metadata_lock.write():
+            if self.users.get(to_id) is None:
+                return False
+            if self.users.get(cookie.id) is None:
+                return False
+
+            self.users[to_id].requests.remove(cookie.id)
+            self.__log_user(to_id)
+            return True
@@ -1,3 +1,6 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
 from json import dumps
 from os import getenv
 from urllib.parse import urljoin
@@ -5,10 +8,12 @@ from urllib.parse import urljoin
 import requests
 
 from database.FileDatabase import DatabaseInterop
+from database.Interop import OutgoingMessage
+from database.metrics import StatKey
 from uuid import uuid4
-from typing import Optional, Any, TypeVar
+from typing import Optional, Any, TypeVar, Callable
 from datetime import timedelta
-from firebase_config import config, message_path, USER_COLLECTION, GROUP_COLLECTION, config_app
+from firebase_config import certificate, message_path, message_counter_path, USER_COLLECTION, GROUP_COLLECTION, config_app
 
 from firebase_admin import auth, db, initialize_app, App
 from firebase_admin._user_mgt import ExportedUserRecord
@@ -22,7 +27,8 @@ from jwt import encode
 from ssl import create_default_context
 from smtplib import SMTP_SSL
 
-from database.message import Message, MESSAGE_AUTHOR_ID
+from database.resilience import Resilience, ResilientFirestore, ResilientReference
+from database.message import Message, MESSAGE_AUTHOR_ID, MESSAGE_INDEX
 from database.cookie import Cookie
 from database.user import PublicUser, PrivateUser, \
     USER_GROUP_IDS, \
@@ -77,7 +83,57 @@ def derive_key(password: str, salt: str):
     return key
 
 
+def group_from_snapshot(group: DocumentSnapshot) -> Group:
+    return Group(
+        group.get(GROUP_ID),
+        group.get(GROUP_NAME),
+        group.get(GROUP_ADMIN_IDS),
+        group.get(GROUP_MEMBER_IDS),
+        group.get(GROUP_LAST_MESSAGE_ID),
+        group.get(GROUP_LAST_MESSAGE_CONTENT),
+        group.get(GROUP_LAST_MESSAGE_AUTHOR_NAME),
+    )
+
+def group_access(uid: str, group: DocumentSnapshot) -> str:
+    """The role of uid in an already fetched group document"""
+    if not group.exists:
+        return "none"
+    if uid in group.get(GROUP_MEMBER_IDS):
+        return "member"
+    if uid in group.get(GROUP_ADMIN_IDS):
+        return "admin"
+    return "none"
+
+# Roles read during the current request, keyed by (uid, group_id). None outside of request_scope
+request_access: ContextVar[Optional[dict[tuple[str, str], str]]] = ContextVar("request_access", default=None)
+
+@contextmanager
+def request_scope():
+    """Access checks made within reuse the roles already read instead of fetching the group again"""
+    token = request_access.set({})
+    try:
+        yield
+    finally:
+        request_access.reset(token)
+
+def remember_access(uid: str, group_id: str, access: str):
+    roles = request_access.get()
+    if roles is not None:
+        roles[(uid, group_id)] = access
+
+def forget_access(group_id: str, uid: Optional[str] = None):
+    """Drops remembered roles a mutation changed, every member's if uid is None"""
+    roles = request_access.get()
+    if roles is None:
+        return
+    for key in [key for key in roles if key[1] == group_id and (uid is None or key[0] == uid)]:
+        del roles[key]
+
+# Paths removed by one multi-path update, keeps each request well below the Realtime Database's size limits
+WIPE_BATCH_SIZE = 500
+
 ID = TypeVar("ID")
+T = TypeVar("T")
 Token = TypeVar("Token")
 class FirebaseDatabase(DatabaseInterop):
     firebase: App
@@ -85,13 +141,35 @@ class FirebaseDatabase(DatabaseInterop):
     user_collection: CollectionReference
     group_collection: CollectionReference
 
-    def __init__(self):
-        self.firebase = initialize_app(config)
-        self.firestore = client()
+    def __init__(
+            self,
+            firestore: Optional[Client] = None,
+            reference: Optional[Callable[[str], db.Reference]] = None,
+            workers: int = 8,
+            wipe_workers: int = 4,
+            resilience: Optional[Resilience] = None
+    ):
+        """
+        firestore and reference stand in for the Firebase clients, the app is initialized unless both are given.
+        Every Firestore and Realtime Database call goes through resilience, which bounds, retries and counts them
+        """
+        if firestore is None or reference is None:
+            self.firebase = initialize_app(certificate())
+        self.resilience = resilience or Resilience()
+        self.firestore = ResilientFirestore(firestore or client(), self.resilience)
+        source = reference or db.reference
+        self.reference = lambda path: ResilientReference(source(path), self.resilience, path)
+        # Reads a method needs regardless of each other's result are issued side by side on these threads
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="firebase")
+        # Wipes spanning many groups take turns on their own threads rather than crowd out every other request
+        self.wipe_executor = ThreadPoolExecutor(wipe_workers, thread_name_prefix="firebase-wipe")
         self.user_collection = self.firestore.collection(USER_COLLECTION)
         self.group_collection = self.firestore.collection(GROUP_COLLECTION)
         super().__init__()
 
+    def stats(self) -> dict[StatKey, float]:
+        return self.resilience.stats()
+
     # Done
     def user_public_get(self, user_id: str) -> Optional[PublicUser]:
         try:
@@ -101,6 +179,18 @@ class FirebaseDatabase(DatabaseInterop):
             return None
         return PublicUser(user_data.display_name, user_data.photo_url)
 
+    def user_public_get_many(self, user_ids: list[str]) -> list[Optional[PublicUser]]:
+        users = {}
+        try:
+            # get_users looks up at most 100 users per call
+            for start in range(0, len(user_ids), 100):
+                result = auth.get_users([auth.UidIdentifier(user_id) for user_id in user_ids[start:start + 100]])
+                for user_data in result.users:
+                    users[user_data.uid] = PublicUser(user_data.display_name, user_data.photo_url)
+        except Exception as e:
+            print(e)
+        return [users.get(user_id) for user_id in user_ids]
+
     # Done
     def user_exists(self, user_id: str) -> bool:
         try:
@@ -259,18 +349,6 @@ class FirebaseDatabase(DatabaseInterop):
             user_record.photo_url
         )
 
-    @staticmethod
-    def __group_get(group: DocumentSnapshot) -> Group:
-        return Group(
-            group.get(GROUP_ID),
-            group.get(GROUP_NAME),
-            group.get(GROUP_ADMIN_IDS),
-            group.get(GROUP_MEMBER_IDS),
-            group.get(GROUP_LAST_MESSAGE_ID),
-            group.get(GROUP_LAST_MESSAGE_CONTENT),
-            group.get(GROUP_LAST_MESSAGE_AUTHOR_NAME),
-        )
-
     # Done
     def user_change_password(self, email: str, new_password: str) -> bool:
         try:
@@ -351,7 +429,7 @@ class FirebaseDatabase(DatabaseInterop):
             .stream()
         output_groups = []
         for group in groups:
-            output_groups.append(self.__group_get(group))
+            output_groups.append(group_from_snapshot(group))
         return output_groups
 
     # Done
@@ -363,12 +441,12 @@ class FirebaseDatabase(DatabaseInterop):
             .stream()
         output_groups = []
         for group in groups:
-            output_groups.append(self.__group_get(group))
+            output_groups.append(group_from_snapshot(group))
         return output_groups
 
     # Done
     def user_join_group(self, cookie: Cookie, group_id: str) -> bool:
-        access = self.__user_has_group_access(cookie.id, group_id)
+        access = self.user_has_group_access(cookie.id, group_id)
         if access != "none":
             return False
         try:
@@ -378,6 +456,7 @@ class FirebaseDatabase(DatabaseInterop):
             self.group_collection.document(group_id).update({
                 GROUP_MEMBER_IDS: ArrayUnion([cookie.id])
             })
+            remember_access(cookie.id, group_id, "member")
             return True
         except Exception as e:
             print(e)
@@ -396,6 +475,7 @@ class FirebaseDatabase(DatabaseInterop):
             self.group_collection.document(group_id).update({
                 GROUP_MEMBER_IDS: ArrayRemove([cookie.id])
             })
+            forget_access(group_id, cookie.id)
             return True
         except Exception as e:
             print(e)
@@ -433,15 +513,16 @@ class FirebaseDatabase(DatabaseInterop):
 
     # Done
     def user_admin_promote_group(self, cookie: Cookie, group_id: str) -> bool:
-        access = self.__user_has_group_access(cookie.id, group_id)
+        access = self.user_has_group_access(cookie.id, group_id)
         if access == "none":
             return False
 
         try:
-            self.group_collection.document(cookie.id).update({
+            self.group_collection.document(group_id).update({
                 GROUP_ADMIN_IDS: ArrayUnion([cookie.id]),
                 GROUP_MEMBER_IDS: ArrayRemove([cookie.id])
             })
+            remember_access(cookie.id, group_id, "admin")
             return True
         except Exception as e:
             print(e)
@@ -450,32 +531,44 @@ class FirebaseDatabase(DatabaseInterop):
 
     # Done
     def user_admin_demote_group(self, cookie: Cookie, group_id: str) -> bool:
-        access = self.__user_has_group_access(cookie.id, group_id)
+        access = self.user_has_group_access(cookie.id, group_id)
         if access == "none":
             return False
 
         try:
-            self.group_collection.document(cookie.id).update({
+            self.group_collection.document(group_id).update({
                 GROUP_ADMIN_IDS: ArrayRemove([cookie.id]),
                 GROUP_MEMBER_IDS: ArrayUnion([cookie.id])
             })
+            remember_access(cookie.id, group_id, "member")
             return True
         except Exception as e:
             print(e)
             return False
 
-    @staticmethod
-    def __delete_all_group_messages_for_user(user_id: str, group_id) -> bool:
+    def __delete_all_group_messages_for_user(self, user_id: str, group_id) -> bool:
+        messages_ref = self.reference(message_path(group_id))
         try:
-            messages_snapshot = db.reference(message_path(group_id)).get()
-            for message_id, message_data in messages_snapshot.items():
-                if message_data.get(MESSAGE_AUTHOR_ID) == user_id:
-                    db.reference(message_path(group_id) + f"/{message_id}").delete()
+            # Only the author's messages are downloaded, needs the same index as message_get_by_author
+            messages_snapshot = messages_ref.order_by_child(MESSAGE_AUTHOR_ID).equal_to(user_id).get()
+            message_ids = list(messages_snapshot or {})
+            for start in range(0, len(message_ids), WIPE_BATCH_SIZE):
+                messages_ref.update({
+                    message_id: None
+                    for message_id in message_ids[start:start + WIPE_BATCH_SIZE]
+                })
             return True
         except Exception as e:
             print(e)
             return False
 
+    def __delete_all_messages_for_user(self, user_id: str, group_ids: list[str]) -> bool:
+        results = self.wipe_executor.map(
+            lambda group_id: self.__delete_all_group_messages_for_user(user_id, group_id),
+            group_ids
+        )
+        return all(list(results))
+
     # Done
     def user_wipe_all_messages(self, cookie: Cookie) -> bool:
         try:
@@ -485,8 +578,9 @@ class FirebaseDatabase(DatabaseInterop):
         except Exception as e:
             print(e)
             return False
-        for interacted_group_id in interacted_group_ids:
-            self.__delete_all_group_messages_for_user(cookie.id, interacted_group_id)
+        # The interacted groups are kept as they are if any of them still holds messages of the user
+        if not self.__delete_all_messages_for_user(cookie.id, interacted_group_ids):
+            return False
         try:
             self.user_collection.document(cookie.id).update({
                 USER_INTERACTED_GROUP_IDS: group_ids
@@ -498,7 +592,7 @@ class FirebaseDatabase(DatabaseInterop):
 
     # Done
     def user_wipe_all_group_messages(self, cookie: Cookie, group_id: str) -> bool:
-        access = self.__user_has_group_access(cookie.id, group_id)
+        access = self.user_has_group_access(cookie.id, group_id)
         if access == "none":
             return False
 
@@ -527,29 +621,40 @@ class FirebaseDatabase(DatabaseInterop):
             return False
         interacted_group_ids = user_data.get(USER_INTERACTED_GROUP_IDS)
         group_ids = user_data.get(USER_GROUP_IDS)
-        for interacted_group_id in interacted_group_ids:
-            if interacted_group_id in group_ids:
-                continue
-            self.__delete_all_group_messages_for_user(cookie.id, interacted_group_id)
-        return True
+        return self.__delete_all_messages_for_user(cookie.id, [
+            interacted_group_id
+            for interacted_group_id in interacted_group_ids
+            if interacted_group_id not in group_ids
+        ])
 
     # Done
     def user_has_group_access(self, uid: str, group_id: str) -> str:
-        group_reference = self.group_collection.document(group_id)
+        roles = request_access.get()
+        if roles is not None and (uid, group_id) in roles:
+            return roles[(uid, group_id)]
         try:
-            members_list = group_reference.get(GROUP_MEMBER_IDS)
+            # Both role lists in one read, nothing else of the group is downloaded. Never answered stale, a removed
+            # member would otherwise keep their role for as long as Firestore is unreachable
+            group = self.group_collection.document(group_id).get([GROUP_MEMBER_IDS, GROUP_ADMIN_IDS], stale=False)
         except Exception as e:
             print(e)
             return "none"
-        if uid in members_list:
-            return "member"
-        try:
-            admin_list = group_reference.get(GROUP_ADMIN_IDS)
-        except:
-            return "none"
-        if uid in admin_list:
-            return "admin"
-        return "none"
+        access = group_access(uid, group)
+        remember_access(uid, group_id, access)
+        return access
+
+    def __access_and_read(self, uid: str, group_id: str, read: Callable[[], T]) -> tuple[str, T]:
+        """The role of uid in the group together with read(), which is fetched while the role is, read may raise"""
+        roles = request_access.get()
+        if roles is not None and (uid, group_id) in roles:
+            return roles[(uid, group_id)], read()
+        pending = self.executor.submit(read)
+        return self.user_has_group_access(uid, group_id), pending.result()
+
+    def __reserve_indexes(self, group_id: str, count: int) -> int:
+        """Claims the next count message indexes of the group and returns the last of them"""
+        # Concurrent senders retry the transaction until their increment applies, so no index is handed out twice
+        return self.reference(message_counter_path(group_id)).transaction(lambda current: (current or 0) + count)
 
     # Done
     def message_send(
@@ -561,9 +666,15 @@ class FirebaseDatabase(DatabaseInterop):
             reply_to_user: Optional[str],
             reply_to_content: Optional[str]
     ) -> bool:
+        # Access comes first, outsiders must not be able to advance the group's counter
         access = self.user_has_group_access(cookie.id, group_id)
         if access == "none":
             return False
+        try:
+            index = self.__reserve_indexes(group_id, 1)
+        except Exception as e:
+            print(e)
+            return False
         message = Message.generate(
             cookie.id,
             cookie.name,
@@ -571,29 +682,80 @@ class FirebaseDatabase(DatabaseInterop):
             access == "admin",
             is_reply,
             reply_to_user,
-            reply_to_content
+            reply_to_content,
+            index
         )
         try:
-            db.reference(message_path(group_id) + f"/{message.id}").set(message.to_obj())
+            self.reference(message_path(group_id) + f"/{message.id}").set(message.to_obj())
             return True
         except Exception as e:
             print(e)
             return False
 
-    # Done
-    def message_get(self, cookie: Cookie, group_id: str, pagination_last_message_key: Optional[str] = None, amount: int = 1) -> list[Message]:
+    def message_send_many(self, cookie: Cookie, group_id: str, messages: list[OutgoingMessage]) -> bool:
         access = self.user_has_group_access(cookie.id, group_id)
         if access == "none":
-            return []
-        ref = db.reference(message_path(group_id))
-        query = ref.order_by_child('index').limit_to_first(amount)
-        query.start_at(pagination_last_message_key)
+            return False
+        if len(messages) == 0:
+            return True
+        try:
+            last_index = self.__reserve_indexes(group_id, len(messages))
+        except Exception as e:
+            print(e)
+            return False
+        batch = {}
+        first_index = last_index - len(messages) + 1
+        for offset, (content, is_reply, reply_to_user, reply_to_content) in enumerate(messages):
+            message = Message.generate(
+                cookie.id,
+                cookie.name,
+                content,
+                access == "admin",
+                is_reply,
+                reply_to_user,
+                reply_to_content,
+                first_index + offset
+            )
+            batch[message.id] = message.to_obj()
         try:
-            snapshot = query.get()
+            # A multi-path update writes the whole batch atomically in a single round trip
+            self.reference(message_path(group_id)).update(batch)
+            return True
+        except Exception as e:
+            print(e)
+            return False
+
+    # Done
+    def message_get(
+            self,
+            cookie: Cookie,
+            group_id: str,
+            pagination_last_message_key: Optional[str] = None,
+            amount: int = 1,
+            after: bool = False
+    ) -> list[Message]:
+        def page() -> Optional[dict]:
+            # Needs ".indexOn": ["index"] on messages/$group_id in the database rules
+            query = self.reference(message_path(group_id)).order_by_child(MESSAGE_INDEX)
+            if pagination_last_message_key is None:
+                query = query.limit_to_first(amount) if after else query.limit_to_last(amount)
+                return query.get()
+            cursor = self.reference(
+                message_path(group_id) + f"/{pagination_last_message_key}/{MESSAGE_INDEX}"
+            ).get()
+            if cursor is None:
+                return None
+            # Indexes are whole numbers, so the cursor itself is excluded by stepping past it
+            if after:
+                return query.start_at(cursor + 1).limit_to_first(amount).get()
+            return query.end_at(cursor - 1).limit_to_last(amount).get()
+
+        try:
+            access, snapshot = self.__access_and_read(cookie.id, group_id, page)
         except Exception as e:
             print(e)
             return []
-        if snapshot is None:
+        if access == "none" or snapshot is None:
             return []
 
         output_messages = []
@@ -605,25 +767,29 @@ class FirebaseDatabase(DatabaseInterop):
         return output_messages
 
     def message_get_with_id(self, cookie: Cookie, group_id: str, message_id: str) -> Optional[Message]:
-        access = self.user_has_group_access(cookie.id, group_id)
-        if access == "none":
+        try:
+            access, message = self.__access_and_read(
+                cookie.id,
+                group_id,
+                self.reference(message_path(group_id) + f"/{message_id}").get
+            )
+        except Exception as e:
+            print(e)
+            return None
+        if access == "none" or message is None:
             return None
-        message = db.reference(message_path(group_id) + f"/{message_id}").get()
         return Message.from_snapshot(message_id, message)
 
     # Done
     def message_edit(self, cookie: Cookie, group_id: str, message_id: str, new_content: str) -> bool:
-        access = self.user_has_group_access(cookie.id, group_id)
-        if access == "none":
-            return False
-
+        message_ref = self.reference(message_path(group_id) + f"/{message_id}")
         try:
-            old_message_data = db.reference(message_path(group_id) + f"/{message_id}").get()
+            access, old_message_data = self.__access_and_read(cookie.id, group_id, message_ref.get)
         except Exception as e:
             print(e)
             return False
 
-        if old_message_data is None:
+        if access == "none" or old_message_data is None:
             return False
         message = Message.from_snapshot(message_id, old_message_data)
 
@@ -633,7 +799,7 @@ class FirebaseDatabase(DatabaseInterop):
         message.content = new_content
 
         try:
-            db.reference(message_path(group_id) + f"/{message_id}").set(message.to_obj())
+            message_ref.set(message.to_obj())
         except Exception as e:
             print(e)
             return False
@@ -641,15 +807,14 @@ class FirebaseDatabase(DatabaseInterop):
 
     # Done
     def message_delete(self, cookie: Cookie, group_id: str, message_id: str) -> bool:
-        access = self.user_has_group_access(cookie.id, group_id)
-        if access == "none":
-            return False
-        message_ref = db.reference(message_path(group_id) + f"/{message_id}")
+        message_ref = self.reference(message_path(group_id) + f"/{message_id}")
         try:
-            message_data = message_ref.get()
+            access, message_data = self.__access_and_read(cookie.id, group_id, message_ref.get)
         except Exception as e:
             print(e)
             return False
+        if access == "none" or message_data is None:
+            return False
 
         message = Message.from_snapshot(message_id, message_data)
         if message is None:
@@ -667,6 +832,35 @@ class FirebaseDatabase(DatabaseInterop):
         return True
 
 
+    def message_get_by_author(self, cookie: Cookie, group_id: str, author_id: str) -> list[Message]:
+        # Needs ".indexOn": ["author_id"] on messages/$group_id in the database rules
+        query = self.reference(message_path(group_id)).order_by_child(MESSAGE_AUTHOR_ID).equal_to(author_id)
+        try:
+            access, snapshot = self.__access_and_read(cookie.id, group_id, query.get)
+        except Exception as e:
+            print(e)
+            return []
+        if access == "none" or snapshot is None:
+            return []
+
+        output_messages = []
+        for message_id, message_body in snapshot.items():
+            message = Message.from_snapshot(message_id, message_body)
+            if message is None:
+                continue
+            output_messages.append(message)
+        return sorted(output_messages, key=lambda message: message.index)
+
+    def message_search(
+            self,
+            cookie: Cookie,
+            search_query: str,
+            page: int = 0,
+            amount: int = 20
+    ) -> list[tuple[str, Message]]:
+        # The Realtime Database has no full text queries, searching would mean downloading every message
+        return []
+
     def __group_create(self, group: Group) -> Optional[Group]:
         try:
             self.group_collection.document(group.id).set(group.to_obj())
@@ -693,27 +887,62 @@ class FirebaseDatabase(DatabaseInterop):
             self.group_collection.document(group_id).delete()
         except:
             return False
+        forget_access(group_id)
         return True
 
     # Done
     def group_get(self, cookie: Cookie, group_id: str) -> Optional[Group]:
-        if self.user_has_group_access(cookie.id, group_id) == "none":
+        # The whole group carries the roles as well, so access is read off it instead of fetched first
+        try:
+            group_record = self.group_collection.document(group_id).get(stale=False)
+        except Exception as e:
+            print(e)
+            return None
+        access = group_access(cookie.id, group_record)
+        remember_access(cookie.id, group_id, access)
+        if access == "none":
             return None
-        group_record = self.group_collection.document(group_id).get()
-        return self.__group_get(group_record)
+        return group_from_snapshot(group_record)
+
+    def group_get_many(self, cookie: Cookie, group_ids: list[str]) -> list[Optional[Group]]:
+        groups = {}
+        try:
+            for group in self.firestore.get_all(
+                [self.group_collection.document(group_id) for group_id in set(group_ids)],
+                stale=False
+            ):
+                # Access is read off the fetched documents rather than with a read of its own per group
+                if group_access(cookie.id, group) == "none":
+                    continue
+                groups[group.id] = group_from_snapshot(group)
+        except Exception as e:
+            print(e)
+        return [groups.get(group_id) for group_id in group_ids]
 
     # Done
     def group_search(self, cookie: Cookie, search_query: str) -> list[Group]:
-        groups = []
+        groups = set()
         try:
             user_record = self.user_collection.document(cookie.id).get()
             group_ids = user_record.get(USER_GROUP_IDS)
-            for group_id in group_ids:
-                group = self.group_collection.document(group_id).get()
-                if search_query in group.get(GROUP_NAME):
-                    groups.append(self.__group_get(group))
-        except:
-            return groups
+            # One batched read for every group instead of a round trip per group
+            for group in self.firestore.get_all(
+                [self.group_collection.document(group_id) for group_id in group_ids],
+                field_paths=[GROUP_NAME]
+            ):
+                if group.exists and search_query in group.get(GROUP_NAME):
+                    groups.add(group.id)
+            if len(groups) == 0:
+                return []
+            # get_all answers in no particular order, the results follow the user's groups like the other backends
+            snapshots = {
+                group.id: group
+                for group in self.firestore.get_all([self.group_collection.document(group_id) for group_id in groups])
+            }
+            return [group_from_snapshot(snapshots.pop(group_id)) for group_id in group_ids if group_id in snapshots]
+        except Exception as e:
+            print(e)
+            return []
 
     # Done
     def group_rename(self, cookie: Cookie, group_id: str, new_group_name: str) -> bool:
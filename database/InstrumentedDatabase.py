@@ -0,0 +1,110 @@
+from functools import wraps
+from random import random
+from threading import Lock
+from time import perf_counter
+
+from database.Interop import DatabaseInterop
+from database.metrics import Histogram, render
+
+class InstrumentedDatabase(DatabaseInterop):
+    """
+    Wraps any DatabaseInterop and records a latency histogram per method for a sample_rate share of the calls.
+    Calls which are not sampled only pay for a random number and their count, calls and errors are counted for
+    every call.
+    Everything else, such as FileDatabase.persist or close, is passed straight to the wrapped database
+    """
+    database: DatabaseInterop
+    sample_rate: float
+    # Every call per method, the histograms only see the sampled ones
+    counts: dict[str, int]
+    calls: dict[str, Histogram]
+    errors: dict[str, int]
+
+    def __init__(self, database: DatabaseInterop, sample_rate: float = 1.0):
+        self.database = database
+        self.sample_rate = sample_rate
+        self.counts = {}
+        self.calls = {}
+        self.errors = {}
+        self.lock = Lock()
+        super().__init__()
+
+    def __getattr__(self, name: str):
+        return getattr(self.database, name)
+
+    def count(self, method: str):
+        with self.lock:
+            self.counts[method] = self.counts.get(method, 0) + 1
+
+    def record(self, method: str, duration: float):
+        with self.lock:
+            histogram = self.calls.get(method)
+            if histogram is None:
+                histogram = self.calls[method] = Histogram()
+            histogram.observe(duration)
+
+    def record_error(self, method: str):
+        with self.lock:
+            self.errors[method] = self.errors.get(method, 0) + 1
+
+    def metrics(self, prefix: str = "shadowtalk_database") -> str:
+        """Everything recorded so far, plus the wrapped database's stats() if it has any, as Prometheus text"""
+        stats = self.database.stats() if hasattr(self.database, "stats") else {}
+        with self.lock:
+            return render(prefix, self.sample_rate, self.counts, self.calls, self.errors, stats)
+
+def __instrument(name: str):
+    function = getattr(DatabaseInterop, name)
+
+    @wraps(function)
+    def method(self: InstrumentedDatabase, *args, **kwargs):
+        target = getattr(self.database, name)
+        self.count(name)
+        if self.sample_rate < 1 and random() >= self.sample_rate:
+            try:
+                return target(*args, **kwargs)
+            except Exception:
+                self.record_error(name)
+                raise
+        start = perf_counter()
+        try:
+            return target(*args, **kwargs)
+        except Exception:
+            self.record_error(name)
+            raise
+        finally:
+            self.record(name, perf_counter() - start)
+
+    @wraps(function)
+    async def async_method(self: InstrumentedDatabase, *args, **kwargs):
+        target = getattr(self.database, name)
+        self.count(name)
+        if self.sample_rate < 1 and random() >= self.sample_rate:
+            try:
+                return await target(*args, **kwargs)
+            except Exception:
+                self.record_error(name)
+                raise
+        start = perf_counter()
+        try:
+            return await target(*args, **kwargs)
+        except Exception:
+            self.record_error(name)
+            raise
+        finally:
+            self.record(name, perf_counter() - start)
+
+    return async_method if name.endswith("_async") else method
+
+def __delegate(name: str) -> property:
+    return property(lambda self: getattr(self.database, name))
+
+for name, value in list(vars(DatabaseInterop).items()):
+    if name.startswith("_"):
+        continue
+    # Input validation is static and does no I/O, it is handed over unmeasured
+    if isinstance(value, staticmethod):
+        setattr(InstrumentedDatabase, name, __delegate(name))
+    elif callable(value):
+        setattr(InstrumentedDatabase, name, __instrument(name))
+del name, value
@@ -1,5 +1,7 @@
 from typing import Optional, Any, TypeVar
 
+from asgiref.sync import sync_to_async
+
 from database.group import Group
 from database.message import Message
 from database.user import PublicUser, PrivateUser
@@ -7,6 +9,8 @@ from database.cookie import Cookie
 
 ID = TypeVar("ID")
 Token = TypeVar("Token")
+# content, is_reply, reply_to_user, reply_to_content, the arguments of message_send after group_id
+OutgoingMessage = tuple[str, bool, Optional[str], Optional[str]]
 class DatabaseInterop:
     def __init__(self): pass
     def deinit(self): pass
@@ -15,6 +19,9 @@ class DatabaseInterop:
     """Functions which don't require authentication"""
     """dont show group information here, ig"""
     def user_public_get(self, user_id: str) -> Optional[PublicUser]: pass
+    """One result per id in the same order, None for users which do not exist"""
+    def user_public_get_many(self, user_ids: list[str]) -> list[Optional[PublicUser]]:
+        return [self.user_public_get(user_id) for user_id in user_ids]
     def user_exists(self, user_id: str) -> bool: pass
     def user_exists_email(self, email: str) -> bool: pass
     def user_authenticate(self, email: str, password: str) -> bool: pass
@@ -30,6 +37,25 @@ class DatabaseInterop:
     def user_login(self, email: str, password: str) -> Optional[Token]: pass
     def user_change_password(self, user_id: str, new_password: str) -> bool: pass
 
+    """Awaitable versions of the functions hashing a password, backends without a native one hash on a worker thread"""
+    async def user_authenticate_async(self, email: str, password: str) -> bool:
+        return await sync_to_async(self.user_authenticate, thread_sensitive=False)(email, password)
+    async def user_create_async(
+            self,
+            email: str,
+            display_name: str,
+            password: str,
+            profile_picture: Optional[str] = None
+    ) -> Optional[Token]:
+        return await sync_to_async(self.user_create, thread_sensitive=False)(
+            email,
+            display_name,
+            password,
+            profile_picture
+        )
+    async def user_login_async(self, email: str, password: str) -> Optional[Token]:
+        return await sync_to_async(self.user_login, thread_sensitive=False)(email, password)
+
     """Input verification (This is in database interop because different databases might have different restrictions"""
     @staticmethod
     def is_valid_email(email: str) -> Optional[str]: pass
@@ -74,16 +100,32 @@ class DatabaseInterop:
             reply_to_user: Optional[str],
             reply_to_content: Optional[str]
     ) -> bool: pass
+    """
+    Sends the messages in order. This fallback stops at the first one which fails and keeps those sent before it,
+    File, SQLite and Firebase override it with a batch which sends all of them or none
+    """
+    def message_send_many(self, cookie: Cookie, group_id: str, messages: list[OutgoingMessage]) -> bool:
+        return all(self.message_send(cookie, group_id, *message) for message in messages)
     def message_get(
             self,
             cookie: Cookie,
             group_id: str,
             pagination_last_message_key: Optional[str] = None,
-            amount: int = 1
+            amount: int = 1,
+            after: bool = False
     ) -> list[Message]: pass
     def message_get_with_id(self, cookie: Cookie, group_id: str, message_id: str) -> Optional[Message]: pass
     def message_edit(self, cookie: Cookie, group_id: str, message_id: str, new_content: str) -> bool: pass
     def message_delete(self, cookie: Cookie, group_id: str, message_id: str) -> bool: pass
+    def message_get_by_author(self, cookie: Cookie, group_id: str, author_id: str) -> list[Message]: pass
+    """(group id, message) pairs of the caller's groups matching every word of search_query, best match first"""
+    def message_search(
+            self,
+            cookie: Cookie,
+            search_query: str,
+            page: int = 0,
+            amount: int = 20
+    ) -> list[tuple[str, Message]]: pass
 
     """Group Interaction"""
     def group_private_create(self, name: str, creator_id: str) -> Optional[Group]: pass
@@ -91,6 +133,9 @@ class DatabaseInterop:
     # def group_public_create(self, name: str, creator_id: str) -> str: pass
     def group_delete(self, cookie: Cookie, group_id: str) -> bool: pass
     def group_get(self, cookie: Cookie, group_id: str) -> Optional[Group]: pass
+    """One result per id in the same order, None for groups which do not exist or the caller can not access"""
+    def group_get_many(self, cookie: Cookie, group_ids: list[str]) -> list[Optional[Group]]:
+        return [self.group_get(cookie, group_id) for group_id in group_ids]
     def group_search(self, cookie: Cookie, search_query: str) -> list[Group]: pass
     def group_rename(self, cookie: Cookie, group_id: str, new_group_name: str) -> bool: pass
 
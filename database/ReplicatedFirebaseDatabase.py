@@ -0,0 +1,348 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from typing import Any, Callable, Optional
+
+from firebase_admin import db
+from google.cloud.firestore import Client, DocumentSnapshot
+
+from database.FirebaseDatabase import FirebaseDatabase, group_access, group_from_snapshot
+from database.cookie import Cookie
+from database.group import Group
+from database.message import Message, MESSAGE_INDEX
+from firebase_config import message_path
+
+MESSAGES_ROOT = message_path("")
+
+def split(path: str) -> list[str]:
+    return [part for part in path.split("/") if part != ""]
+
+def newer(snapshot: DocumentSnapshot, current: Optional[DocumentSnapshot]) -> bool:
+    """Whether snapshot may replace current, snapshots of one document can arrive out of order"""
+    if current is None or not snapshot.exists:
+        return True
+    # Group ids are never reused, a deleted group stays deleted
+    if not current.exists:
+        return False
+    return snapshot.update_time >= current.update_time
+
+
+class GroupReplica:
+    """
+    Mirror of one group, its Firestore document and its newest messages. Only the newest max_messages are kept,
+    every message with an index of at least floor is mirrored unless complete, when all of them are
+    """
+    group_id: str
+    snapshot: Optional[DocumentSnapshot]
+    messages: Optional[dict[str, dict]]
+    complete: bool
+    floor: int
+    last_used: float
+
+    def __init__(self, group_id: str, max_messages: int):
+        self.group_id = group_id
+        self.max_messages = max_messages
+        self.snapshot = None
+        self.messages = None
+        self.complete = True
+        self.floor = 0
+        self.last_used = monotonic()
+        self.registrations = []
+
+    def put(self, path: list[str], value: Any):
+        if self.messages is None:
+            if len(path) != 0:
+                return
+            self.messages = {}
+        if len(path) == 0:
+            self.messages = {}
+            self.complete = True
+            for message_id, message in (value or {}).items():
+                self.messages[message_id] = message
+        elif len(path) == 1:
+            if value is None:
+                self.messages.pop(path[0], None)
+            elif self.complete or value.get(MESSAGE_INDEX, 0) >= self.floor:
+                self.messages[path[0]] = value
+        else:
+            message = self.messages.get(path[0])
+            if message is None:
+                return
+            if len(path) == 2:
+                if value is None:
+                    message.pop(path[1], None)
+                else:
+                    message[path[1]] = value
+        self.trim()
+
+    def trim(self):
+        if len(self.messages) <= self.max_messages:
+            return
+        newest = sorted(self.messages.items(), key=lambda item: item[1].get(MESSAGE_INDEX, 0))[-self.max_messages:]
+        self.messages = dict(newest)
+        self.complete = False
+        self.floor = newest[0][1].get(MESSAGE_INDEX, 0)
+
+    def page(self, cursor_id: Optional[str], amount: int, after: bool) -> Optional[list[Message]]:
+        """The page message_get would return, None if it reaches past what is mirrored"""
+        if self.messages is None:
+            return None
+        ordered = sorted(self.messages.items(), key=lambda item: item[1].get(MESSAGE_INDEX, 0))
+        if cursor_id is None:
+            if after and not self.complete:
+                return None
+            selected = ordered[:amount] if after else ordered[max(0, len(ordered) - amount):]
+        else:
+            cursor = self.messages.get(cursor_id)
+            if cursor is None:
+                return None
+            index = cursor.get(MESSAGE_INDEX, 0)
+            if after:
+                selected = [item for item in ordered if item[1].get(MESSAGE_INDEX, 0) > index][:amount]
+            else:
+                older = [item for item in ordered if item[1].get(MESSAGE_INDEX, 0) < index]
+                if len(older) < amount and not self.complete:
+                    return None
+                selected = older[max(0, len(older) - amount):]
+        messages = [Message.from_snapshot(message_id, message) for message_id, message in selected]
+        return [message for message in messages if message is not None]
+
+
+class WriteThroughReference:
+    """Realtime Database reference whose writes reach the replicas as soon as they succeed, before their events do"""
+    def __init__(self, reference, path: str, database: "ReplicatedFirebaseDatabase"):
+        self.reference = reference
+        self.path = split(path)
+        self.database = database
+
+    def __getattr__(self, name: str):
+        return getattr(self.reference, name)
+
+    def set(self, value: Any):
+        self.reference.set(value)
+        self.database.written(self.path, value)
+
+    def update(self, values: dict):
+        self.reference.update(values)
+        for child, value in values.items():
+            self.database.written(self.path + split(child), value)
+
+    def delete(self):
+        self.reference.delete()
+        self.database.written(self.path, None)
+
+
+class ReplicatedFirebaseDatabase(FirebaseDatabase):
+    """
+    FirebaseDatabase which keeps the groups it is asked about mirrored in memory, fed by a Firestore listener on the
+    group document and a Realtime Database listener on its messages. user_has_group_access, group_get and message_get
+    are answered from the mirror once its first snapshot arrived, and from Firebase before that or for pages older
+    than the mirror holds. Writes made through this instance are applied to the mirror right away, those of other
+    servers once their event arrives.
+    Only groups a member asked about are mirrored, access is read from Firebase before a group is subscribed to.
+    At most max_groups groups are mirrored, the least recently used one is dropped for a new one and groups unused
+    for idle_seconds are unsubscribed. Subscribing downloads the group's whole message history once
+    """
+    def __init__(
+            self,
+            firestore: Optional[Client] = None,
+            reference: Optional[Callable[[str], db.Reference]] = None,
+            max_groups: int = 64,
+            max_messages: int = 500,
+            idle_seconds: float = 300,
+            **kwargs
+    ):
+        self.max_groups = max_groups
+        self.max_messages = max_messages
+        self.idle_seconds = idle_seconds
+        self.replicas: OrderedDict[str, GroupReplica] = OrderedDict()
+        self.replica_lock = Lock()
+        super().__init__(firestore, reference, **kwargs)
+        # Listeners go to the source, every other use of self.reference writes through the mirror
+        self.source = self.reference
+        self.reference = self.__reference
+
+    def __reference(self, path: str) -> WriteThroughReference:
+        return WriteThroughReference(self.source(path), path, self)
+
+    def deinit(self):
+        self.unsubscribe_idle()
+        super().deinit()
+
+    def close(self):
+        with self.replica_lock:
+            replicas = list(self.replicas.values())
+            self.replicas.clear()
+        for replica in replicas:
+            self.__unsubscribe(replica)
+
+    """Listeners"""
+    def written(self, path: list[str], value: Any):
+        if path[:len(split(MESSAGES_ROOT))] != split(MESSAGES_ROOT) or len(path) < 2:
+            return
+        group_id = path[1]
+        with self.replica_lock:
+            replica = self.replicas.get(group_id)
+            if replica is not None:
+                replica.put(path[2:], value)
+
+    def __on_messages(self, replica: GroupReplica, event):
+        path = split(event.path)
+        with self.replica_lock:
+            if event.event_type == "patch":
+                for child, value in (event.data or {}).items():
+                    replica.put(path + split(child), value)
+            else:
+                replica.put(path, event.data)
+
+    def __on_group(self, replica: GroupReplica, snapshots: list[DocumentSnapshot], changes, read_time):
+        with self.replica_lock:
+            for snapshot in snapshots:
+                if newer(snapshot, replica.snapshot):
+                    replica.snapshot = snapshot
+
+    def __unsubscribe(self, replica: GroupReplica):
+        for registration in replica.registrations:
+            try:
+                if hasattr(registration, "unsubscribe"):
+                    registration.unsubscribe()
+                else:
+                    registration.close()
+            except Exception as e:
+                print(e)
+
+    def unsubscribe_idle(self):
+        deadline = monotonic() - self.idle_seconds
+        with self.replica_lock:
+            idle = [replica for replica in self.replicas.values() if replica.last_used < deadline]
+            for replica in idle:
+                del self.replicas[replica.group_id]
+        for replica in idle:
+            self.__unsubscribe(replica)
+
+    def __replica(self, group_id: str) -> GroupReplica:
+        with self.replica_lock:
+            replica = self.replicas.get(group_id)
+            if replica is not None:
+                replica.last_used = monotonic()
+                self.replicas.move_to_end(group_id)
+                return replica
+            replica = self.replicas[group_id] = GroupReplica(group_id, self.max_messages)
+            evicted = []
+            while len(self.replicas) > self.max_groups:
+                evicted.append(self.replicas.popitem(last=False)[1])
+        for old in evicted:
+            self.__unsubscribe(old)
+        self.unsubscribe_idle()
+        try:
+            replica.registrations.append(self.group_collection.document(group_id).on_snapshot(
+                lambda snapshots, changes, read_time: self.__on_group(replica, snapshots, changes, read_time)
+            ))
+            replica.registrations.append(self.source(message_path(group_id)).listen(
+                lambda event: self.__on_messages(replica, event)
+            ))
+        except Exception as e:
+            print(e)
+        with self.replica_lock:
+            evicted = self.replicas.get(group_id) is not replica
+        if evicted:
+            self.__unsubscribe(replica)
+        return replica
+
+    def __refresh_group(self, group_id: str):
+        """Installs the group as it is after a write through this instance, ahead of its snapshot event"""
+        with self.replica_lock:
+            replica = self.replicas.get(group_id)
+        if replica is None:
+            return
+        try:
+            snapshot = self.group_collection.document(group_id).get()
+        except Exception as e:
+            print(e)
+            with self.replica_lock:
+                replica.snapshot = None
+            return
+        with self.replica_lock:
+            if newer(snapshot, replica.snapshot):
+                replica.snapshot = snapshot
+
+    def __member_replica(self, uid: str, group_id: str) -> tuple[str, Optional[GroupReplica]]:
+        """
+        The role of uid in the group, and the group's mirror if uid is a member of it. Outsiders never get a group
+        mirrored nor keep a mirrored one from being dropped
+        """
+        with self.replica_lock:
+            replica = self.replicas.get(group_id)
+            snapshot = None if replica is None else replica.snapshot
+        access = group_access(uid, snapshot) if snapshot is not None else super().user_has_group_access(uid, group_id)
+        if access == "none":
+            return access, None
+        return access, self.__replica(group_id)
+
+    """Served from the mirror"""
+    def user_has_group_access(self, uid: str, group_id: str) -> str:
+        access, _ = self.__member_replica(uid, group_id)
+        return access
+
+    def group_get(self, cookie: Cookie, group_id: str) -> Optional[Group]:
+        access, replica = self.__member_replica(cookie.id, group_id)
+        if access == "none":
+            return None
+        snapshot = replica.snapshot
+        if snapshot is None:
+            return super().group_get(cookie, group_id)
+        return group_from_snapshot(snapshot)
+
+    def message_get(
+            self,
+            cookie: Cookie,
+            group_id: str,
+            pagination_last_message_key: Optional[str] = None,
+            amount: int = 1,
+            after: bool = False
+    ) -> list[Message]:
+        access, replica = self.__member_replica(cookie.id, group_id)
+        if access == "none":
+            return []
+        with self.replica_lock:
+            page = replica.page(pagination_last_message_key, amount, after)
+        if page is None or replica.snapshot is None:
+            return super().message_get(cookie, group_id, pagination_last_message_key, amount, after)
+        return page
+
+    """Group writes, the mirror takes them before their snapshot arrives"""
+    def user_join_group(self, cookie: Cookie, group_id: str) -> bool:
+        changed = super().user_join_group(cookie, group_id)
+        if changed:
+            self.__refresh_group(group_id)
+        return changed
+
+    def user_leave_group(self, cookie: Cookie, group_id: str, wipe_messages: bool) -> bool:
+        changed = super().user_leave_group(cookie, group_id, wipe_messages)
+        if changed:
+            self.__refresh_group(group_id)
+        return changed
+
+    def user_admin_promote_group(self, cookie: Cookie, group_id: str) -> bool:
+        changed = super().user_admin_promote_group(cookie, group_id)
+        if changed:
+            self.__refresh_group(group_id)
+        return changed
+
+    def user_admin_demote_group(self, cookie: Cookie, group_id: str) -> bool:
+        changed = super().user_admin_demote_group(cookie, group_id)
+        if changed:
+            self.__refresh_group(group_id)
+        return changed
+
+    def group_delete(self, cookie: Cookie, group_id: str) -> bool:
+        deleted = super().group_delete(cookie, group_id)
+        if deleted:
+            self.__refresh_group(group_id)
+        return deleted
+
+    def group_rename(self, cookie: Cookie, group_id: str, new_group_name: str) -> bool:
+        renamed = super().group_rename(cookie, group_id, new_group_name)
+        if renamed:
+            self.__refresh_group(group_id)
+        return renamed
@@ -0,0 +1,774 @@
+import json
+import sqlite3
+from contextlib import contextmanager
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from os import getenv
+from smtplib import SMTP_SSL
+from ssl import create_default_context
+from threading import local
+from typing import Optional, TypeVar, Iterator
+
+from jwt import encode
+
+from .cookie import Cookie
+from scrypt import hash
+from bcrypt import gensalt
+
+from database.Interop import DatabaseInterop, OutgoingMessage
+from database.FileDatabase import FileDatabase
+from database.user import User, PrivateUser, PublicUser
+from database.group import Group
+from database.message import Message
+from database.message_search import terms
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    email TEXT NOT NULL UNIQUE,
+    name TEXT NOT NULL,
+    is_verified_email INTEGER NOT NULL DEFAULT 0,
+    profile_picture TEXT
+);
+CREATE TABLE IF NOT EXISTS auth (
+    email TEXT PRIMARY KEY,
+    hash BLOB NOT NULL,
+    salt TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS groups (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    last_message_id TEXT NOT NULL,
+    last_message_content TEXT NOT NULL,
+    last_message_author_name TEXT NOT NULL,
+    last_message_index INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS group_members (
+    group_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    role TEXT NOT NULL,
+    PRIMARY KEY (group_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS group_members_user ON group_members (user_id);
+CREATE TABLE IF NOT EXISTS interacted_groups (
+    user_id TEXT NOT NULL,
+    group_id TEXT NOT NULL,
+    PRIMARY KEY (user_id, group_id)
+);
+CREATE TABLE IF NOT EXISTS pinned_groups (
+    user_id TEXT NOT NULL,
+    group_id TEXT NOT NULL,
+    PRIMARY KEY (user_id, group_id)
+);
+CREATE TABLE IF NOT EXISTS requests (
+    to_id TEXT NOT NULL,
+    from_id TEXT NOT NULL,
+    PRIMARY KEY (to_id, from_id)
+);
+CREATE TABLE IF NOT EXISTS messages (
+    -- An alias of the rowid, which VACUUM then keeps as it is and message_text can refer to
+    row_id INTEGER PRIMARY KEY,
+    group_id TEXT NOT NULL,
+    message_index INTEGER NOT NULL,
+    id TEXT NOT NULL,
+    author_id TEXT NOT NULL,
+    author_name TEXT NOT NULL,
+    content TEXT NOT NULL,
+    is_author_admin INTEGER NOT NULL,
+    is_reply INTEGER NOT NULL,
+    reply_to_user TEXT,
+    reply_to_content TEXT,
+    UNIQUE (group_id, message_index)
+);
+CREATE UNIQUE INDEX IF NOT EXISTS messages_id ON messages (group_id, id);
+CREATE INDEX IF NOT EXISTS messages_author ON messages (group_id, author_id);
+-- Full-text index of the messages' content, which stays in messages alone. Kept in step by the triggers below
+CREATE VIRTUAL TABLE IF NOT EXISTS message_text USING fts5 (content, content='messages', content_rowid='row_id');
+CREATE TRIGGER IF NOT EXISTS message_text_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO message_text (rowid, content) VALUES (new.row_id, new.content);
+END;
+CREATE TRIGGER IF NOT EXISTS message_text_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO message_text (message_text, rowid, content) VALUES ('delete', old.row_id, old.content);
+END;
+CREATE TRIGGER IF NOT EXISTS message_text_update AFTER UPDATE OF content ON messages BEGIN
+    INSERT INTO message_text (message_text, rowid, content) VALUES ('delete', old.row_id, old.content);
+    INSERT INTO message_text (rowid, content) VALUES (new.row_id, new.content);
+END;
+"""
+
+MESSAGE_COLUMNS = """
+id, message_index, author_id, author_name, content, is_author_admin, is_reply, reply_to_user, reply_to_content
+"""
+
+def message_from_row(row: sqlite3.Row) -> Message:
+    return Message(
+        row["id"],
+        row["message_index"],
+        row["author_id"],
+        row["author_name"],
+        row["content"],
+        bool(row["is_author_admin"]),
+        bool(row["is_reply"]),
+        row["reply_to_user"],
+        row["reply_to_content"]
+    )
+
+ID = TypeVar("ID")
+Token = TypeVar("Token")
+class SQLiteDatabase(DatabaseInterop):
+    """
+    DatabaseInterop on a single SQLite file in WAL mode, so any number of threads and worker processes can share it.
+    Every thread gets its own connection, sqlite3 caches the prepared form of each statement per connection
+    """
+    location: str
+
+    def __init__(self, location: str):
+        self.location = location
+        self.local = local()
+        self.__connection().executescript(SCHEMA)
+        super().__init__()
+
+    def deinit(self):
+        pass
+
+    def close(self):
+        """Closes the calling thread's connection, do this before forking"""
+        connection = getattr(self.local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+    def __connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is not None:
+            return connection
+        connection = sqlite3.connect(self.location, timeout=30, isolation_level=None, cached_statements=256)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        self.local.connection = connection
+        return connection
+
+    def __query(self, sql: str, parameters: tuple = ()) -> list[sqlite3.Row]:
+        return self.__connection().execute(sql, parameters).fetchall()
+
+    def __query_one(self, sql: str, parameters: tuple = ()) -> Optional[sqlite3.Row]:
+        return self.__connection().execute(sql, parameters).fetchone()
+
+    def __execute(self, sql: str, parameters: tuple = ()) -> int:
+        return self.__connection().execute(sql, parameters).rowcount
+
+    @contextmanager
+    def __transaction(self) -> Iterator[sqlite3.Connection]:
+        # IMMEDIATE takes the write lock up front, so read-then-write sequences never fail half way with SQLITE_BUSY
+        connection = self.__connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def __groups(self, group_ids: list[str]) -> list[Group]:
+        if len(group_ids) == 0:
+            return []
+        placeholders = ",".join("?" * len(group_ids))
+        groups = dict(
+            (row["id"], Group(
+                row["id"],
+                row["name"],
+                [],
+                [],
+                row["last_message_id"],
+                row["last_message_content"],
+                row["last_message_author_name"],
+                row["last_message_index"]
+            ))
+            for row in self.__query(f"SELECT * FROM groups WHERE id IN ({placeholders})", tuple(group_ids))
+        )
+        for row in self.__query(
+            f"SELECT group_id, user_id, role FROM group_members WHERE group_id IN ({placeholders}) ORDER BY rowid",
+            tuple(group_ids)
+        ):
+            group = groups[row["group_id"]]
+            if row["role"] == "admin":
+                group.admin_ids.append(row["user_id"])
+            else:
+                group.member_ids.append(row["user_id"])
+        return [groups[group_id] for group_id in group_ids if group_id in groups]
+
+    def __member_group_ids(self, user_id: str) -> list[str]:
+        return [
+            row["group_id"]
+            for row in self.__query("SELECT group_id FROM group_members WHERE user_id = ? ORDER BY rowid", (user_id,))
+        ]
+
+    def user_public_get(self, user_id: str) -> Optional[PublicUser]:
+        row = self.__query_one("SELECT name, profile_picture FROM users WHERE id = ?", (user_id,))
+        if row is None:
+            return None
+        return PublicUser(row["name"], row["profile_picture"])
+
+    def user_public_get_many(self, user_ids: list[str]) -> list[Optional[PublicUser]]:
+        if len(user_ids) == 0:
+            return []
+        placeholders = ",".join("?" * len(user_ids))
+        users = dict(
+            (row["id"], PublicUser(row["name"], row["profile_picture"]))
+            for row in self.__query(
+                f"SELECT id, name, profile_picture FROM users WHERE id IN ({placeholders})",
+                tuple(user_ids)
+            )
+        )
+        return [users.get(user_id) for user_id in user_ids]
+
+    def user_exists(self, user_id: str) -> bool:
+        return self.__query_one("SELECT 1 FROM users WHERE id = ?", (user_id,)) is not None
+
+    def user_exists_email(self, email: str) -> bool:
+        return self.__query_one("SELECT 1 FROM users WHERE email = ?", (email,)) is not None
+
+    def user_authenticate(self, email: str, password: str) -> bool:
+        row = self.__query_one("SELECT hash, salt FROM auth WHERE email = ?", (email,))
+        if row is None:
+            return False
+        return hash(password, row["salt"]) == row["hash"]
+
+    def user_create(
+            self,
+            email: str,
+            display_name: str,
+            password: str,
+            profile_picture: Optional[str] = None
+    ) -> Optional[Token]:
+        user = User(email, display_name, profile_picture)
+        salt = gensalt()
+        password_hash = hash(password, salt)
+        try:
+            with self.__transaction() as connection:
+                connection.execute(
+                    "INSERT INTO users (id, email, name, profile_picture) VALUES (?, ?, ?, ?)",
+                    (user.id, email, display_name, profile_picture)
+                )
+                connection.execute(
+                    "INSERT INTO auth (email, hash, salt) VALUES (?, ?, ?)",
+                    (email, password_hash, salt.decode())
+                )
+        except sqlite3.IntegrityError as e:
+            print(e)
+            return None
+        return json.dumps(Cookie(user.id, email, display_name).to_dict())
+
+    def encode_cookie(self, cookie: Cookie) -> str:
+        return json.dumps(cookie.to_dict())
+
+    def user_verify(self, cookie: Cookie) -> bool:
+        user_record = self.__query_one("SELECT id, email, name, is_verified_email FROM users WHERE id = ?", (cookie.id,))
+        if user_record["is_verified_email"]:
+            return True
+
+        message = MIMEMultipart("alternative")
+        message["Subject"] = "ShadowTalk - User Email Verification Code"
+        message["From"] = getenv("EMAIL")
+        message["To"] = user_record["email"]
+        encoded = encode({'_id': user_record["id"]}, getenv("EMAIL_TOKEN"), algorithm="HS256")
+        url = f"{getenv('DOMAIN')}/verify-email?token={encoded}"
+        body = f"""
+        <h1 style="text-align: center;">ShadowTalk User Email Verification</h1>
+        <br>
+        <h3 style="text-align: center;">
+            <div style="font-size: 2rem;">
+                Hello {user_record["name"]}!<br>
+                Please <a href="{url}" target="_blank">Click this link</a> to verify your account<br>
+                <div style="color: 'red';">Do not share this with anyone else</div>
+            </div>
+        </h3>
+        """
+        html = MIMEText(body, "html")
+        message.attach(html)
+
+        context = create_default_context()
+        with SMTP_SSL("smtp.gmail.com", 465, context=context) as server:
+            server.login(getenv("EMAIL"), getenv("EMAIL_PASS"))
+            server.sendmail(getenv("EMAIL"), user_record["email"], message.as_string())
+
+    def user_login(self, email: str, password: str) -> Optional[Token]:
+        if not self.user_authenticate(email, password):
+            return None
+        user = self.__query_one("SELECT id, name FROM users WHERE email = ?", (email,))
+        return json.dumps(Cookie(user["id"], email, user["name"]).to_dict())
+
+    def user_change_password(self, user_id: str, new_password: str) -> bool:
+        salt = gensalt()
+        password_hash = hash(new_password, salt)
+        return self.__execute(
+            "UPDATE auth SET hash = ?, salt = ? WHERE email = (SELECT email FROM users WHERE id = ?)",
+            (password_hash, salt.decode(), user_id)
+        ) == 1
+
+    is_valid_email = staticmethod(FileDatabase.is_valid_email)
+    is_valid_display_name = staticmethod(FileDatabase.is_valid_display_name)
+    is_valid_password = staticmethod(FileDatabase.is_valid_password)
+    is_valid_photo_url = staticmethod(FileDatabase.is_valid_photo_url)
+
+    def user_get(self, cookie: Cookie) -> Optional[PrivateUser]:
+        row = self.__query_one(
+            "SELECT name, email, is_verified_email, profile_picture FROM users WHERE id = ?",
+            (cookie.id,)
+        )
+        if row is None:
+            return None
+        return PrivateUser(row["name"], row["email"], bool(row["is_verified_email"]), row["profile_picture"])
+
+    def user_change_username(self, cookie: Cookie, new_user_name: str) -> bool:
+        return self.__execute("UPDATE users SET name = ? WHERE id = ?", (new_user_name, cookie.id)) == 1
+
+    def user_change_email(self, cookie: Cookie, new_email: str) -> bool:
+        try:
+            with self.__transaction() as connection:
+                user = connection.execute("SELECT email FROM users WHERE id = ?", (cookie.id,)).fetchone()
+                if user is None:
+                    return False
+                connection.execute(
+                    "UPDATE users SET email = ?, is_verified_email = 0 WHERE id = ?",
+                    (new_email, cookie.id)
+                )
+                connection.execute("UPDATE auth SET email = ? WHERE email = ?", (new_email, user["email"]))
+        except sqlite3.IntegrityError as e:
+            print(e)
+            return False
+        return True
+
+    def user_change_profile_picture(self, cookie: Cookie, new_profile_picture: str) -> bool:
+        return self.__execute(
+            "UPDATE users SET profile_picture = ? WHERE id = ?",
+            (new_profile_picture, cookie.id)
+        ) == 1
+
+    def user_groups_get(self, cookie: Cookie, search_query: str) -> list[Group]:
+        return self.__groups(self.__member_group_ids(cookie.id))
+
+    def user_interacted_groups_get(self, cookie: Cookie, search_query: str) -> list[Group]:
+        return self.__groups([
+            row["group_id"]
+            for row in self.__query("SELECT group_id FROM interacted_groups WHERE user_id = ? ORDER BY rowid", (cookie.id,))
+        ])
+
+    def user_join_group(self, cookie: Cookie, group_id: str) -> bool:
+        with self.__transaction() as connection:
+            if connection.execute("SELECT 1 FROM users WHERE id = ?", (cookie.id,)).fetchone() is None:
+                return False
+            if connection.execute("SELECT 1 FROM groups WHERE id = ?", (group_id,)).fetchone() is None:
+                return False
+            return connection.execute(
+                "INSERT OR IGNORE INTO group_members (group_id, user_id, role) VALUES (?, ?, 'member')",
+                (group_id, cookie.id)
+            ).rowcount == 1
+
+    def user_leave_group(self, cookie: Cookie, group_id: str, wipe_messages: bool) -> bool:
+        return self.__execute(
+            "DELETE FROM group_members WHERE group_id = ? AND user_id = ?",
+            (group_id, cookie.id)
+        ) == 1
+
+    def user_pin_group(self, cookie: Cookie, group_id: str) -> bool:
+        with self.__transaction() as connection:
+            if self.user_has_group_access(cookie.id, group_id) == "none":
+                return False
+            connection.execute(
+                "INSERT OR IGNORE INTO pinned_groups (user_id, group_id) VALUES (?, ?)",
+                (cookie.id, group_id)
+            )
+            return True
+
+    def user_unpin_group(self, cookie: Cookie, group_id: str) -> bool:
+        if self.user_has_group_access(cookie.id, group_id) == "none":
+            return False
+        return self.__execute(
+            "DELETE FROM pinned_groups WHERE user_id = ? AND group_id = ?",
+            (cookie.id, group_id)
+        ) == 1
+
+    def user_admin_promote_group(self, cookie: Cookie, group_id: str) -> bool:
+        return self.__execute(
+            "UPDATE group_members SET role = 'admin' WHERE group_id = ? AND user_id = ? AND role = 'member'",
+            (group_id, cookie.id)
+        ) == 1
+
+    def user_admin_demote_group(self, cookie: Cookie, group_id: str) -> bool:
+        return self.__execute(
+            "UPDATE group_members SET role = 'member' WHERE group_id = ? AND user_id = ? AND role = 'admin'",
+            (group_id, cookie.id)
+        ) == 1
+
+    def user_wipe_all_messages(self, cookie: Cookie) -> bool:
+        if not self.user_exists(cookie.id):
+            return False
+        for group_id in self.__member_group_ids(cookie.id):
+            self.user_wipe_all_group_messages(cookie, group_id)
+        return True
+
+    def user_wipe_all_group_messages(self, cookie: Cookie, group_id: str) -> bool:
+        with self.__transaction() as connection:
+            if connection.execute("SELECT 1 FROM groups WHERE id = ?", (group_id,)).fetchone() is None:
+                return False
+            connection.execute("DELETE FROM messages WHERE group_id = ? AND author_id = ?", (group_id, cookie.id))
+            return True
+
+    def user_wipe_all_left_group_messages(self, cookie: Cookie) -> bool:
+        if not self.user_exists(cookie.id):
+            return False
+        for row in self.__query(
+            """
+            SELECT group_id FROM interacted_groups WHERE user_id = ?
+            EXCEPT SELECT group_id FROM group_members WHERE user_id = ?
+            """,
+            (cookie.id, cookie.id)
+        ):
+            self.user_wipe_all_group_messages(cookie, row["group_id"])
+        return True
+
+    def user_has_group_access(self, uid: str, group_id: str) -> str:
+        row = self.__query_one("SELECT role FROM group_members WHERE group_id = ? AND user_id = ?", (group_id, uid))
+        if row is None:
+            return "none"
+        return row["role"]
+
+    def message_send(
+            self,
+            cookie: Cookie,
+            group_id: str,
+            content: str,
+            is_reply: bool,
+            reply_to_user: Optional[str],
+            reply_to_content: Optional[str]
+    ) -> bool:
+        with self.__transaction() as connection:
+            access = self.user_has_group_access(cookie.id, group_id)
+            if access == "none":
+                return False
+            message = Message.generate(
+                cookie.id,
+                cookie.name,
+                content,
+                access == "admin",
+                is_reply,
+                reply_to_user,
+                reply_to_content,
+                connection.execute(
+                    "SELECT last_message_index + 1 FROM groups WHERE id = ?",
+                    (group_id,)
+                ).fetchone()[0]
+            )
+            connection.execute(
+                f"INSERT INTO messages (group_id, {MESSAGE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    group_id,
+                    message.id,
+                    message.index,
+                    message.author_id,
+                    message.author_name,
+                    message.content,
+                    message.is_author_admin,
+                    message.is_reply,
+                    message.reply_to_user,
+                    message.reply_to_content
+                )
+            )
+            connection.execute(
+                """
+                UPDATE groups SET
+                    last_message_index = ?,
+                    last_message_id = ?,
+                    last_message_content = ?,
+                    last_message_author_name = ?
+                WHERE id = ?
+                """,
+                (message.index, message.id, message.content, cookie.name, group_id)
+            )
+            return True
+
+    def message_send_many(self, cookie: Cookie, group_id: str, messages: list[OutgoingMessage]) -> bool:
+        with self.__transaction() as connection:
+            access = self.user_has_group_access(cookie.id, group_id)
+            if access == "none":
+                return False
+            if len(messages) == 0:
+                return True
+            first_index = connection.execute(
+                "SELECT last_message_index + 1 FROM groups WHERE id = ?",
+                (group_id,)
+            ).fetchone()[0]
+            generated = [
+                Message.generate(
+                    cookie.id,
+                    cookie.name,
+                    content,
+                    access == "admin",
+                    is_reply,
+                    reply_to_user,
+                    reply_to_content,
+                    first_index + i
+                )
+                for i, (content, is_reply, reply_to_user, reply_to_content) in enumerate(messages)
+            ]
+            connection.executemany(
+                f"INSERT INTO messages (group_id, {MESSAGE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        group_id,
+                        message.id,
+                        message.index,
+                        message.author_id,
+                        message.author_name,
+                        message.content,
+                        message.is_author_admin,
+                        message.is_reply,
+                        message.reply_to_user,
+                        message.reply_to_content
+                    )
+                    for message in generated
+                ]
+            )
+            last = generated[-1]
+            connection.execute(
+                """
+                UPDATE groups SET
+                    last_message_index = ?,
+                    last_message_id = ?,
+                    last_message_content = ?,
+                    last_message_author_name = ?
+                WHERE id = ?
+                """,
+                (last.index, last.id, last.content, cookie.name, group_id)
+            )
+            return True
+
+    def message_get(
+            self,
+            cookie: Cookie,
+            group_id: str,
+            pagination_last_message_key: Optional[str] = None,
+            amount: int = 1,
+            after: bool = False
+    ) -> list[Message]:
+        if self.user_has_group_access(cookie.id, group_id) == "none":
+            return []
+
+        if pagination_last_message_key is None:
+            cursor = 0 if after else None
+        else:
+            row = self.__query_one(
+                "SELECT message_index FROM messages WHERE group_id = ? AND id = ?",
+                (group_id, pagination_last_message_key)
+            )
+            if row is None:
+                return []
+            cursor = row["message_index"]
+
+        if after:
+            rows = self.__query(
+                f"""
+                SELECT {MESSAGE_COLUMNS} FROM messages
+                WHERE group_id = ? AND message_index > ? ORDER BY message_index LIMIT ?
+                """,
+                (group_id, cursor, amount)
+            )
+            return [message_from_row(row) for row in rows]
+
+        if cursor is None:
+            rows = self.__query(
+                f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE group_id = ? ORDER BY message_index DESC LIMIT ?",
+                (group_id, amount)
+            )
+        else:
+            rows = self.__query(
+                f"""
+                SELECT {MESSAGE_COLUMNS} FROM messages
+                WHERE group_id = ? AND message_index < ? ORDER BY message_index DESC LIMIT ?
+                """,
+                (group_id, cursor, amount)
+            )
+        return [message_from_row(row) for row in reversed(rows)]
+
+    def message_get_with_id(self, cookie: Cookie, group_id: str, message_id: str) -> Optional[Message]:
+        if self.user_has_group_access(cookie.id, group_id) == "none":
+            return None
+        row = self.__query_one(
+            f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE group_id = ? AND id = ?",
+            (group_id, message_id)
+        )
+        if row is None:
+            return None
+        return message_from_row(row)
+
+    def message_edit(self, cookie: Cookie, group_id: str, message_id: str, new_content: str) -> bool:
+        if self.user_has_group_access(cookie.id, group_id) == "none":
+            return False
+        return self.__execute(
+            "UPDATE messages SET content = ? WHERE group_id = ? AND id = ? AND author_id = ?",
+            (new_content, group_id, message_id, cookie.id)
+        ) == 1
+
+    def message_delete(self, cookie: Cookie, group_id: str, message_id: str) -> bool:
+        access = self.user_has_group_access(cookie.id, group_id)
+        if access == "none":
+            return False
+        if access == "admin":
+            return self.__execute(
+                "DELETE FROM messages WHERE group_id = ? AND id = ?",
+                (group_id, message_id)
+            ) == 1
+        return self.__execute(
+            "DELETE FROM messages WHERE group_id = ? AND id = ? AND author_id = ?",
+            (group_id, message_id, cookie.id)
+        ) == 1
+
+    def message_get_by_author(self, cookie: Cookie, group_id: str, author_id: str) -> list[Message]:
+        if self.user_has_group_access(cookie.id, group_id) == "none":
+            return []
+        return [
+            message_from_row(row)
+            for row in self.__query(
+                f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE group_id = ? AND author_id = ? ORDER BY message_index",
+                (group_id, author_id)
+            )
+        ]
+
+    def message_search(
+            self,
+            cookie: Cookie,
+            search_query: str,
+            page: int = 0,
+            amount: int = 20
+    ) -> list[tuple[str, Message]]:
+        query_terms = terms(search_query)
+        if len(query_terms) == 0:
+            return []
+        # Every word as a quoted phrase, so FTS5 syntax in the query is matched literally
+        match = " ".join('"' + term.replace('"', '""') + '"' for term in query_terms)
+        rows = self.__query(
+            f"""
+            SELECT group_id, {MESSAGE_COLUMNS} FROM messages
+            JOIN (
+                SELECT rowid, bm25(message_text) AS score FROM message_text WHERE message_text MATCH ?
+            ) AS matches ON matches.rowid = messages.row_id
+            WHERE group_id IN (SELECT group_id FROM group_members WHERE user_id = ?)
+            ORDER BY score, message_index DESC LIMIT ? OFFSET ?
+            """,
+            (match, cookie.id, amount, page * amount)
+        )
+        return [(row["group_id"], message_from_row(row)) for row in rows]
+
+    def __group_create(self, group: Group) -> Optional[Group]:
+        with self.__transaction() as connection:
+            for admin_id in group.admin_ids:
+                if connection.execute("SELECT 1 FROM users WHERE id = ?", (admin_id,)).fetchone() is None:
+                    return None
+            connection.execute(
+                """
+                INSERT INTO groups (
+                    id, name, last_message_id, last_message_content, last_message_author_name, last_message_index
+                ) VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    group.id,
+                    group.name,
+                    group.last_message_id,
+                    group.last_message_content,
+                    group.last_message_author_name,
+                    group.last_message_index
+                )
+            )
+            for admin_id in group.admin_ids:
+                connection.execute(
+                    "INSERT INTO group_members (group_id, user_id, role) VALUES (?, ?, 'admin')",
+                    (group.id, admin_id)
+                )
+                connection.execute(
+                    "INSERT OR IGNORE INTO interacted_groups (user_id, group_id) VALUES (?, ?)",
+                    (admin_id, group.id)
+                )
+            return group
+
+    def group_private_create(self, name: str, creator_id: str) -> Optional[Group]:
+        return self.__group_create(Group.private(name, [creator_id]))
+
+    def group_contact_create(self, user1_id: str, user1_name: str, user2_id: str, user2_name: str) -> Optional[Group]:
+        return self.__group_create(Group.private(f"{user1_name} & {user2_name}", [user1_id, user2_id]))
+
+    def group_delete(self, cookie: Cookie, group_id: str) -> bool:
+        with self.__transaction() as connection:
+            if self.user_has_group_access(cookie.id, group_id) != "admin":
+                return False
+            connection.execute("DELETE FROM messages WHERE group_id = ?", (group_id,))
+            connection.execute("DELETE FROM group_members WHERE group_id = ?", (group_id,))
+            connection.execute("DELETE FROM interacted_groups WHERE group_id = ?", (group_id,))
+            connection.execute("DELETE FROM pinned_groups WHERE group_id = ?", (group_id,))
+            connection.execute("DELETE FROM groups WHERE id = ?", (group_id,))
+            return True
+
+    def group_get(self, cookie: Cookie, group_id: str) -> Optional[Group]:
+        if self.user_has_group_access(cookie.id, group_id) == "none":
+            return None
+        groups = self.__groups([group_id])
+        if len(groups) == 0:
+            return None
+        return groups[0]
+
+    def group_get_many(self, cookie: Cookie, group_ids: list[str]) -> list[Optional[Group]]:
+        if len(group_ids) == 0:
+            return []
+        placeholders = ",".join("?" * len(group_ids))
+        accessible = [
+            row["group_id"]
+            for row in self.__query(
+                f"SELECT group_id FROM group_members WHERE user_id = ? AND group_id IN ({placeholders})",
+                (cookie.id, *group_ids)
+            )
+        ]
+        groups = dict((group.id, group) for group in self.__groups(accessible))
+        return [groups.get(group_id) for group_id in group_ids]
+
+    def group_search(self, cookie: Cookie, search_query: str) -> list[Group]:
+        return self.__groups([
+            row["group_id"]
+            for row in self.__query(
+                """
+                SELECT group_members.group_id FROM group_members
+                JOIN groups ON groups.id = group_members.group_id
+                WHERE group_members.user_id = ? AND instr(groups.name, ?) > 0
+                ORDER BY group_members.rowid
+                """,
+                (cookie.id, search_query)
+            )
+        ])
+
+    def group_rename(self, cookie: Cookie, group_id: str, new_group_name: str) -> bool:
+        if self.user_has_group_access(cookie.id, group_id) != "admin":
+            return False
+        return self.__execute("UPDATE groups SET name = ? WHERE id = ?", (new_group_name, group_id)) == 1
+
+    def request_send(self, cookie: Cookie, to_id: str) -> bool:
+        with self.__transaction() as connection:
+            for user_id in (to_id, cookie.id):
+                if connection.execute("SELECT 1 FROM users WHERE id = ?", (user_id,)).fetchone() is None:
+                    return False
+            connection.execute("INSERT OR IGNORE INTO requests (to_id, from_id) VALUES (?, ?)", (to_id, cookie.id))
+            return True
+
+    def request_get(self, cookie: Cookie) -> list[str]:
+        return [
+            row["from_id"]
+            for row in self.__query("SELECT from_id FROM requests WHERE to_id = ? ORDER BY rowid", (cookie.id,))
+        ]
+
+    def request_exists(self, cookie: Cookie, to_id: str) -> bool:
+        return self.__query_one(
+            "SELECT 1 FROM requests WHERE to_id = ? AND from_id = ?",
+            (to_id, cookie.id)
+        ) is not None
+
+    def request_cancel(self, cookie: Cookie, to_id: str) -> bool:
+        return self.__execute("DELETE FROM requests WHERE to_id = ? AND from_id = ?", (to_id, cookie.id)) == 1
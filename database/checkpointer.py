@@ -0,0 +1,41 @@
+from threading import Event, Thread
+from typing import Callable
+
+class Checkpointer(Thread):
+    """
+    Runs persist on its own thread every interval seconds, or as soon as it is woken, so requests never wait on disk.
+    Wakes arriving while persist runs are folded into the next run, which gives group commit for free
+    """
+    interval: float
+    stopped: bool
+
+    def __init__(self, persist: Callable[[], None], interval: float):
+        super().__init__(name="checkpointer", daemon=True)
+        self.persist = persist
+        self.interval = interval
+        self.woken = Event()
+        self.stopped = False
+
+    def run(self):
+        while True:
+            self.woken.wait(self.interval)
+            self.woken.clear()
+            # Read before persisting, a stop arriving during persist then still gets a run of its own
+            stopped = self.stopped
+            try:
+                self.persist()
+            except Exception as e:
+                print(e)
+            if stopped:
+                return
+
+    def wake(self):
+        self.woken.set()
+
+    def stop(self):
+        """Stops the thread after a final persist"""
+        if self.stopped:
+            return
+        self.stopped = True
+        self.woken.set()
+        self.join()
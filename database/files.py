@@ -0,0 +1,17 @@
+from os import O_RDONLY, close, fsync, open as open_descriptor, replace
+from os.path import abspath, dirname
+
+def write_atomically(location: str, data: bytes):
+    """Replaces the file at location with data, a crash leaves either the old or the new file and never a torn one"""
+    temporary_location = location + ".tmp"
+    with open(temporary_location, 'wb') as f:
+        f.write(data)
+        f.flush()
+        fsync(f.fileno())
+    replace(temporary_location, location)
+    # The rename itself only survives a crash once the directory entry is on disk
+    directory = open_descriptor(dirname(abspath(location)), O_RDONLY)
+    try:
+        fsync(directory)
+    finally:
+        close(directory)
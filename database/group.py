@@ -1,5 +1,7 @@
 from uuid import uuid4
 
+from database.slotted import Slotted
+
 GROUP_ID = "id"
 GROUP_NAME = "name"
 GROUP_ADMIN_IDS = "admin_ids"
@@ -7,8 +9,19 @@ GROUP_MEMBER_IDS = "member_ids"
 GROUP_LAST_MESSAGE_ID = "last_message_id"
 GROUP_LAST_MESSAGE_CONTENT = "last_message_content"
 GROUP_LAST_MESSAGE_AUTHOR_NAME = "last_message_author_name"
+GROUP_LAST_MESSAGE_INDEX = "last_message_index"
 
-class Group:
+class Group(Slotted):
+    __slots__ = (
+        "id",
+        "name",
+        "admin_ids",
+        "member_ids",
+        "last_message_id",
+        "last_message_content",
+        "last_message_author_name",
+        "last_message_index",
+    )
     id: str
     name: str
 
@@ -17,6 +30,7 @@ class Group:
     last_message_id: str
     last_message_content: str
     last_message_author_name: str
+    last_message_index: int
 
     def __init__(
             self,
@@ -26,7 +40,8 @@ class Group:
             member_ids: list[str],
             last_message_id: str,
             last_message_content: str,
-            last_message_author_name: str
+            last_message_author_name: str,
+            last_message_index: int = 0
     ):
         self.id = identifier
         self.name = name
@@ -35,6 +50,7 @@ class Group:
         self.last_message_id = last_message_id
         self.last_message_content = last_message_content
         self.last_message_author_name = last_message_author_name
+        self.last_message_index = last_message_index
 
     @staticmethod
     def generate(name) -> "Group":
@@ -57,8 +73,22 @@ class Group:
             GROUP_LAST_MESSAGE_ID: self.last_message_id,
             GROUP_LAST_MESSAGE_CONTENT: self.last_message_content,
             GROUP_LAST_MESSAGE_AUTHOR_NAME: self.last_message_author_name,
+            GROUP_LAST_MESSAGE_INDEX: self.last_message_index,
         }
 
+    @staticmethod
+    def from_obj(obj: dict) -> "Group":
+        return Group(
+            obj[GROUP_ID],
+            obj[GROUP_NAME],
+            obj[GROUP_ADMIN_IDS],
+            obj[GROUP_MEMBER_IDS],
+            obj[GROUP_LAST_MESSAGE_ID],
+            obj[GROUP_LAST_MESSAGE_CONTENT],
+            obj[GROUP_LAST_MESSAGE_AUTHOR_NAME],
+            obj.get(GROUP_LAST_MESSAGE_INDEX, 0)
+        )
+
     @staticmethod
     def private(name: str, creator_ids: list[str]) -> "Group":
         self = Group.generate(name)
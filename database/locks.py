@@ -0,0 +1,84 @@
+from contextlib import contextmanager
+from threading import Condition, Lock, RLock, get_ident
+from typing import Optional
+
+class ReadWriteLock:
+    """Any number of readers or a single writer, waiting writers go first and both sides may re-enter"""
+    readers: dict[int, int]
+    writer: Optional[int]
+    writer_depth: int
+    waiting_writers: int
+
+    def __init__(self):
+        self.condition = Condition(Lock())
+        self.readers = {}
+        self.writer = None
+        self.writer_depth = 0
+        self.waiting_writers = 0
+
+    def acquire_read(self):
+        me = get_ident()
+        with self.condition:
+            if self.writer == me or me in self.readers:
+                self.readers[me] = self.readers.get(me, 0) + 1
+                return
+            while self.writer is not None or self.waiting_writers > 0:
+                self.condition.wait()
+            self.readers[me] = 1
+
+    def release_read(self):
+        me = get_ident()
+        with self.condition:
+            self.readers[me] -= 1
+            if self.readers[me] == 0:
+                del self.readers[me]
+                if len(self.readers) == 0:
+                    self.condition.notify_all()
+
+    def acquire_write(self):
+        me = get_ident()
+        with self.condition:
+            if self.writer == me:
+                self.writer_depth += 1
+                return
+            if me in self.readers:
+                raise RuntimeError("Can not upgrade a read lock to a write lock")
+            self.waiting_writers += 1
+            while self.writer is not None or len(self.readers) != 0:
+                self.condition.wait()
+            self.waiting_writers -= 1
+            self.writer = me
+            self.writer_depth = 1
+
+    def release_write(self):
+        with self.condition:
+            self.writer_depth -= 1
+            if self.writer_depth == 0:
+                self.writer = None
+                self.condition.notify_all()
+
+    @contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+class LockStripes:
+    """A fixed pool of re-entrant locks shared between keys by hash, so locking a key costs no allocation"""
+    locks: list[RLock]
+
+    def __init__(self, count: int = 64):
+        self.locks = [RLock() for _ in range(count)]
+
+    def __call__(self, key: str) -> RLock:
+        return self.locks[hash(key) % len(self.locks)]
@@ -1,6 +1,9 @@
+from sys import intern
 from uuid import uuid4
 from typing import Optional
 
+from database.slotted import Slotted, intern_optional
+
 MESSAGE_AUTHOR_ID = "author_id"
 MESSAGE_INDEX = "index"
 MESSAGE_AUTHOR_NAME = "author_name"
@@ -11,7 +14,18 @@ MESSAGE_REPLY_TO_USER = "reply_to_user"
 MESSAGE_REPLY_TO_CONTENT = "reply_to_content"
 
 
-class Message:
+class Message(Slotted):
+    __slots__ = (
+        "id",
+        "index",
+        "content",
+        "author_name",
+        "author_id",
+        "is_author_admin",
+        "is_reply",
+        "reply_to_user",
+        "reply_to_content",
+    )
     id: str
     index: int # used for pagination
     content: str
@@ -38,12 +52,14 @@ class Message:
     ):
         self.id = identifier
         self.index = index
-        self.author_id = author_id
-        self.author_name = author_name
+        # Authors write many messages, so their id and name are shared instead of copied. Content is arbitrary user
+        # text and would only pile up in the interpreter's intern table
+        self.author_id = intern(author_id)
+        self.author_name = intern(author_name)
         self.content = content
         self.is_author_admin = is_author_admin
         self.is_reply = is_reply
-        self.reply_to_user = reply_to_user
+        self.reply_to_user = intern_optional(reply_to_user)
         self.reply_to_content = reply_to_content
 
     @staticmethod
@@ -54,11 +70,12 @@ class Message:
             is_author_admin: bool,
             is_reply: bool,
             reply_to_user: Optional[str] = None,
-            reply_to_content: Optional[str] = None
+            reply_to_content: Optional[str] = None,
+            index: int = 0
     ) -> "Message":
         return Message(
             str(uuid4()),
-            0,
+            index,
             author_id,
             author_name,
             content,
@@ -85,8 +102,8 @@ class Message:
         try:
             return Message(
                 message_id,
-                message_data[MESSAGE_AUTHOR_ID],
                 message_data[MESSAGE_INDEX],
+                message_data[MESSAGE_AUTHOR_ID],
                 message_data[MESSAGE_AUTHOR_NAME],
                 message_data[MESSAGE_CONTENT],
                 message_data[MESSAGE_IS_AUTHOR_ADMIN],
@@ -0,0 +1,101 @@
+from bisect import bisect_left, bisect_right
+from typing import Iterable, Optional
+
+from database.message import Message
+
+# Tombstones are compacted away once they make up this share of the index
+MAX_REMOVED_SHARE = 0.5
+
+class MessageIndex:
+    """
+    Message ids of a single group ordered by their pagination index.
+    Removing only leaves a tombstone (None) behind, so wiping k messages costs O(k log n) instead of shifting the list k times
+    """
+    indexes: list[int]
+    message_ids: list[Optional[str]]
+    removed: int
+
+    def __init__(self):
+        self.indexes = []
+        self.message_ids = []
+        self.removed = 0
+
+    @staticmethod
+    def from_messages(messages: Iterable[Message]) -> "MessageIndex":
+        self = MessageIndex()
+        for message in sorted(messages, key=lambda message: message.index):
+            self.indexes.append(message.index)
+            self.message_ids.append(message.id)
+        return self
+
+    def __len__(self) -> int:
+        return len(self.indexes) - self.removed
+
+    def last_index(self) -> int:
+        """The highest index handed out so far, removed messages included"""
+        if len(self.indexes) == 0:
+            return 0
+        return self.indexes[-1]
+
+    def add(self, index: int, message_id: str):
+        # Sends always carry the newest index, so this is an append unless a log replay inserts out of order
+        if len(self.indexes) == 0 or index > self.indexes[-1]:
+            self.indexes.append(index)
+            self.message_ids.append(message_id)
+            return
+        position = bisect_left(self.indexes, index)
+        if position < len(self.indexes) and self.indexes[position] == index:
+            if self.message_ids[position] is None:
+                self.removed -= 1
+            self.message_ids[position] = message_id
+            return
+        self.indexes.insert(position, index)
+        self.message_ids.insert(position, message_id)
+
+    def remove(self, index: int):
+        position = bisect_left(self.indexes, index)
+        if position == len(self.indexes) or self.indexes[position] != index:
+            return
+        if self.message_ids[position] is None:
+            return
+        self.message_ids[position] = None
+        self.removed += 1
+        if self.removed > len(self.indexes) * MAX_REMOVED_SHARE:
+            self.compact()
+
+    def compact(self):
+        live = [
+            (index, message_id)
+            for index, message_id in zip(self.indexes, self.message_ids)
+            if message_id is not None
+        ]
+        self.indexes = [index for index, _ in live]
+        self.message_ids = [message_id for _, message_id in live]
+        self.removed = 0
+
+    def before(self, index: Optional[int], amount: int) -> list[str]:
+        """Up to amount message ids older than index (or the newest ones), oldest first"""
+        end = len(self.indexes) if index is None else bisect_left(self.indexes, index)
+        if self.removed == 0:
+            return self.message_ids[max(0, end - amount):end]
+        pages = []
+        found = 0
+        while end > 0 and found < amount:
+            start = max(0, end - (amount - found))
+            page = [message_id for message_id in self.message_ids[start:end] if message_id is not None]
+            pages.append(page)
+            found += len(page)
+            end = start
+        return [message_id for page in reversed(pages) for message_id in page]
+
+    def after(self, index: Optional[int], amount: int) -> list[str]:
+        """Up to amount message ids newer than index (or the oldest ones), oldest first"""
+        start = 0 if index is None else bisect_right(self.indexes, index)
+        if self.removed == 0:
+            return self.message_ids[start:start + amount]
+        result = []
+        while start < len(self.indexes) and len(result) < amount:
+            end = start + (amount - len(result))
+            result.extend(message_id for message_id in self.message_ids[start:end] if message_id is not None)
+            start = end
+        return result
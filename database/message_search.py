@@ -0,0 +1,99 @@
+import re
+from math import log
+from typing import Iterable
+
+from database.message import Message
+
+TERM = re.compile(r"\w+")
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+def terms(text: str) -> list[str]:
+    return TERM.findall(text.lower())
+
+class MessageSearchIndex:
+    """Inverted index over the content of a single group's messages, ranked with BM25"""
+    # term -> {message_id -> occurrences of term in that message}
+    postings: dict[str, dict[str, int]]
+    lengths: dict[str, int]
+    message_indexes: dict[str, int]
+    # Distinct terms of every message, edits change content in place so removal can not re-tokenize the old text
+    message_terms: dict[str, tuple[str, ...]]
+    total_length: int
+
+    def __init__(self):
+        self.postings = {}
+        self.lengths = {}
+        self.message_indexes = {}
+        self.message_terms = {}
+        self.total_length = 0
+
+    @staticmethod
+    def from_messages(messages: Iterable[Message]) -> "MessageSearchIndex":
+        self = MessageSearchIndex()
+        for message in messages:
+            self.add(message)
+        return self
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def covers(self, messages: dict[str, Message]) -> bool:
+        """Whether the index was built from exactly these messages, a crash may have left it behind its shard"""
+        return self.message_indexes.keys() == messages.keys() and all(
+            self.message_indexes[message_id] == message.index
+            for message_id, message in messages.items()
+        )
+
+    def add(self, message: Message):
+        if message.id in self.lengths:
+            self.remove(message.id)
+        message_terms = terms(message.content)
+        for term in message_terms:
+            occurrences = self.postings.setdefault(term, {})
+            occurrences[message.id] = occurrences.get(message.id, 0) + 1
+        self.lengths[message.id] = len(message_terms)
+        self.message_indexes[message.id] = message.index
+        self.message_terms[message.id] = tuple(set(message_terms))
+        self.total_length += len(message_terms)
+
+    def remove(self, message_id: str):
+        length = self.lengths.pop(message_id, None)
+        if length is None:
+            return
+        del self.message_indexes[message_id]
+        self.total_length -= length
+        for term in self.message_terms.pop(message_id):
+            occurrences = self.postings[term]
+            del occurrences[message_id]
+            if len(occurrences) == 0:
+                del self.postings[term]
+
+    def search(self, query_terms: list[str]) -> list[tuple[float, int, str]]:
+        """(score, message index, message id) of every message containing all of query_terms"""
+        if len(query_terms) == 0 or len(self.lengths) == 0:
+            return []
+        postings = []
+        for term in set(query_terms):
+            occurrences = self.postings.get(term)
+            if occurrences is None:
+                return []
+            postings.append(occurrences)
+        postings.sort(key=len)
+
+        count = len(self.lengths)
+        average_length = self.total_length / count
+        results = []
+        for message_id in postings[0]:
+            if not all(message_id in occurrences for occurrences in postings[1:]):
+                continue
+            length_norm = K1 * (1 - B + B * self.lengths[message_id] / average_length)
+            score = 0
+            for occurrences in postings:
+                frequency = occurrences[message_id]
+                idf = log(1 + (count - len(occurrences) + 0.5) / (len(occurrences) + 0.5))
+                score += idf * frequency * (K1 + 1) / (frequency + length_norm)
+            results.append((score, self.message_indexes[message_id], message_id))
+        return results
@@ -0,0 +1,344 @@
+import pickle
+from collections import OrderedDict
+from os import makedirs, remove, stat
+from os.path import exists, join
+from threading import RLock
+from typing import Optional
+
+from database import storage
+from database.files import write_atomically
+from database.locks import LockStripes
+from database.message import Message
+from database.message_index import MessageIndex
+from database.message_search import MessageSearchIndex
+
+def index_authors(messages: dict[str, Message]) -> dict[str, set[str]]:
+    authors = {}
+    for message in messages.values():
+        authors.setdefault(message.author_id, set()).add(message.id)
+    return authors
+
+class MessageStore:
+    """
+    Messages of every group, one shard file per group, loaded on first access and evicted least recently used first.
+    Each shard's search index is saved next to it so it does not have to be rebuilt when the shard is loaded.
+    Searching a group which is not resident only reads its search index, those are cached separately (at most
+    max_cached_search_indexes of them) so a search does not push the groups in use out of memory.
+    Groups with unsaved changes are never evicted, they stay resident (even over max_resident_messages) until save()
+    writes them, so no request ever waits on writing out another group.
+    Callers hold group_locks(group_id) around every access to a group, the store's own lock only covers its bookkeeping
+    """
+    location: str
+    max_resident_messages: int
+
+    resident: OrderedDict[str, dict[str, Message]]
+    indexes: dict[str, MessageIndex]
+    search_indexes: dict[str, MessageSearchIndex]
+    # Search indexes of groups which are not resident, as saved next to their shard, least recently used first
+    cached_search_indexes: OrderedDict[str, MessageSearchIndex]
+    # group_id -> {author_id -> ids of that author's messages}
+    author_indexes: dict[str, dict[str, set[str]]]
+    resident_messages: int
+
+    # Groups changed since their shard was last written, and groups whose shard has to be removed
+    dirty: set[str]
+    deleted: set[str]
+    # Groups whose shard save() is writing, they are not evicted until it is on disk
+    writing: set[str]
+
+    def __init__(
+            self,
+            location: str,
+            max_resident_messages: int,
+            group_locks: LockStripes,
+            max_cached_search_indexes: int = 256
+    ):
+        makedirs(location, exist_ok=True)
+        self.location = location
+        self.group_locks = group_locks
+        self.lock = RLock()
+        self.max_resident_messages = max_resident_messages
+        self.max_cached_search_indexes = max_cached_search_indexes
+        self.resident = OrderedDict()
+        self.indexes = {}
+        self.search_indexes = {}
+        self.cached_search_indexes = OrderedDict()
+        self.author_indexes = {}
+        self.resident_messages = 0
+        self.dirty = set()
+        self.deleted = set()
+        self.writing = set()
+
+    def shard_location(self, group_id: str) -> str:
+        return join(self.location, f"{group_id}.dat")
+
+    def search_index_location(self, group_id: str) -> str:
+        return join(self.location, f"{group_id}.idx")
+
+    def shard_signature(self, group_id: str) -> tuple[int, int, int]:
+        """Changes whenever the shard is rewritten, write_atomically always puts a new file in place"""
+        status = stat(self.shard_location(group_id))
+        return status.st_ino, status.st_size, status.st_mtime_ns
+
+    def __load(self, group_id: str) -> Optional[dict[str, Message]]:
+        if group_id in self.deleted:
+            return None
+        location = self.shard_location(group_id)
+        if not exists(location):
+            return None
+        messages = storage.load_messages(location)
+        index = MessageIndex.from_messages(messages.values())
+        with self.lock:
+            search_index = self.cached_search_indexes.pop(group_id, None)
+        if search_index is None:
+            _, search_index = self.__read_search_index(group_id)
+
+        with self.lock:
+            # Messages stored before indexes were assigned all carry 0, so number them in the order they were sent
+            if len(set(index.indexes)) != len(messages):
+                for i, message in enumerate(messages.values()):
+                    message.index = i + 1
+                index = MessageIndex.from_messages(messages.values())
+                self.dirty.add(group_id)
+            if search_index is None or not search_index.covers(messages):
+                search_index = MessageSearchIndex.from_messages(messages.values())
+                self.dirty.add(group_id)
+
+            self.resident[group_id] = messages
+            self.indexes[group_id] = index
+            self.search_indexes[group_id] = search_index
+            self.author_indexes[group_id] = index_authors(messages)
+            self.resident_messages += len(messages)
+            self.__evict()
+        return messages
+
+    def __read_search_index(self, group_id: str) -> tuple[Optional[tuple], Optional[MessageSearchIndex]]:
+        """The saved search index and the signature of the shard it was saved with"""
+        location = self.search_index_location(group_id)
+        if not exists(location):
+            return None, None
+        with open(location, 'rb') as f:
+            saved = pickle.load(f)
+        # Saved before search indexes carried their shard's signature
+        if isinstance(saved, MessageSearchIndex):
+            return None, saved
+        signature, search_index = saved
+        if isinstance(search_index, bytes):
+            search_index = pickle.loads(search_index)
+        return signature, search_index
+
+    def __snapshot(self, group_id: str) -> tuple[bytes, bytes]:
+        """Encodes a group's shard and search index for save(), the caller holds group_locks(group_id)"""
+        shard = storage.dump_messages(self.resident[group_id])
+        search_index = pickle.dumps(self.search_indexes[group_id])
+        with self.lock:
+            self.dirty.discard(group_id)
+            self.writing.add(group_id)
+        return shard, search_index
+
+    def __evict(self):
+        # The most recently used group always stays, even if it alone is over budget
+        for group_id in list(self.resident.keys())[:-1]:
+            if self.resident_messages <= self.max_resident_messages:
+                return
+            if group_id in self.dirty or group_id in self.writing:
+                continue
+            # A group another thread is working on can not be dropped from under it
+            group_lock = self.group_locks(group_id)
+            if not group_lock.acquire(blocking=False):
+                continue
+            try:
+                messages = self.resident.pop(group_id)
+                del self.indexes[group_id]
+                # The group is saved, so its search index is the one on disk and can keep answering searches
+                self.__cache_search_index(group_id, self.search_indexes.pop(group_id))
+                del self.author_indexes[group_id]
+                self.resident_messages -= len(messages)
+            finally:
+                group_lock.release()
+
+    def __cache_search_index(self, group_id: str, search_index: MessageSearchIndex):
+        with self.lock:
+            self.cached_search_indexes[group_id] = search_index
+            self.cached_search_indexes.move_to_end(group_id)
+            while len(self.cached_search_indexes) > self.max_cached_search_indexes:
+                self.cached_search_indexes.popitem(last=False)
+
+    def get(self, group_id: str) -> Optional[dict[str, Message]]:
+        with self.lock:
+            messages = self.resident.get(group_id)
+            if messages is not None:
+                self.resident.move_to_end(group_id)
+                return messages
+        return self.__load(group_id)
+
+    def __getitem__(self, group_id: str) -> dict[str, Message]:
+        messages = self.get(group_id)
+        if messages is None:
+            raise KeyError(group_id)
+        return messages
+
+    def __contains__(self, group_id: str) -> bool:
+        return self.get(group_id) is not None
+
+    def index(self, group_id: str) -> Optional[MessageIndex]:
+        if self.get(group_id) is None:
+            return None
+        return self.indexes[group_id]
+
+    def search(self, group_id: str, query_terms: list[str]) -> list[tuple[float, int, str]]:
+        """
+        (score, message index, message id) of the group's messages matching query_terms, see MessageSearchIndex.search.
+        A group which is not resident is searched through its saved search index, its shard is not loaded
+        """
+        with self.lock:
+            search_index = self.search_indexes.get(group_id)
+            if search_index is None:
+                search_index = self.cached_search_indexes.get(group_id)
+                if search_index is not None:
+                    self.cached_search_indexes.move_to_end(group_id)
+        if search_index is None and group_id not in self.deleted and exists(self.shard_location(group_id)):
+            signature, search_index = self.__read_search_index(group_id)
+            if search_index is not None and signature == self.shard_signature(group_id):
+                self.__cache_search_index(group_id, search_index)
+            elif self.get(group_id) is not None:
+                # A crash may have left the search index behind its shard, it is checked and rebuilt on load
+                search_index = self.search_indexes[group_id]
+        if search_index is None:
+            return []
+        return search_index.search(query_terms)
+
+    def messages_with_ids(self, group_id: str, message_ids: set[str]) -> dict[str, Message]:
+        """The group's messages among message_ids, read from its shard without making it resident if it is not"""
+        with self.lock:
+            messages = self.resident.get(group_id)
+        if messages is not None:
+            return dict((message_id, messages[message_id]) for message_id in message_ids if message_id in messages)
+        if group_id in self.deleted or not exists(self.shard_location(group_id)):
+            return {}
+        return storage.load_messages(self.shard_location(group_id), message_ids)
+
+    def create(self, group_id: str, messages: Optional[dict[str, Message]] = None):
+        messages = {} if messages is None else messages
+        index = MessageIndex.from_messages(messages.values())
+        search_index = MessageSearchIndex.from_messages(messages.values())
+        with self.lock:
+            if group_id in self.resident:
+                self.resident_messages -= len(self.resident[group_id])
+            self.deleted.discard(group_id)
+            self.cached_search_indexes.pop(group_id, None)
+            self.resident[group_id] = messages
+            self.indexes[group_id] = index
+            self.search_indexes[group_id] = search_index
+            self.author_indexes[group_id] = index_authors(messages)
+            self.resident_messages += len(messages)
+            self.dirty.add(group_id)
+            self.__evict()
+
+    def delete(self, group_id: str):
+        with self.lock:
+            self.cached_search_indexes.pop(group_id, None)
+            messages = self.resident.pop(group_id, None)
+            if messages is not None:
+                del self.indexes[group_id]
+                del self.search_indexes[group_id]
+                del self.author_indexes[group_id]
+                self.resident_messages -= len(messages)
+            self.dirty.discard(group_id)
+            self.deleted.add(group_id)
+
+    def put(self, group_id: str, message: Message):
+        messages = self[group_id]
+        with self.lock:
+            if message.id not in messages:
+                self.resident_messages += 1
+            messages[message.id] = message
+            self.indexes[group_id].add(message.index, message.id)
+            self.search_indexes[group_id].add(message)
+            self.author_indexes[group_id].setdefault(message.author_id, set()).add(message.id)
+            self.dirty.add(group_id)
+            self.__evict()
+
+    def remove(self, group_id: str, message_id: str) -> Optional[Message]:
+        messages = self[group_id]
+        with self.lock:
+            message = messages.pop(message_id, None)
+            if message is None:
+                return None
+            self.indexes[group_id].remove(message.index)
+            self.search_indexes[group_id].remove(message_id)
+            self.__forget_author(group_id, message)
+            self.resident_messages -= 1
+            self.dirty.add(group_id)
+            return message
+
+    def __forget_author(self, group_id: str, message: Message):
+        message_ids = self.author_indexes[group_id].get(message.author_id)
+        if message_ids is None:
+            return
+        message_ids.discard(message.id)
+        if len(message_ids) == 0:
+            del self.author_indexes[group_id][message.author_id]
+
+    def by_author(self, group_id: str, author_id: str) -> list[Message]:
+        """Messages of one author in the group, oldest first"""
+        messages = self[group_id]
+        with self.lock:
+            return sorted(
+                (messages[message_id] for message_id in self.author_indexes[group_id].get(author_id, ())),
+                key=lambda message: message.index
+            )
+
+    def wipe_author(self, group_id: str, author_id: str) -> int:
+        """Removes every message of author_id from the group, touching only those messages"""
+        messages = self[group_id]
+        with self.lock:
+            message_ids = self.author_indexes[group_id].pop(author_id, None)
+            if message_ids is None:
+                return 0
+            index = self.indexes[group_id]
+            search_index = self.search_indexes[group_id]
+            for message_id in message_ids:
+                message = messages.pop(message_id)
+                index.remove(message.index)
+                search_index.remove(message_id)
+            self.resident_messages -= len(message_ids)
+            self.dirty.add(group_id)
+            return len(message_ids)
+
+    def save(self) -> int:
+        """Writes every dirty shard and removes the shards of deleted groups, returns the bytes written"""
+        with self.lock:
+            dirty = list(self.dirty)
+            deleted = list(self.deleted)
+            self.deleted.clear()
+        written = 0
+        for group_id in dirty:
+            # The group's lock is only held while it is encoded, the files are written once it is released
+            with self.group_locks(group_id):
+                with self.lock:
+                    if group_id not in self.dirty or group_id not in self.resident:
+                        continue
+                shard, search_index = self.__snapshot(group_id)
+            try:
+                write_atomically(self.shard_location(group_id), shard)
+                # Written after the shard along with its signature, search() can tell whether they match from a stat
+                search_index = pickle.dumps((self.shard_signature(group_id), search_index))
+                write_atomically(self.search_index_location(group_id), search_index)
+            except Exception:
+                with self.lock:
+                    self.dirty.add(group_id)
+                    self.deleted.update(deleted)
+                raise
+            finally:
+                with self.lock:
+                    self.writing.discard(group_id)
+            written += len(shard) + len(search_index)
+        for group_id in deleted:
+            for location in (self.shard_location(group_id), self.search_index_location(group_id)):
+                if exists(location):
+                    remove(location)
+        # The groups just written may be dropped now, which brings the store back within its budget
+        with self.lock:
+            self.__evict()
+        return written
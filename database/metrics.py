@@ -0,0 +1,102 @@
+from bisect import bisect_left
+from typing import Union
+
+# Upper bounds in seconds, from a dictionary lookup up to a slow network round trip
+DEFAULT_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+# stats() keys which only ever grow, the rest are exported as gauges
+COUNTER_SUFFIXES = ("_total", "_performed", "_skipped", "_written")
+
+# A stats() key is either the name of one of FileDatabase's persistence figures, or a metric name with its labels
+StatKey = Union[str, tuple[str, tuple[tuple[str, str], ...]]]
+
+def labelled(name: str, **labels: str) -> StatKey:
+    """stats() key of one sample of the metric name, exported as {prefix}_{name}{labels}"""
+    return name, tuple(sorted(labels.items()))
+
+class Histogram:
+    """Latency histogram with cumulative buckets as Prometheus expects them, callers serialize observe"""
+    buckets: tuple[float, ...]
+    # counts[i] holds observations in (buckets[i - 1], buckets[i]], the last entry everything above the last bucket
+    counts: list[int]
+    total: float
+    count: int
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        result = []
+        running = 0
+        for bound, count in zip(self.buckets, self.counts):
+            running += count
+            result.append((repr(bound), running))
+        result.append(("+Inf", running + self.counts[-1]))
+        return result
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def render(
+        prefix: str,
+        sample_rate: float,
+        counts: dict[str, int],
+        calls: dict[str, Histogram],
+        errors: dict[str, int],
+        stats: dict[StatKey, float]
+) -> str:
+    """Prometheus text exposition format (version 0.0.4)"""
+    lines = [
+        f"# HELP {prefix}_sample_rate Share of database calls whose latency is recorded.",
+        f"# TYPE {prefix}_sample_rate gauge",
+        f"{prefix}_sample_rate {sample_rate!r}",
+        f"# HELP {prefix}_calls_total Database calls, counted whether sampled or not.",
+        f"# TYPE {prefix}_calls_total counter",
+    ]
+    for method, count in sorted(counts.items()):
+        lines.append(f"{prefix}_calls_total{{method=\"{escape(method)}\"}} {count}")
+    lines += [
+        f"# HELP {prefix}_call_duration_seconds Latency of sampled database calls.",
+        f"# TYPE {prefix}_call_duration_seconds histogram",
+    ]
+    for method, histogram in sorted(calls.items()):
+        label = f"method=\"{escape(method)}\""
+        for bound, count in histogram.cumulative():
+            lines.append(f"{prefix}_call_duration_seconds_bucket{{{label},le=\"{bound}\"}} {count}")
+        lines.append(f"{prefix}_call_duration_seconds_sum{{{label}}} {histogram.total!r}")
+        lines.append(f"{prefix}_call_duration_seconds_count{{{label}}} {histogram.count}")
+
+    lines.append(f"# HELP {prefix}_errors_total Database calls which raised, counted whether sampled or not.")
+    lines.append(f"# TYPE {prefix}_errors_total counter")
+    for method, count in sorted(errors.items()):
+        lines.append(f"{prefix}_errors_total{{method=\"{escape(method)}\"}} {count}")
+
+    families: dict[str, list[str]] = {}
+    kinds: dict[str, str] = {}
+    for key, value in stats.items():
+        if isinstance(key, tuple):
+            name, labels = key
+            metric = f"{prefix}_{name}"
+            label_text = ",".join(f"{label}=\"{escape(str(label_value))}\"" for label, label_value in labels)
+            sample = f"{metric}{{{label_text}}}"
+        else:
+            name = key
+            metric = sample = f"{prefix}_persistence_{name}"
+        kinds[metric] = "counter" if name.endswith(COUNTER_SUFFIXES) else "gauge"
+        families.setdefault(metric, []).append(f"{sample} {value!r}")
+    for metric, samples in families.items():
+        lines.append(f"# TYPE {metric} {kinds[metric]}")
+        lines.extend(sorted(samples))
+    return "\n".join(lines) + "\n"
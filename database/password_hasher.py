@@ -0,0 +1,50 @@
+from asyncio import wrap_future
+from concurrent.futures import Future, ThreadPoolExecutor
+from hmac import compare_digest
+from threading import BoundedSemaphore, Lock
+
+import scrypt
+
+class HasherBusy(Exception):
+    """The hasher already has max_pending passwords outstanding"""
+
+def verify(password: str, salt: str, expected: bytes) -> bool:
+    return compare_digest(scrypt.hash(password, salt), expected)
+
+class PasswordHasher:
+    """
+    scrypt on a bounded pool of worker threads (the hash runs outside the GIL), so a burst of logins waits for
+    the pool instead of occupying every request thread. Once max_pending hashes are outstanding new ones are
+    rejected straight away rather than queued behind the burst
+    """
+    rejected: int
+
+    def __init__(self, workers: int = 4, max_pending: int = 64):
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="password-hasher")
+        self.slots = BoundedSemaphore(max_pending)
+        self.stats_lock = Lock()
+        self.rejected = 0
+
+    def __submit(self, function, *args) -> Future:
+        if not self.slots.acquire(blocking=False):
+            with self.stats_lock:
+                self.rejected += 1
+            raise HasherBusy("Too many passwords are waiting to be hashed")
+        future = self.executor.submit(function, *args)
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def hash(self, password: str, salt) -> Future:
+        return self.__submit(scrypt.hash, password, salt)
+
+    def verify(self, password: str, salt: str, expected: bytes) -> Future:
+        return self.__submit(verify, password, salt, expected)
+
+    async def hash_async(self, password: str, salt) -> bytes:
+        return await wrap_future(self.hash(password, salt))
+
+    async def verify_async(self, password: str, salt: str, expected: bytes) -> bool:
+        return await wrap_future(self.verify(password, salt, expected))
+
+    def shutdown(self):
+        self.executor.shutdown()
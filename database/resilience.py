@@ -0,0 +1,437 @@
+from asyncio import sleep as async_sleep, wait_for, TimeoutError as AsyncTimeoutError
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from random import random
+from threading import Lock
+from time import monotonic, sleep
+from typing import Any, Awaitable, Callable, Optional
+
+from cachetools import TTLCache
+from firebase_admin import exceptions as firebase_exceptions
+from google.api_core import exceptions as google_exceptions
+from requests import exceptions as requests_exceptions
+
+from database.metrics import labelled, StatKey
+
+# Failures worth another attempt, the service may well answer the next one
+TRANSIENT_ERRORS = (
+    TimeoutError,
+    ConnectionError,
+    requests_exceptions.ConnectionError,
+    requests_exceptions.Timeout,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+    google_exceptions.TooManyRequests,
+    google_exceptions.Aborted,
+    firebase_exceptions.UnavailableError,
+    firebase_exceptions.DeadlineExceededError,
+    firebase_exceptions.InternalError,
+    firebase_exceptions.ResourceExhaustedError,
+    firebase_exceptions.AbortedError,
+)
+
+class CircuitOpen(Exception):
+    def __init__(self, service: str):
+        super().__init__(f"{service} is failing, calls are refused until it recovers")
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive transient failures and refuses calls for reset_timeout seconds,
+    then lets a single trial call through which closes it again on success
+    """
+    failures: int
+    opened_at: Optional[float]
+    trial: bool
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = Lock()
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial or monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.trial = True
+            return True
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.failure_threshold:
+                self.opened_at = monotonic()
+            self.trial = False
+
+    def is_open(self) -> bool:
+        with self.lock:
+            return self.opened_at is not None
+
+
+class Resilience:
+    """
+    Runs calls to a remote service under a deadline covering every attempt, each attempt is given up after
+    attempt_timeout (by default an even share of the deadline). Idempotent reads are retried with
+    exponentially growing, jittered pauses and, with hedge_after set, raced against a second attempt when the first
+    is slower than that. Each service has a circuit breaker, a read refused by it or failing for good is answered with
+    its last successful result if one is younger than stale_ttl. Reads given no key, access checks among them, never are.
+    Outcomes are counted per operation: success, retry, hedge, timeout, failure, rejected and stale
+    """
+    deadline: float
+    attempt_timeout: float
+    attempts: int
+    backoff: float
+    max_backoff: float
+    hedge_after: Optional[float]
+
+    def __init__(
+            self,
+            deadline: float = 10,
+            attempts: int = 3,
+            attempt_timeout: Optional[float] = None,
+            backoff: float = 0.05,
+            max_backoff: float = 1,
+            hedge_after: Optional[float] = None,
+            failure_threshold: int = 5,
+            reset_timeout: float = 10,
+            stale_entries: int = 10_000,
+            stale_ttl: float = 300,
+            workers: int = 32
+    ):
+        self.deadline = deadline
+        self.attempts = attempts
+        self.attempt_timeout = attempt_timeout or deadline / attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_after = hedge_after
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.breakers: dict[str, CircuitBreaker] = {}
+        self.stale = TTLCache(stale_entries, stale_ttl)
+        # (operation, outcome) -> calls
+        self.outcomes: dict[tuple[str, str], int] = {}
+        self.lock = Lock()
+        # Calls run here so a stalled one only holds a worker past its deadline, not the request waiting on it
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="firebase-call")
+
+    def breaker(self, service: str) -> CircuitBreaker:
+        with self.lock:
+            breaker = self.breakers.get(service)
+            if breaker is None:
+                breaker = self.breakers[service] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+            return breaker
+
+    def count(self, operation: str, outcome: str):
+        with self.lock:
+            key = (operation, outcome)
+            self.outcomes[key] = self.outcomes.get(key, 0) + 1
+
+    def stats(self) -> dict[StatKey, float]:
+        with self.lock:
+            stats = {
+                labelled("firebase_calls_total", operation=operation, outcome=outcome): count
+                for (operation, outcome), count in sorted(self.outcomes.items())
+            }
+            breakers = list(self.breakers.items())
+        for service, breaker in breakers:
+            stats[labelled("firebase_circuit_open", service=service)] = 1 if breaker.is_open() else 0
+        return stats
+
+    def __attempt(self, operation: str, function: Callable[[], Any], hedge: bool, deadline: float) -> Any:
+        attempts: list[Future] = [self.executor.submit(function)]
+        if hedge and self.hedge_after is not None:
+            done, _ = wait(attempts, min(self.hedge_after, max(0.0, deadline - monotonic())))
+            if len(done) == 0 and monotonic() < deadline:
+                self.count(operation, "hedge")
+                attempts.append(self.executor.submit(function))
+        error = None
+        while len(attempts) != 0:
+            remaining = deadline - monotonic()
+            done, _ = wait(attempts, max(0.0, remaining), FIRST_COMPLETED)
+            if len(done) == 0:
+                raise TimeoutError(f"{operation} took longer than its deadline")
+            for future in done:
+                attempts.remove(future)
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def call(
+            self,
+            service: str,
+            operation: str,
+            function: Callable[[], Any],
+            idempotent: bool,
+            key: Optional[str] = None
+    ) -> Any:
+        """Result of function, key names an idempotent read whose result may be served stale"""
+        breaker = self.breaker(service)
+        deadline = monotonic() + self.deadline
+        attempts = self.attempts if idempotent else 1
+        error = None
+        for attempt in range(attempts):
+            if not breaker.allow():
+                self.count(operation, "rejected")
+                error = CircuitOpen(service)
+                break
+            try:
+                result = self.__attempt(
+                    operation,
+                    function,
+                    idempotent,
+                    min(deadline, monotonic() + self.attempt_timeout) if idempotent else deadline
+                )
+            except TRANSIENT_ERRORS as e:
+                breaker.failure()
+                self.count(operation, "timeout" if isinstance(e, TimeoutError) else "failure")
+                error = e
+                pause = random() * min(self.max_backoff, self.backoff * 2 ** attempt)
+                if attempt + 1 == attempts or monotonic() + pause >= deadline:
+                    break
+                self.count(operation, "retry")
+                sleep(pause)
+                continue
+            except Exception:
+                # The service answered, just not with what was hoped for
+                breaker.success()
+                self.count(operation, "error")
+                raise
+            breaker.success()
+            self.count(operation, "success")
+            if key is not None:
+                self.stale[key] = result
+            return result
+
+        if key is not None:
+            stale = self.stale.get(key)
+            if stale is not None:
+                self.count(operation, "stale")
+                return stale
+        raise error
+
+    async def __attempt_async(self, operation: str, function: Callable[[], Awaitable[Any]], deadline: float) -> Any:
+        try:
+            return await wait_for(function(), max(0.0, deadline - monotonic()))
+        except AsyncTimeoutError:
+            raise TimeoutError(f"{operation} took longer than its deadline")
+
+    async def call_async(
+            self,
+            service: str,
+            operation: str,
+            function: Callable[[], Awaitable[Any]],
+            idempotent: bool,
+            key: Optional[str] = None
+    ) -> Any:
+        """call() for the async clients, function is awaited on the caller's event loop and never hedged"""
+        breaker = self.breaker(service)
+        deadline = monotonic() + self.deadline
+        attempts = self.attempts if idempotent else 1
+        error = None
+        for attempt in range(attempts):
+            if not breaker.allow():
+                self.count(operation, "rejected")
+                error = CircuitOpen(service)
+                break
+            try:
+                result = await self.__attempt_async(
+                    operation,
+                    function,
+                    min(deadline, monotonic() + self.attempt_timeout) if idempotent else deadline
+                )
+            except TRANSIENT_ERRORS as e:
+                breaker.failure()
+                self.count(operation, "timeout" if isinstance(e, TimeoutError) else "failure")
+                error = e
+                pause = random() * min(self.max_backoff, self.backoff * 2 ** attempt)
+                if attempt + 1 == attempts or monotonic() + pause >= deadline:
+                    break
+                self.count(operation, "retry")
+                await async_sleep(pause)
+                continue
+            except Exception:
+                breaker.success()
+                self.count(operation, "error")
+                raise
+            breaker.success()
+            self.count(operation, "success")
+            if key is not None:
+                self.stale[key] = result
+            return result
+
+        if key is not None:
+            stale = self.stale.get(key)
+            if stale is not None:
+                self.count(operation, "stale")
+                return stale
+        raise error
+
+
+"""Firebase clients whose calls go through Resilience"""
+class ResilientDocument:
+    def __init__(self, document, resilience: Resilience, path: str):
+        self.document = document
+        self.resilience = resilience
+        self.path = path
+
+    def __getattr__(self, name: str):
+        return getattr(self.document, name)
+
+    def get(self, field_paths: Optional[list[str]] = None, stale: bool = True):
+        """stale=False for reads that decide access, those fail rather than answer with a role that may be revoked"""
+        return self.resilience.call(
+            "firestore",
+            "firestore_get",
+            lambda: self.document.get(field_paths),
+            True,
+            f"firestore:{self.path}:{field_paths}" if stale else None
+        )
+
+    def set(self, data: dict):
+        return self.resilience.call("firestore", "firestore_write", lambda: self.document.set(data), False)
+
+    def update(self, data: dict):
+        return self.resilience.call("firestore", "firestore_write", lambda: self.document.update(data), False)
+
+    def delete(self):
+        return self.resilience.call("firestore", "firestore_write", lambda: self.document.delete(), False)
+
+
+class ResilientQuery:
+    def __init__(self, query, resilience: Resilience, description: str):
+        self.query = query
+        self.resilience = resilience
+        self.description = description
+
+    def where(self, field: str, operator: str, value: Any) -> "ResilientQuery":
+        return ResilientQuery(
+            self.query.where(field, operator, value),
+            self.resilience,
+            f"{self.description}:{field}{operator}{value!r}"
+        )
+
+    def stream(self):
+        return iter(self.resilience.call(
+            "firestore",
+            "firestore_query",
+            lambda: list(self.query.stream()),
+            True,
+            f"firestore:{self.description}"
+        ))
+
+
+class ResilientCollection:
+    def __init__(self, collection, resilience: Resilience, name: str):
+        self.collection = collection
+        self.resilience = resilience
+        self.name = name
+
+    def __getattr__(self, name: str):
+        return getattr(self.collection, name)
+
+    def document(self, identifier: str) -> ResilientDocument:
+        return ResilientDocument(self.collection.document(identifier), self.resilience, f"{self.name}/{identifier}")
+
+    def where(self, field: str, operator: str, value: Any) -> ResilientQuery:
+        return ResilientQuery(self.collection, self.resilience, self.name).where(field, operator, value)
+
+
+class ResilientFirestore:
+    def __init__(self, client, resilience: Resilience):
+        self.client = client
+        self.resilience = resilience
+
+    def __getattr__(self, name: str):
+        return getattr(self.client, name)
+
+    def collection(self, name: str) -> ResilientCollection:
+        return ResilientCollection(self.client.collection(name), self.resilience, name)
+
+    def get_all(self, references: list, field_paths: Optional[list[str]] = None, stale: bool = True):
+        documents = [getattr(reference, "document", reference) for reference in references]
+        paths = sorted(getattr(reference, "path", "") for reference in references)
+        return iter(self.resilience.call(
+            "firestore",
+            "firestore_get_all",
+            lambda: list(self.client.get_all(documents, field_paths=field_paths)),
+            True,
+            f"firestore:{paths}:{field_paths}" if stale else None
+        ))
+
+
+class ResilientRealtimeQuery:
+    # firebase_admin's query methods update the query in place, the description follows along
+    def __init__(self, query, resilience: Resilience, description: str):
+        self.query = query
+        self.resilience = resilience
+        self.description = description
+
+    def __refine(self, name: str, value: Any) -> "ResilientRealtimeQuery":
+        self.query = getattr(self.query, name)(value)
+        self.description += f":{name}={value!r}"
+        return self
+
+    def start_at(self, start): return self.__refine("start_at", start)
+    def end_at(self, end): return self.__refine("end_at", end)
+    def equal_to(self, value): return self.__refine("equal_to", value)
+    def limit_to_first(self, limit: int): return self.__refine("limit_to_first", limit)
+    def limit_to_last(self, limit: int): return self.__refine("limit_to_last", limit)
+
+    def get(self):
+        return self.resilience.call(
+            "realtime",
+            "realtime_query",
+            self.query.get,
+            True,
+            f"realtime:{self.description}"
+        )
+
+
+class ResilientReference:
+    def __init__(self, reference, resilience: Resilience, path: str):
+        self.reference = reference
+        self.resilience = resilience
+        self.path = path
+
+    def __getattr__(self, name: str):
+        return getattr(self.reference, name)
+
+    def get(self):
+        return self.resilience.call("realtime", "realtime_get", self.reference.get, True, f"realtime:{self.path}")
+
+    def set(self, value: Any):
+        return self.resilience.call("realtime", "realtime_write", lambda: self.reference.set(value), False)
+
+    def update(self, values: dict):
+        return self.resilience.call("realtime", "realtime_write", lambda: self.reference.update(values), False)
+
+    def delete(self):
+        return self.resilience.call("realtime", "realtime_write", self.reference.delete, False)
+
+    def transaction(self, transaction_update: Callable[[Any], Any]):
+        # firebase_admin retries a contended transaction itself, a repeat here could apply it twice
+        return self.resilience.call(
+            "realtime",
+            "realtime_transaction",
+            lambda: self.reference.transaction(transaction_update),
+            False
+        )
+
+    def order_by_child(self, child: str) -> ResilientRealtimeQuery:
+        return ResilientRealtimeQuery(
+            self.reference.order_by_child(child),
+            self.resilience,
+            f"{self.path}:order_by_child={child}"
+        )
@@ -0,0 +1,19 @@
+from sys import intern
+from typing import Optional
+
+def intern_optional(text: Optional[str]) -> Optional[str]:
+    return None if text is None else intern(text)
+
+class Slotted:
+    """
+    Base of the models kept in memory by the million, their attributes live in __slots__ instead of a per-instance
+    __dict__. Pickles written before the models had slots carry a plain dict as their state, which still loads
+    """
+    __slots__ = ()
+
+    def __setstate__(self, state):
+        # Default slot pickling gives (None, {slot: value}), slotless classes gave {attribute: value}
+        if isinstance(state, tuple):
+            state = {**(state[0] or {}), **state[1]}
+        for name, value in state.items():
+            setattr(self, name, value)
@@ -0,0 +1,201 @@
+"""
+Snapshot file format of FileDatabase.
+
+A file is MAGIC followed by a stream of msgpack objects. The first object is a header naming the format version, the
+kind of record stored and the record's fields (the keys of the models' to_obj), every following object is one record
+as an array of those fields. Records are decoded one at a time, so a file never has to be held in memory twice, and a
+file written with other fields than the current ones is still read by name.
+
+Files written before this format are pickles, they are still read and are replaced by the new format on their next
+write. Run `python -m database.storage <directory>` to convert a whole FileDatabase directory at once.
+"""
+import pickle
+import sys
+from operator import attrgetter
+from os import listdir
+from os.path import exists, isdir, join
+from shutil import copyfile
+from typing import Any, Callable, Iterable, Iterator, Optional
+
+import msgpack
+
+from database.files import write_atomically
+from database.group import Group
+from database.message import Message
+from database.user import User
+
+MAGIC = b"ShadowTalk"
+FORMAT_VERSION = 1
+
+KIND_USERS = "users"
+KIND_GROUPS = "groups"
+KIND_AUTH = "auth"
+KIND_MESSAGES = "messages"
+
+# In constructor order where the model has one taking every field, so current records decode positionally
+FIELDS = {
+    KIND_USERS: (
+        "id",
+        "name",
+        "email",
+        "is_verified_email",
+        "profile_picture",
+        "group_ids",
+        "interacted_group_ids",
+        "pinned_group_ids",
+        "requests",
+    ),
+    KIND_GROUPS: (
+        "id",
+        "name",
+        "admin_ids",
+        "member_ids",
+        "last_message_id",
+        "last_message_content",
+        "last_message_author_name",
+        "last_message_index",
+    ),
+    KIND_AUTH: ("email", "hash", "salt"),
+    KIND_MESSAGES: (
+        "id",
+        "index",
+        "author_id",
+        "author_name",
+        "content",
+        "is_author_admin",
+        "is_reply",
+        "reply_to_user",
+        "reply_to_content",
+    ),
+}
+
+def auth_record(item: tuple[str, tuple[bytes, str]]) -> tuple:
+    email, (password_hash, salt) = item
+    return email, password_hash, salt
+
+ENCODERS: dict[str, Callable[[Any], tuple]] = {
+    KIND_USERS: attrgetter(*FIELDS[KIND_USERS]),
+    KIND_GROUPS: attrgetter(*FIELDS[KIND_GROUPS]),
+    KIND_AUTH: auth_record,
+    KIND_MESSAGES: attrgetter(*FIELDS[KIND_MESSAGES]),
+}
+
+def user_record(*record) -> User:
+    return User.from_obj(dict(zip(FIELDS[KIND_USERS], record)))
+
+POSITIONAL_DECODERS: dict[str, Callable[..., Any]] = {
+    KIND_USERS: user_record,
+    KIND_GROUPS: Group,
+    KIND_AUTH: lambda *record: record,
+    KIND_MESSAGES: Message,
+}
+
+NAMED_DECODERS: dict[str, Callable[[dict], Any]] = {
+    KIND_USERS: User.from_obj,
+    KIND_GROUPS: Group.from_obj,
+    KIND_AUTH: lambda obj: (obj["email"], obj["hash"], obj["salt"]),
+    KIND_MESSAGES: lambda obj: Message.from_snapshot(obj["id"], obj),
+}
+
+def encode(kind: str, records: Iterable) -> bytes:
+    packer = msgpack.Packer(use_bin_type=True)
+    encoder = ENCODERS[kind]
+    chunks = [
+        MAGIC,
+        packer.pack({"version": FORMAT_VERSION, "kind": kind, "fields": list(FIELDS[kind])}),
+    ]
+    chunks.extend(packer.pack(encoder(record)) for record in records)
+    return b"".join(chunks)
+
+def is_legacy(location: str) -> bool:
+    with open(location, 'rb') as f:
+        return f.read(len(MAGIC)) != MAGIC
+
+def read_records(location: str, keys: Optional[set] = None) -> Iterator:
+    """Decodes the records of a file one by one, with keys only those whose key (their first field) is in it"""
+    with open(location, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{location} is not a snapshot file")
+        unpacker = msgpack.Unpacker(f, raw=False, use_list=True)
+        header = next(unpacker)
+        if header["version"] > FORMAT_VERSION:
+            raise ValueError(f"{location} was written by a newer version (format {header['version']})")
+        kind = header["kind"]
+        fields = tuple(header["fields"])
+        key = fields.index(FIELDS[kind][0])
+        if fields == FIELDS[kind]:
+            decoder = POSITIONAL_DECODERS[kind]
+            for record in unpacker:
+                if keys is None or record[key] in keys:
+                    yield decoder(*record)
+        else:
+            decoder = NAMED_DECODERS[kind]
+            for record in unpacker:
+                if keys is None or record[key] in keys:
+                    yield decoder(dict(zip(fields, record)))
+
+def __load_legacy(location: str):
+    with open(location, 'rb') as f:
+        return pickle.load(f)
+
+def load_users(location: str) -> dict[str, User]:
+    if is_legacy(location):
+        return __load_legacy(location)
+    return dict((user.id, user) for user in read_records(location))
+
+def load_groups(location: str) -> dict[str, Group]:
+    if is_legacy(location):
+        return __load_legacy(location)
+    return dict((group.id, group) for group in read_records(location))
+
+def load_auth(location: str) -> dict[str, tuple[bytes, str]]:
+    if is_legacy(location):
+        return __load_legacy(location)
+    return dict((email, (password_hash, salt)) for email, password_hash, salt in read_records(location))
+
+def load_messages(location: str, message_ids: Optional[set[str]] = None) -> dict[str, Message]:
+    """Messages of a shard, with message_ids only those, the others are skipped without being decoded"""
+    if is_legacy(location):
+        messages = __load_legacy(location)
+        if message_ids is None:
+            return messages
+        return dict((message_id, messages[message_id]) for message_id in message_ids if message_id in messages)
+    return dict((message.id, message) for message in read_records(location, message_ids))
+
+def dump_users(users: dict[str, User]) -> bytes:
+    return encode(KIND_USERS, users.values())
+
+def dump_groups(groups: dict[str, Group]) -> bytes:
+    return encode(KIND_GROUPS, groups.values())
+
+def dump_auth(auth: dict[str, tuple[bytes, str]]) -> bytes:
+    return encode(KIND_AUTH, auth.items())
+
+def dump_messages(messages: dict[str, Message]) -> bytes:
+    return encode(KIND_MESSAGES, messages.values())
+
+def migrate_file(location: str, load: Callable[[str], dict], dump: Callable[[dict], bytes]) -> bool:
+    """Rewrites a pickle file in the current format, keeping the original as location + ".pickle" """
+    if not exists(location) or not is_legacy(location):
+        return False
+    data = load(location)
+    copyfile(location, location + ".pickle")
+    write_atomically(location, dump(data))
+    return True
+
+def migrate(directory: str, messages_directory: str = "messages") -> int:
+    """Converts every pickle snapshot of a FileDatabase directory, returns the number of files converted"""
+    converted = 0
+    converted += migrate_file(join(directory, "users.dat"), load_users, dump_users)
+    converted += migrate_file(join(directory, "groups.dat"), load_groups, dump_groups)
+    converted += migrate_file(join(directory, "auth.dat"), load_auth, dump_auth)
+    shards = join(directory, messages_directory)
+    if isdir(shards):
+        for name in listdir(shards):
+            if name.endswith(".dat"):
+                converted += migrate_file(join(shards, name), load_messages, dump_messages)
+    return converted
+
+
+if __name__ == '__main__':
+    print(f"Converted {migrate(sys.argv[1])} files")
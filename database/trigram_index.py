@@ -0,0 +1,52 @@
+from typing import Optional
+
+TRIGRAM_LENGTH = 3
+
+def trigrams(text: str) -> set[str]:
+    return set(text[i:i + TRIGRAM_LENGTH] for i in range(len(text) - TRIGRAM_LENGTH + 1))
+
+class TrigramIndex:
+    """Keys by the trigrams of their text, a substring query only has to verify the keys sharing its rarest trigram"""
+    postings: dict[str, set[str]]
+    texts: dict[str, str]
+
+    def __init__(self):
+        self.postings = {}
+        self.texts = {}
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def add(self, key: str, text: str):
+        if key in self.texts:
+            self.remove(key)
+        self.texts[key] = text
+        for trigram in trigrams(text):
+            self.postings.setdefault(trigram, set()).add(key)
+
+    def remove(self, key: str):
+        text = self.texts.pop(key, None)
+        if text is None:
+            return
+        for trigram in trigrams(text):
+            keys = self.postings[trigram]
+            keys.discard(key)
+            if len(keys) == 0:
+                del self.postings[trigram]
+
+    def rarest(self, query: str) -> Optional[set[str]]:
+        """
+        Keys sharing the least common trigram of query, a superset of the keys containing query.
+        None when query is too short to narrow anything down
+        """
+        query_trigrams = trigrams(query)
+        if len(query_trigrams) == 0:
+            return None
+        rarest = None
+        for trigram in query_trigrams:
+            keys = self.postings.get(trigram)
+            if keys is None:
+                return set()
+            if rarest is None or len(keys) < len(rarest):
+                rarest = keys
+        return rarest
@@ -1,7 +1,20 @@
 from typing import Optional
 from uuid import uuid4
 
-class User:
+from database.slotted import Slotted
+
+class User(Slotted):
+    __slots__ = (
+        "id",
+        "email",
+        "is_verified_email",
+        "name",
+        "profile_picture",
+        "group_ids",
+        "interacted_group_ids",
+        "pinned_group_ids",
+        "requests",
+    )
     id: str
     email: str
     is_verified_email: bool
@@ -38,6 +51,21 @@ class User:
             "requests": self.requests
         }
 
+    @staticmethod
+    def from_obj(obj: dict) -> "User":
+        # Skips __init__, which would generate an id only to throw it away
+        self = User.__new__(User)
+        self.id = obj["id"]
+        self.name = obj["name"]
+        self.email = obj["email"]
+        self.profile_picture = obj["profile_picture"]
+        self.is_verified_email = obj["is_verified_email"]
+        self.group_ids = obj["group_ids"]
+        self.interacted_group_ids = obj["interacted_group_ids"]
+        self.pinned_group_ids = obj["pinned_group_ids"]
+        self.requests = obj["requests"]
+        return self
+
     @staticmethod
     def get_columns():
         return [
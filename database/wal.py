@@ -0,0 +1,107 @@
+import pickle
+from os import fsync, remove, rename, SEEK_END
+from os.path import exists
+from shutil import copyfileobj
+from struct import Struct
+from threading import Lock
+from typing import Iterator
+
+# Every record is framed as <length><pickled tuple> so a torn write at the tail of the log can be detected and dropped
+RECORD_HEADER = Struct("<I")
+
+def read_segment(location: str) -> Iterator[tuple]:
+    if not exists(location):
+        return
+    valid_offset = 0
+    with open(location, 'r+b') as f:
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            (length,) = RECORD_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                break
+            try:
+                record = pickle.loads(payload)
+            except Exception as e:
+                print(e)
+                break
+            valid_offset = f.tell()
+            yield record
+
+        # Drop whatever was half written when the process died, so new records are not appended after garbage
+        f.truncate(valid_offset)
+
+class WriteAheadLog:
+    """
+    Append only record log, a checkpoint rotates the current segment out (location + ".old") and discards it
+    once the snapshot it belongs to is on disk
+    """
+    location: str
+    rotated_location: str
+    pending: int
+    bytes_written: int
+
+    def __init__(self, location: str):
+        self.location = location
+        self.rotated_location = location + ".old"
+        self.pending = 0
+        self.bytes_written = 0
+        self.lock = Lock()
+        self.file = open(location, 'ab')
+
+    def append(self, record: tuple):
+        payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.file.write(RECORD_HEADER.pack(len(payload)))
+            self.file.write(payload)
+            self.pending += 1
+            self.bytes_written += RECORD_HEADER.size + len(payload)
+
+    def flush(self) -> bool:
+        with self.lock:
+            if self.pending == 0:
+                return False
+            self.file.flush()
+            fsync(self.file.fileno())
+            self.pending = 0
+            return True
+
+    def replay(self) -> Iterator[tuple]:
+        yield from read_segment(self.rotated_location)
+        yield from read_segment(self.location)
+        with self.lock:
+            self.file.seek(0, SEEK_END)
+
+    def size(self) -> int:
+        with self.lock:
+            return self.file.tell()
+
+    def rotate(self):
+        """Moves every record so far into the rotated segment and starts an empty one"""
+        with self.lock:
+            self.file.flush()
+            fsync(self.file.fileno())
+            self.file.close()
+            if exists(self.rotated_location):
+                # The previous checkpoint never finished, its records are still needed
+                with open(self.location, 'rb') as source, open(self.rotated_location, 'ab') as destination:
+                    copyfileobj(source, destination)
+                    destination.flush()
+                    fsync(destination.fileno())
+                remove(self.location)
+            else:
+                rename(self.location, self.rotated_location)
+            self.file = open(self.location, 'ab')
+            self.pending = 0
+
+    def discard_rotated(self):
+        with self.lock:
+            if exists(self.rotated_location):
+                remove(self.rotated_location)
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.file.close()
@@ -11,6 +11,9 @@ GROUP_COLLECTION = "group_data"
 def message_path(group_id: str):
     return f"messages/{group_id}"
 
+def message_counter_path(group_id: str):
+    return f"message_counters/{group_id}"
+
 config_app = {
     "apiKey": getenv("API_KEY"),
     "authDomain": getenv("AUTH_DOMAIN"),
@@ -20,4 +23,11 @@ config_app = {
     "appId": getenv("APP_ID"),
     "measurementId": getenv("MEASUREMENT_ID"),
 }
-config = credentials.Certificate("firebase_creds.json")
\ No newline at end of file
+def certificate() -> credentials.Certificate:
+    return credentials.Certificate("firebase_creds.json")
+
+def __getattr__(name: str):
+    # config is read on first use, so modules importing this one load without firebase_creds.json as the tests do
+    if name == "config":
+        return certificate()
+    raise AttributeError(name)
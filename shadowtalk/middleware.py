@@ -1,5 +1,6 @@
 import json
 import pickle
+from functools import partial
 
 from django.conf.global_settings import SESSION_COOKIE_NAME
 from django.utils.deprecation import MiddlewareMixin
@@ -7,10 +8,18 @@ from firebase_admin import auth
 from types import SimpleNamespace as Blank
 
 from database.cookie import Cookie
+from database.FirebaseDatabase import request_access
+
+async def current_user(request):
+    return request.user
 
 
 class FirebaseAuthMiddleware(MiddlewareMixin):
     def process_request(self, request):
+        # Group roles read while serving this request are reused by later access checks of the same request
+        request_access.set({})
+        # login_required awaits request.auser() on async views, which AuthenticationMiddleware points at Django's users
+        request.auser = partial(current_user, request)
         session_cookie = request.COOKIES.get(SESSION_COOKIE_NAME)
 
         # Hack around
@@ -32,8 +41,14 @@ class FirebaseAuthMiddleware(MiddlewareMixin):
             request.user.is_authenticated = False
         return None
 
+    def process_response(self, request, response):
+        request_access.set(None)
+        return response
+
 class FileAuthMiddleware(MiddlewareMixin):
     def process_request(self, request):
+        # login_required awaits request.auser() on async views, which AuthenticationMiddleware points at Django's users
+        request.auser = partial(current_user, request)
         session_cookie = request.COOKIES.get(SESSION_COOKIE_NAME)
 
         # Hack around
@@ -0,0 +1,248 @@
+import json
+import sqlite3
+from os.path import join
+from tempfile import TemporaryDirectory
+
+from django.test import TestCase
+
+from database.Interop import DatabaseInterop
+from database.SQLiteDatabase import SQLiteDatabase
+from database.cookie import Cookie
+from tests.test_file_database import open_database
+
+
+class DatabaseBehavior:
+    """Behaviour every DatabaseInterop backend has to share, subclasses provide open()"""
+    database: DatabaseInterop
+
+    def open(self, directory: str) -> DatabaseInterop:
+        raise NotImplementedError
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.database = self.open(self.directory.name)
+
+    def tearDown(self):
+        self.database.deinit()
+        self.directory.cleanup()
+
+    def create_user(self, email: str, name: str) -> Cookie:
+        token = self.database.user_create(email, name, "password")
+        return Cookie(json.loads(token)["uid"], email, name)
+
+    def test_login(self):
+        self.create_user("john@doe.com", "John")
+        self.assertTrue(self.database.user_exists_email("john@doe.com"))
+        self.assertFalse(self.database.user_exists_email("jane@doe.com"))
+        self.assertIsNotNone(self.database.user_login("john@doe.com", "password"))
+        self.assertIsNone(self.database.user_login("john@doe.com", "wrong password"))
+
+    def test_taken_email_is_rejected(self):
+        john = self.create_user("john@doe.com", "John")
+        self.assertIsNone(self.database.user_create("john@doe.com", "Impostor", "password"))
+        self.assertEqual(self.database.user_get(john).name, "John")
+        self.assertEqual(json.loads(self.database.user_login("john@doe.com", "password"))["uid"], john.id)
+
+    def test_change_email(self):
+        john = self.create_user("john@doe.com", "John")
+        self.create_user("jane@doe.com", "Jane")
+        self.assertFalse(self.database.user_change_email(john, "jane@doe.com"))
+        self.assertTrue(self.database.user_change_email(john, "johnny@doe.com"))
+        self.assertFalse(self.database.user_exists_email("john@doe.com"))
+        self.assertIsNotNone(self.database.user_login("johnny@doe.com", "password"))
+        self.assertEqual(self.database.user_get(john).email, "johnny@doe.com")
+
+    def test_group_membership(self):
+        john = self.create_user("john@doe.com", "John")
+        jane = self.create_user("jane@doe.com", "Jane")
+        group = self.database.group_private_create("Chat", john.id)
+
+        self.assertEqual(self.database.user_has_group_access(john.id, group.id), "admin")
+        self.assertEqual(self.database.user_has_group_access(jane.id, group.id), "none")
+        self.assertIsNone(self.database.group_get(jane, group.id))
+
+        self.assertTrue(self.database.user_join_group(jane, group.id))
+        self.assertFalse(self.database.user_join_group(jane, group.id))
+        self.assertTrue(self.database.user_admin_promote_group(jane, group.id))
+        self.assertFalse(self.database.user_admin_promote_group(jane, group.id))
+        self.assertEqual(self.database.group_get(jane, group.id).admin_ids, [john.id, jane.id])
+        self.assertTrue(self.database.user_admin_demote_group(jane, group.id))
+        self.assertEqual(self.database.group_get(jane, group.id).member_ids, [jane.id])
+
+        self.assertTrue(self.database.user_leave_group(jane, group.id, False))
+        self.assertEqual(self.database.user_has_group_access(jane.id, group.id), "none")
+        self.assertEqual([group.id for group in self.database.user_groups_get(john, "")], [group.id])
+
+    def test_group_rename_and_search(self):
+        john = self.create_user("john@doe.com", "John")
+        group = self.database.group_private_create("Chat", john.id)
+        self.database.group_private_create("Work", john.id)
+        self.assertTrue(self.database.group_rename(john, group.id, "Family chat"))
+        self.assertEqual([group.name for group in self.database.group_search(john, "chat")], ["Family chat"])
+
+    def test_group_delete(self):
+        john = self.create_user("john@doe.com", "John")
+        jane = self.create_user("jane@doe.com", "Jane")
+        group = self.database.group_contact_create(john.id, "John", jane.id, "Jane")
+        self.assertTrue(self.database.message_send(john, group.id, "hello", False, None, None))
+
+        self.assertTrue(self.database.group_delete(jane, group.id))
+        self.assertIsNone(self.database.group_get(john, group.id))
+        self.assertEqual(self.database.user_groups_get(john, ""), [])
+        self.assertEqual(self.database.message_get(john, group.id, None, 10), [])
+
+    def test_message_pagination(self):
+        john = self.create_user("john@doe.com", "John")
+        group = self.database.group_private_create("Chat", john.id)
+        for i in range(10):
+            self.assertTrue(self.database.message_send(john, group.id, str(i), False, None, None))
+
+        newest = self.database.message_get(john, group.id, None, 3)
+        self.assertEqual([message.content for message in newest], ["7", "8", "9"])
+        older = self.database.message_get(john, group.id, newest[0].id, 3)
+        self.assertEqual([message.content for message in older], ["4", "5", "6"])
+        newer = self.database.message_get(john, group.id, older[-1].id, 2, after=True)
+        self.assertEqual([message.content for message in newer], ["7", "8"])
+        oldest = self.database.message_get(john, group.id, None, 2, after=True)
+        self.assertEqual([message.content for message in oldest], ["0", "1"])
+        self.assertEqual(self.database.group_get(john, group.id).last_message_content, "9")
+
+    def test_message_edit_and_delete(self):
+        john = self.create_user("john@doe.com", "John")
+        jane = self.create_user("jane@doe.com", "Jane")
+        group = self.database.group_private_create("Chat", john.id)
+        self.database.user_join_group(jane, group.id)
+        self.database.message_send(jane, group.id, "hello", False, None, None)
+        (message,) = self.database.message_get(jane, group.id, None, 1)
+
+        self.assertFalse(self.database.message_edit(john, group.id, message.id, "changed"))
+        self.assertTrue(self.database.message_edit(jane, group.id, message.id, "hi"))
+        self.assertEqual(self.database.message_get_with_id(john, group.id, message.id).content, "hi")
+        # Admins may delete anybody's message
+        self.assertTrue(self.database.message_delete(john, group.id, message.id))
+        self.assertIsNone(self.database.message_get_with_id(jane, group.id, message.id))
+
+    def test_wipe_messages(self):
+        john = self.create_user("john@doe.com", "John")
+        jane = self.create_user("jane@doe.com", "Jane")
+        group = self.database.group_contact_create(john.id, "John", jane.id, "Jane")
+        for author in (john, jane, john):
+            self.database.message_send(author, group.id, author.name, False, None, None)
+
+        self.assertEqual(
+            [message.author_name for message in self.database.message_get_by_author(jane, group.id, john.id)],
+            ["John", "John"]
+        )
+        self.assertTrue(self.database.user_wipe_all_messages(john))
+        self.assertEqual(self.database.message_get_by_author(jane, group.id, john.id), [])
+        self.assertEqual(
+            [message.author_name for message in self.database.message_get(jane, group.id, None, 10)],
+            ["Jane"]
+        )
+
+    def test_message_search(self):
+        john = self.create_user("john@doe.com", "John")
+        jane = self.create_user("jane@doe.com", "Jane")
+        group = self.database.group_private_create("Chat", john.id)
+        other = self.database.group_private_create("Work", jane.id)
+        self.database.message_send(john, group.id, "see you at lunch", False, None, None)
+        self.database.message_send(john, group.id, "lunch lunch", False, None, None)
+        self.database.message_send(john, group.id, "no lunch today, sorry", False, None, None)
+        self.database.message_send(jane, other.id, "lunch", False, None, None)
+
+        results = self.database.message_search(john, "Lunch")
+        self.assertEqual(set(group_id for group_id, _ in results), {group.id})
+        self.assertEqual(results[0][1].content, "lunch lunch")
+        self.assertEqual(
+            [message.content for _, message in self.database.message_search(john, "lunch sorry")],
+            ["no lunch today, sorry"]
+        )
+        self.assertEqual(len(self.database.message_search(john, "lunch", 1, 2)), 1)
+        self.assertEqual(self.database.message_search(john, ""), [])
+
+    def test_batch_apis(self):
+        john = self.create_user("john@doe.com", "John")
+        jane = self.create_user("jane@doe.com", "Jane")
+        mine = self.database.group_private_create("Mine", john.id)
+        theirs = self.database.group_private_create("Theirs", jane.id)
+
+        users = self.database.user_public_get_many([jane.id, "missing", john.id])
+        self.assertEqual([user.name if user is not None else None for user in users], ["Jane", None, "John"])
+        groups = self.database.group_get_many(john, [theirs.id, mine.id, "missing"])
+        self.assertEqual([group.name if group is not None else None for group in groups], [None, "Mine", None])
+
+        self.assertTrue(self.database.message_send(john, mine.id, "first", False, None, None))
+        self.assertTrue(self.database.message_send_many(john, mine.id, [
+            ("second", False, None, None),
+            ("third", True, "John", "second"),
+        ]))
+        self.assertFalse(self.database.message_send_many(john, theirs.id, [("nope", False, None, None)]))
+        messages = self.database.message_get(john, mine.id, None, 10)
+        self.assertEqual([message.content for message in messages], ["first", "second", "third"])
+        self.assertEqual([message.index for message in messages], [1, 2, 3])
+        self.assertEqual(messages[2].reply_to_content, "second")
+        self.assertEqual(self.database.group_get(john, mine.id).last_message_content, "third")
+        self.assertEqual(self.database.message_get(jane, theirs.id, None, 10), [])
+
+    def test_requests(self):
+        john = self.create_user("john@doe.com", "John")
+        jane = self.create_user("jane@doe.com", "Jane")
+        self.assertTrue(self.database.request_send(john, jane.id))
+        self.assertTrue(self.database.request_exists(john, jane.id))
+        self.assertEqual(self.database.request_get(jane), [john.id])
+        self.assertTrue(self.database.request_cancel(john, jane.id))
+        self.assertFalse(self.database.request_exists(john, jane.id))
+
+
+class FileDatabaseBehaviorTest(DatabaseBehavior, TestCase):
+    def open(self, directory: str) -> DatabaseInterop:
+        return open_database(directory)
+
+    def tearDown(self):
+        self.database.deinit()
+        self.database.log.close()
+        self.directory.cleanup()
+
+
+class SQLiteDatabaseBehaviorTest(DatabaseBehavior, TestCase):
+    def open(self, directory: str) -> DatabaseInterop:
+        return SQLiteDatabase(join(directory, "shadowtalk.sqlite3"))
+
+    def test_shared_between_connections(self):
+        john = self.create_user("john@doe.com", "John")
+        group = self.database.group_private_create("Chat", john.id)
+        other = self.open(self.directory.name)
+        self.assertTrue(other.message_send(john, group.id, "hello", False, None, None))
+        self.assertEqual(
+            [message.content for message in self.database.message_get(john, group.id, None, 1)],
+            ["hello"]
+        )
+        self.assertEqual(self.database.group_get(john, group.id).last_message_index, 1)
+
+    def test_search_survives_vacuum(self):
+        john = self.create_user("john@doe.com", "John")
+        group = self.database.group_private_create("Chat", john.id)
+        for content in ["first lunch", "second lunch", "third lunch", "dinner"]:
+            self.assertTrue(self.database.message_send(john, group.id, content, False, None, None))
+        messages = self.database.message_get(john, group.id, None, 10)
+        # Removing the oldest rows leaves a gap VACUUM would close by renumbering any rowid without an alias
+        self.assertTrue(self.database.message_delete(john, group.id, messages[0].id))
+        self.assertTrue(self.database.message_delete(john, group.id, messages[1].id))
+        connection = sqlite3.connect(join(self.directory.name, "shadowtalk.sqlite3"))
+        connection.execute("VACUUM")
+        # SQLite only promises to keep rowids which alias an INTEGER PRIMARY KEY, and the content is not stored twice
+        self.assertIn("row_id", [row[1] for row in connection.execute("PRAGMA table_info(messages)")])
+        tables = [row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        self.assertNotIn("message_text_content", tables)
+        connection.close()
+
+        self.assertEqual(
+            [message.content for _, message in self.database.message_search(john, "lunch")],
+            ["third lunch"]
+        )
+        self.assertTrue(self.database.message_edit(john, group.id, messages[3].id, "lunch after all"))
+        self.assertCountEqual(
+            [message.content for _, message in self.database.message_search(john, "lunch")],
+            ["third lunch", "lunch after all"]
+        )
+        self.assertEqual(self.database.message_search(john, "dinner"), [])
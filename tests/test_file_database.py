@@ -0,0 +1,1048 @@
+import asyncio
+import json
+import pickle
+from os import listdir, remove
+from os.path import join, getsize, exists
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
+from time import perf_counter, sleep
+from typing import Optional
+from unittest.mock import patch
+
+import msgpack
+from django.test import TestCase
+
+from database import storage
+from database.AsyncInterop import ExecutorDatabase
+from database.CachedDatabase import CachedDatabase
+from database.FileDatabase import FileDatabase
+from database.InstrumentedDatabase import InstrumentedDatabase
+from database.Interop import DatabaseInterop
+from database.files import write_atomically
+from database.cookie import Cookie
+from database.group import Group
+from database.message import Message
+from database.metrics import labelled
+from database.message_search import MessageSearchIndex
+from database.password_hasher import PasswordHasher, HasherBusy
+from database.user import User
+
+
+def open_database(directory: str, **kwargs) -> FileDatabase:
+    return FileDatabase(
+        join(directory, "users.dat"),
+        join(directory, "groups.dat"),
+        join(directory, "messages"),
+        join(directory, "auth.dat"),
+        join(directory, "journal.log"),
+        **kwargs
+    )
+
+def create_user(database: FileDatabase, email: str, name: str) -> Cookie:
+    database.user_create(email, name, "password")
+    user_id = next(user.id for user in database.users.values() if user.email == email)
+    return Cookie(user_id, email, name)
+
+
+class WriteAheadLogTest(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_replay_restores_mutations(self):
+        database = open_database(self.directory.name)
+        john = create_user(database, "john@doe.com", "John")
+        group = database.group_private_create("Chat", john.id)
+        self.assertTrue(database.message_send(john, group.id, "hello", False, None, None))
+        self.assertTrue(database.group_rename(john, group.id, "Renamed"))
+        database.deinit()
+        database.log.close()
+
+        database = open_database(self.directory.name)
+        self.assertEqual(database.groups[group.id].name, "Renamed")
+        self.assertEqual(database.users[john.id].group_ids, [group.id])
+        self.assertEqual(
+            [message.content for message in database.messages[group.id].values()],
+            ["hello"]
+        )
+        self.assertTrue(database.user_authenticate("john@doe.com", "password"))
+
+    def test_request_only_appends_what_changed(self):
+        database = open_database(self.directory.name)
+        john = create_user(database, "john@doe.com", "John")
+        group = database.group_private_create("Chat", john.id)
+        database.checkpoint()
+        shard_location = database.messages.shard_location(group.id)
+        snapshot_size = getsize(shard_location)
+
+        database.message_send(john, group.id, "hello", False, None, None)
+        database.deinit()
+        self.assertEqual(getsize(shard_location), snapshot_size)
+        self.assertGreater(database.log.size(), 0)
+
+    def test_records_do_not_grow_with_the_group(self):
+        database = open_database(self.directory.name)
+        john = create_user(database, "john@doe.com", "John")
+        jerry = create_user(database, "jerry@doe.com", "Jerry")
+        group = database.group_private_create("Chat", john.id)
+        database.groups[group.id].member_ids.extend(f"member {i}" for i in range(20_000))
+
+        for mutation in [
+            lambda: database.message_send(john, group.id, "hi", False, None, None),
+            lambda: database.user_join_group(jerry, group.id),
+            lambda: database.user_pin_group(jerry, group.id),
+            lambda: database.user_admin_promote_group(jerry, group.id),
+            lambda: database.user_leave_group(jerry, group.id, False),
+        ]:
+            written = database.log.bytes_written
+            self.assertTrue(mutation())
+            self.assertLess(database.log.bytes_written - written, 1024)
+        database.log.close()
+
+    def test_narrow_records_are_replayed(self):
+        database = open_database(self.directory.name)
+        john = create_user(database, "john@doe.com", "John")
+        jerry = create_user(database, "jerry@doe.com", "Jerry")
+        group = database.group_private_create("Chat", john.id)
+        other = database.group_private_create("Other", john.id)
+        database.checkpoint()
+        self.assertTrue(database.user_join_group(jerry, group.id))
+        self.assertTrue(database.user_join_group(jerry, other.id))
+        self.assertTrue(database.user_pin_group(jerry, group.id))
+        self.assertTrue(database.user_admin_promote_group(jerry, group.id))
+        self.assertTrue(database.message_send(jerry, group.id, "hello", False, None, None))
+        self.assertTrue(database.user_leave_group(jerry, other.id, False))
+        self.assertTrue(database.group_delete(john, other.id))
+        self.assertTrue(database.group_rename(john, group.id, "Renamed"))
+        expected_group = database.groups[group.id].to_obj()
+        expected_users = {user_id: user.to_obj() for user_id, user in database.users.items()}
+        database.deinit()
+        database.log.close()
+
+        database = open_database(self.directory.name)
+        self.assertEqual(database.groups[group.id].to_obj(), expected_group)
+        self.assertEqual({user_id: user.to_obj() for user_id, user in database.users.items()}, expected_users)
+        self.assertEqual(database.groups[group.id].last_message_content, "hello")
+        self.assertEqual(database.users[jerry.id].pinned_group_ids, [group.id])
+        self.assertEqual(database.user_has_group_access(jerry.id, group.id), "admin")
+        database.log.close()
+
+    def test_checkpoint_compacts_log(self):
+        database = open_database(self.directory.name, checkpoint_bytes=1)
+        john = create_user(database, "john@doe.com", "John")
+        database.group_private_create("Chat", john.id)
+        database.deinit()
+        self.assertEqual(database.log.size(), 0)
+        database.log.close()
+
+        database = open_database(self.directory.name)
+        self.assertEqual(len(database.groups), 1)
+
+    def test_failed_checkpoint_keeps_the_log(self):
+        database = open_database(self.directory.name)
+        database.checkpoint()
+        john = create_user(database, "john@doe.com", "John")
+        group = database.group_private_create("Chat", john.id)
+        self.assertTrue(database.message_send(john, group.id, "hello", False, None, None))
+
+        def failing(location: str, data: bytes):
+            if location.endswith("users.dat"):
+                raise OSError("disk full")
+            write_atomically(location, data)
+        with patch("database.FileDatabase.write_atomically", failing):
+            with self.assertRaises(OSError):
+                database.checkpoint()
+        self.assertIn("users", database.dirty_stores)
+        # What the failed checkpoint left unwritten is written by the next one before the log is discarded
+        database.checkpoint()
+        database.log.close()
+
+        database = open_database(self.directory.name)
+        self.assertTrue(database.user_authenticate("john@doe.com", "password"))
+        self.assertEqual(database.users[john.id].group_ids, [group.id])
+        self.assertEqual([message.content for message in database.messages[group.id].values()], ["hello"])
+        database.log.close()
+
+    def test_torn_tail_is_dropped(self):
+        database = open_database(self.directory.name)
+        john = create_user(database, "john@doe.com", "John")
+        database.deinit()
+        database.log.close()
+        with open(join(self.directory.name, "journal.log"), 'ab') as f:
+            f.write(b"\xff\x00\x00\x00partial")
+
+        database = open_database(self.directory.name)
+        self.assertTrue(database.user_exists(john.id))
+        database.group_private_create("Chat", john.id)
+        database.deinit()
+        database.log.close()
+
+        database = open_database(self.directory.name)
+        self.assertEqual(len(database.groups), 1)
+
+
+class DirtyTrackingTest(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.database = open_database(self.directory.name, checkpoint_bytes=1)
+        self.john = create_user(self.database, "john@doe.com", "John")
+        self.group = self.database.group_private_create("Chat", self.john.id)
+        self.database.deinit()
+
+    def tearDown(self):
+        self.database.log.close()
+        self.directory.cleanup()
+
+    def test_read_only_flush_is_skipped(self):
+        performed = self.database.flushes_performed
+        self.database.group_search(self.john, "")
+        self.database.user_get(self.john)
+        self.database.deinit()
+
+        self.assertEqual(self.database.flushes_performed, performed)
+        self.assertEqual(self.database.flushes_skipped, 1)
+        self.assertEqual(self.database.log.size(), 0)
+
+    def test_checkpoint_only_writes_dirty_stores(self):
+        remove(join(self.directory.name, "users.dat"))
+        remove(join(self.directory.name, "auth.dat"))
+
+        self.database.group_rename(self.john, self.group.id, "Renamed")
+        self.assertEqual(self.database.dirty_stores, {"groups"})
+        self.database.deinit()
+
+        self.assertFalse(exists(join(self.directory.name, "users.dat")))
+        self.assertFalse(exists(join(self.directory.name, "auth.dat")))
+        self.assertEqual(self.database.dirty_stores, set())
+
+    def test_message_mutation_marks_group(self):
+        self.database.message_send(self.john, self.group.id, "hello", False, None, None)
+        self.assertEqual(self.database.messages.dirty, {self.group.id})
+
+
+class EmailIndexTest(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.database = open_database(self.directory.name)
+        self.john = create_user(self.database, "john@doe.com", "John")
+
+    def tearDown(self):
+        self.database.log.close()
+        self.directory.cleanup()
+
+    def test_change_email_updates_index(self):
+        self.assertTrue(self.database.user_change_email(self.john, "johnny@doe.com"))
+        self.assertFalse(self.database.user_exists_email("john@doe.com"))
+        self.assertTrue(self.database.user_exists_email("johnny@doe.com"))
+        self.assertIsNotNone(self.database.user_login("johnny@doe.com", "password"))
+
+    def test_change_email_rejects_taken_email(self):
+        create_user(self.database, "jerry@doe.com", "Jerry")
+        self.assertFalse(self.database.user_change_email(self.john, "jerry@doe.com"))
+
+    def test_index_is_rebuilt_on_load(self):
+        self.database.user_change_email(self.john, "johnny@doe.com")
+        self.database.deinit()
+        self.database.log.close()
+
+        self.database = open_database(self.directory.name)
+        self.assertEqual(self.database.user_ids_by_email, {"johnny@doe.com": self.john.id})
+
+
+class MessagePaginationTest(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.database = open_database(self.directory.name)
+        self.john = create_user(self.database, "john@doe.com", "John")
+        self.group = self.database.group_private_create("Chat", self.john.id)
+        for i in range(10):
+            self.database.message_send(self.john, self.group.id, str(i), False, None, None)
+
+    def tearDown(self):
+        self.database.log.close()
+        self.directory.cleanup()
+
+    def contents(self, messages) -> list[str]:
+        return [message.content for message in messages]
+
+    def test_indexes_increase_per_group(self):
+        messages = self.database.message_get(self.john, self.group.id, None, 10)
+        self.assertEqual([message.index for message in messages], list(range(1, 11)))
+        self.assertEqual(self.database.groups[self.group.id].last_message_index, 10)
+
+    def test_latest_page_and_cursor(self):
+        latest = self.database.message_get(self.john, self.group.id, None, 3)
+        self.assertEqual(self.contents(latest), ["7", "8", "9"])
+
+        older = self.database.message_get(self.john, self.group.id, latest[0].id, 3)
+        self.assertEqual(self.contents(older), ["4", "5", "6"])
+
+        newer = self.database.message_get(self.john, self.group.id, older[-1].id, 2, after=True)
+        self.assertEqual(self.contents(newer), ["7", "8"])
+
+    def test_deleted_index_is_not_reused(self):
+        latest = self.database.message_get(self.john, self.group.id, None, 1)[0]
+        self.database.message_delete(self.john, self.group.id, latest.id)
+        self.database.message_send(self.john, self.group.id, "new", False, None, None)
+
+        messages = self.database.message_get(self.john, self.group.id, None, 2)
+        self.assertEqual(self.contents(messages), ["8", "new"])
+        self.assertEqual(messages[-1].index, 11)
+
+    def test_legacy_messages_are_numbered_on_load(self):
+        for message in self.database.messages[self.group.id].values():
+            message.index = 0
+        self.database.checkpoint()
+        self.database.log.close()
+
+        self.database = open_database(self.directory.name)
+        messages = self.database.message_get(self.john, self.group.id, None, 3)
+        self.assertEqual(self.contents(messages), ["7", "8", "9"])
+        self.assertEqual([message.index for message in messages], [8, 9, 10])
+
+
+class MessageShardingTest(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.database = open_database(self.directory.name, checkpoint_bytes=1, max_resident_messages=4)
+        self.john = create_user(self.database, "john@doe.com", "John")
+        self.groups = [self.database.group_private_create(f"Chat {i}", self.john.id) for i in range(3)]
+
+    def tearDown(self):
+        self.database.log.close()
+        self.directory.cleanup()
+
+    def send(self, group, amount: int):
+        for i in range(amount):
+            self.database.message_send(self.john, group.id, str(i), False, None, None)
+
+    def test_groups_are_loaded_on_first_access(self):
+        self.send(self.groups[0], 2)
+        self.send(self.groups[1], 2)
+        self.database.deinit()
+        self.database.log.close()
+
+        self.database = open_database(self.directory.name, max_resident_messages=4)
+        self.assertEqual(len(self.database.messages.resident), 0)
+        messages = self.database.message_get(self.john, self.groups[1].id, None, 10)
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(list(self.database.messages.resident.keys()), [self.groups[1].id])
+
+    def test_dirty_groups_stay_resident_until_saved(self):
+        self.send(self.groups[0], 3)
+        self.send(self.groups[1], 3)
+        self.assertIn(self.groups[0].id, self.database.messages.resident)
+        self.assertFalse(exists(self.database.messages.shard_location(self.groups[0].id)))
+
+        self.database.checkpoint()
+        self.assertNotIn(self.groups[0].id, self.database.messages.resident)
+        self.assertLessEqual(self.database.messages.resident_messages, 4)
+        self.assertEqual(len(storage.load_messages(self.database.messages.shard_location(self.groups[0].id))), 3)
+        self.assertEqual(len(self.database.message_get(self.john, self.groups[0].id, None, 10)), 3)
+
+    def test_legacy_messages_file_is_split(self):
+        self.send(self.groups[0], 2)
+        legacy = {self.groups[0].id: dict(self.database.messages[self.groups[0].id]), self.groups[1].id: {}}
+        self.database.checkpoint()
+        self.database.log.close()
+        remove(self.database.messages.shard_location(self.groups[0].id))
+        with open(join(self.directory.name, "messages.dat"), 'wb') as f:
+            pickle.dump(legacy, f)
+
+        self.database = open_database(self.directory.name)
+        self.assertEqual(len(self.database.message_get(self.john, self.groups[0].id, None, 10)), 2)
+        self.assertFalse(exists(join(self.directory.name, "messages.dat")))
+        self.assertTrue(exists(self.database.messages.shard_location(self.groups[1].id)))
+
+
+class MembershipIndexTest(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.database = open_database(self.directory.name)
+        self.john = create_user(self.database, "john@doe.com", "John")
+        self.jerry = create_user(self.database, "jerry@doe.com", "Jerry")
+        self.group = self.database.group_private_create("Chat", self.john.id)
+
+    def tearDown(self):
+        self.database.log.close()
+        self.directory.cleanup()
+
+    def test_roles_follow_membership_changes(self):
+        self.assertEqual(self.database.user_has_group_access(self.john.id, self.group.id), "admin")
+        self.assertEqual(self.database.user_has_group_access(self.jerry.id, self.group.id), "none")
+
+        self.assertTrue(self.database.user_join_group(self.jerry, self.group.id))
+        self.assertFalse(self.database.user_join_group(self.jerry, self.group.id))
+        self.assertEqual(self.database.user_has_group_access(self.jerry.id, self.group.id), "member")
+
+        self.assertTrue(self.database.user_admin_promote_group(self.jerry, self.group.id))
+        self.assertEqual(self.database.user_has_group_access(self.jerry.id, self.group.id), "admin")
+        self.assertEqual(self.database.groups[self.group.id].admin_ids, [self.john.id, self.jerry.id])
+        self.assertEqual(self.database.groups[self.group.id].member_ids, [])
+
+        self.assertTrue(self.database.user_admin_demote_group(self.jerry, self.group.id))
+        self.assertTrue(self.database.user_leave_group(self.jerry, self.group.id, False))
+        self.assertEqual(self.database.user_has_group_access(self.jerry.id, self.group.id), "none")
+        self.assertEqual(self.database.groups[self.group.id].member_ids, [])
+
+    def test_group_delete_clears_roles(self):
+        self.database.user_join_group(self.jerry, self.group.id)
+        self.assertTrue(self.database.group_delete(self.john, self.group.id))
+        self.assertEqual(self.database.user_has_group_access(self.john.id, self.group.id), "none")
+        self.assertEqual(self.database.users[self.jerry.id].group_ids, [])
+
+    def test_roles_are_rebuilt_on_load(self):
+        self.database.user_join_group(self.jerry, self.group.id)
+        self.database.deinit()
+        self.database.log.close()
+
+        self.database = open_database(self.directory.name)
+        self.assertEqual(
+            self.database.group_roles[self.group.id],
+            {self.john.id: "admin", self.jerry.id: "member"}
+        )
+
+
+class GroupSearchTest(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.database = open_database(self.directory.name)
+        self.john = create_user(self.database, "john@doe.com", "John")
+        self.jerry = create_user(self.database, "jerry@doe.com", "Jerry")
+        self.family = self.database.group_private_create("Family chat", self.john.id)
+        self.work = self.database.group_private_create("Work chat", self.john.id)
+        self.other = self.database.group_private_create("Family stuff", self.jerry.id)
+
+    def tearDown(self):
+        self.database.log.close()
+        self.directory.cleanup()
+
+    def search(self, cookie: Cookie, query: str) -> list[str]:
+        return [group.id for group in self.database.group_search(cookie, query)]
+
+    def test_only_the_users_groups_match(self):
+        self.assertEqual(self.search(self.john, "chat"), [self.family.id, self.work.id])
+        self.assertEqual(self.search(self.john, "Family"), [self.family.id])
+        self.assertEqual(self.search(self.john, "mily c"), [self.family.id])
+        self.assertEqual(self.search(self.john, "Fa"), [self.family.id])
+        self.assertEqual(self.search(self.john, ""), [self.family.id, self.work.id])
+        self.assertEqual(self.search(self.john, "family"), [])
+
+    def test_index_follows_renames_and_deletes(self):
+        self.assertTrue(self.database.group_rename(self.john, self.work.id, "Office"))
+        self.assertEqual(self.search(self.john, "chat"), [self.family.id])
+        self.assertEqual(self.search(self.john, "Offi"), [self.work.id])
+
+        self.assertTrue(self.database.group_delete(self.john, self.family.id))
+        self.assertEqual(self.search(self.john, "Family"), [])
+        self.assertEqual(self.database.group_names.rarest("Family"), {self.other.id})
+
+    def test_index_is_rebuilt_on_load(self):
+        self.database.group_rename(self.john, self.work.id, "Office")
+        self.database.deinit()
+        self.database.log.close()
+
+        self.database = open_database(self.directory.name)
+        self.assertEqual(self.search(self.john, "Office"), [self.work.id])
+        self.assertEqual(self.search(self.jerry, "Family"), [self.other.id])
+
+
+class MessageSearchTest(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.database = open_database(self.directory.name)
+        self.john = create_user(self.database, "john@doe.com", "John")
+        self.jerry = create_user(self.database, "jerry@doe.com", "Jerry")
+        self.group = self.database.group_private_create("Chat", self.john.id)
+        self.database.message_send(self.john, self.group.id, "lunch at noon?", False, None, None)
+        self.database.message_send(self.john, self.group.id, "Lunch lunch lunch", False, None, None)
+
+    def tearDown(self):
+        self.database.log.close()
+        self.directory.cleanup()
+
+    def search(self, cookie: Cookie, query: str) -> list[str]:
+        return [message.content for _, message in self.database.message_search(cookie, query)]
+
+    def test_index_follows_edits_deletes_and_wipes(self):
+        self.assertEqual(self.search(self.john, "LUNCH"), ["Lunch lunch lunch", "lunch at noon?"])
+        (_, message) = self.database.message_search(self.john, "noon")[0]
+
+        self.assertTrue(self.database.message_edit(self.john, self.group.id, message.id, "dinner at eight"))
+        self.assertEqual(self.search(self.john, "noon"), [])
+        self.assertEqual(self.search(self.john, "dinner eight"), ["dinner at eight"])
+
+        self.assertTrue(self.database.message_delete(self.john, self.group.id, message.id))
+        self.assertEqual(self.search(self.john, "dinner"), [])
+        self.database.user_wipe_all_group_messages(self.john, self.group.id)
+        self.assertEqual(self.search(self.john, "lunch"), [])
+
+    def test_other_groups_are_not_searched(self):
+        self.assertEqual(self.search(self.jerry, "lunch"), [])
+        self.database.user_join_group(self.jerry, self.group.id)
+        self.assertEqual(len(self.search(self.jerry, "lunch")), 2)
+
+    def test_index_is_persisted_with_its_shard(self):
+        self.database.checkpoint()
+        self.database.log.close()
+        location = self.database.messages.search_index_location(self.group.id)
+        self.assertTrue(exists(location))
+
+        self.database = open_database(self.directory.name)
+        self.assertEqual(len(self.search(self.john, "lunch")), 2)
+        self.assertNotIn(self.group.id, self.database.messages.dirty)
+
+    def test_cold_groups_are_searched_without_loading_them(self):
+        other = self.database.group_private_create("Other", self.john.id)
+        self.database.message_send(self.john, other.id, "lunch again", False, None, None)
+        self.database.checkpoint()
+        self.database.log.close()
+
+        self.database = open_database(self.directory.name)
+        self.database.message_get(self.john, other.id, None, 1)
+        shard_location = self.database.messages.shard_location(self.group.id)
+        with patch("builtins.open", wraps=open) as opened:
+            self.assertEqual(len(self.database.messages.search(self.group.id, ["lunch"])), 2)
+        self.assertNotIn(shard_location, [call.args[0] for call in opened.call_args_list])
+        self.assertCountEqual(self.search(self.john, "lunch"), ["Lunch lunch lunch", "lunch again", "lunch at noon?"])
+        self.assertEqual(self.search(self.john, "noon"), ["lunch at noon?"])
+        self.assertEqual(list(self.database.messages.resident.keys()), [other.id])
+        self.assertIn(self.group.id, self.database.messages.cached_search_indexes)
+
+    def test_stale_index_is_rebuilt(self):
+        self.database.checkpoint()
+        with open(self.database.messages.search_index_location(self.group.id), 'wb') as f:
+            pickle.dump(MessageSearchIndex(), f)
+        self.database.log.close()
+
+        self.database = open_database(self.directory.name)
+        self.assertEqual(len(self.search(self.john, "lunch")), 2)
+
+
+class PasswordHasherTest(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.hasher = PasswordHasher(workers=2, max_pending=2)
+        self.database = open_database(self.directory.name, hasher=self.hasher)
+
+    def tearDown(self):
+        self.database.log.close()
+        self.hasher.shutdown()
+        self.directory.cleanup()
+
+    def test_async_login(self):
+        token = asyncio.run(self.database.user_create_async("john@doe.com", "John", "password"))
+        self.assertIsNotNone(token)
+        self.assertEqual(asyncio.run(self.database.user_login_async("john@doe.com", "password")), token)
+        self.assertIsNone(asyncio.run(self.database.user_login_async("john@doe.com", "wrong password")))
+        self.assertFalse(asyncio.run(self.database.user_authenticate_async("jane@doe.com", "password")))
+        self.assertTrue(self.database.user_authenticate("john@doe.com", "password"))
+
+    def test_async_calls_wait_for_locks_off_the_event_loop(self):
+        self.database.user_create("john@doe.com", "John", "password")
+        locked = Event()
+
+        def checkpoint():
+            # Holds the lock as a checkpoint does while it encodes the stores
+            with self.database.mutation_lock.write():
+                locked.set()
+                sleep(0.3)
+
+        async def scenario() -> int:
+            ticks = 0
+
+            async def tick():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.01)
+                    ticks += 1
+
+            ticker = asyncio.create_task(tick())
+            Thread(target=checkpoint).start()
+            locked.wait()
+            self.assertIsNotNone(await self.database.user_create_async("jane@doe.com", "Jane", "password"))
+            ticker.cancel()
+            return ticks
+
+        self.assertGreater(asyncio.run(scenario()), 10)
+
+    def test_saturated_hasher_rejects_immediately(self):
+        self.database.user_create("john@doe.com", "John", "password")
+        for _ in range(2):
+            self.hasher.slots.acquire()
+        try:
+            with self.assertRaises(HasherBusy):
+                asyncio.run(self.database.user_login_async("john@doe.com", "password"))
+            self.assertFalse(self.database.user_authenticate("john@doe.com", "password"))
+            self.assertIsNone(self.database.user_create("jane@doe.com", "Jane", "password"))
+            self.assertEqual(self.hasher.rejected, 3)
+        finally:
+            for _ in range(2):
+                self.hasher.slots.release()
+        self.assertTrue(self.database.user_authenticate("john@doe.com", "password"))
+
+
+class AuthorIndexTest(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.database = open_database(self.directory.name)
+        self.john = create_user(self.database, "john@doe.com", "John")
+        self.jerry = create_user(self.database, "jerry@doe.com", "Jerry")
+        self.group = self.database.group_private_create("Chat", self.john.id)
+        self.database.user_join_group(self.jerry, self.group.id)
+        for i in range(30):
+            author = self.john if i % 3 == 0 else self.jerry
+            self.database.message_send(author, self.group.id, str(i), False, None, None)
+
+    def tearDown(self):
+        self.database.log.close()
+        self.directory.cleanup()
+
+    def contents(self, messages: list) -> list[str]:
+        return [message.content for message in messages]
+
+    def test_messages_by_author(self):
+        self.assertEqual(
+            self.contents(self.database.message_get_by_author(self.jerry, self.group.id, self.john.id)),
+            [str(i) for i in range(0, 30, 3)]
+        )
+        self.assertEqual(self.database.message_get_by_author(self.jerry, self.group.id, "nobody"), [])
+
+    def test_wipe_keeps_pagination_intact(self):
+        self.assertTrue(self.database.user_wipe_all_group_messages(self.jerry, self.group.id))
+        self.assertEqual(self.database.message_get_by_author(self.john, self.group.id, self.jerry.id), [])
+        self.assertEqual(len(self.database.messages.index(self.group.id)), 10)
+
+        newest = self.database.message_get(self.john, self.group.id, None, 4)
+        self.assertEqual(self.contents(newest), ["18", "21", "24", "27"])
+        older = self.database.message_get(self.john, self.group.id, newest[0].id, 4)
+        self.assertEqual(self.contents(older), ["6", "9", "12", "15"])
+        newer = self.database.message_get(self.john, self.group.id, older[0].id, 3, after=True)
+        self.assertEqual(self.contents(newer), ["9", "12", "15"])
+
+        self.database.message_send(self.jerry, self.group.id, "back", False, None, None)
+        self.assertEqual(self.contents(self.database.message_get(self.john, self.group.id, None, 2)), ["27", "back"])
+
+    def test_wipe_without_messages_logs_nothing(self):
+        stranger = create_user(self.database, "jane@doe.com", "Jane")
+        self.database.user_join_group(stranger, self.group.id)
+        self.database.checkpoint()
+        self.assertTrue(self.database.user_wipe_all_group_messages(stranger, self.group.id))
+        self.assertEqual(self.database.log.size(), 0)
+
+    def test_wipe_is_replayed(self):
+        self.database.user_wipe_all_group_messages(self.jerry, self.group.id)
+        self.database.deinit()
+        self.database.log.close()
+
+        self.database = open_database(self.directory.name)
+        self.assertEqual(
+            self.contents(self.database.message_get(self.john, self.group.id, None, 30)),
+            [str(i) for i in range(0, 30, 3)]
+        )
+
+
+class BackgroundCheckpointTest(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_deinit_hands_persisting_to_the_checkpointer(self):
+        database = open_database(self.directory.name, checkpoint_bytes=1, background_interval=60)
+        john = create_user(database, "john@doe.com", "John")
+        database.group_private_create("Chat", john.id)
+        database.deinit()
+        for _ in range(100):
+            if database.stats()["checkpoints_performed"] == 1:
+                break
+            sleep(0.05)
+        stats = database.stats()
+        self.assertEqual(stats["checkpoints_performed"], 1)
+        self.assertGreater(stats["last_checkpoint_size"], 0)
+        self.assertEqual(database.log.size(), 0)
+        database.close()
+        self.assertFalse(database.checkpointer.is_alive())
+
+        database = open_database(self.directory.name)
+        self.assertTrue(database.user_exists(john.id))
+        self.assertEqual(len(database.groups), 1)
+        database.log.close()
+
+    def test_close_persists_pending_records(self):
+        database = open_database(self.directory.name, background_interval=60)
+        john = create_user(database, "john@doe.com", "John")
+        database.close()
+
+        database = open_database(self.directory.name)
+        self.assertTrue(database.user_exists(john.id))
+        database.log.close()
+
+    def test_shards_are_written_outside_their_group_lock(self):
+        database = open_database(self.directory.name)
+        john = create_user(database, "john@doe.com", "John")
+        group = database.group_private_create("Chat", john.id)
+        database.message_send(john, group.id, "hello", False, None, None)
+        writing = Event()
+        written = Event()
+
+        def slow_write(location: str, data: bytes):
+            writing.set()
+            written.wait(5)
+            write_atomically(location, data)
+
+        with patch("database.message_store.write_atomically", slow_write):
+            checkpoint = Thread(target=database.checkpoint)
+            checkpoint.start()
+            self.assertTrue(writing.wait(5))
+            self.assertEqual(len(database.message_get(john, group.id, None, 10)), 1)
+            self.assertTrue(database.message_send(john, group.id, "again", False, None, None))
+            written.set()
+            checkpoint.join()
+        self.assertIn(group.id, database.messages.dirty)
+        database.checkpoint()
+        database.log.close()
+
+        database = open_database(self.directory.name)
+        self.assertEqual(len(database.message_get(john, group.id, None, 10)), 2)
+        database.log.close()
+
+    def test_snapshots_replace_files_atomically(self):
+        database = open_database(self.directory.name)
+        john = create_user(database, "john@doe.com", "John")
+        group = database.group_private_create("Chat", john.id)
+        database.message_send(john, group.id, "hello", False, None, None)
+        self.assertTrue(database.checkpoint())
+        database.log.close()
+
+        leftovers = [name for name in listdir(self.directory.name) if name.endswith(".tmp")]
+        leftovers += [name for name in listdir(join(self.directory.name, "messages")) if name.endswith(".tmp")]
+        self.assertEqual(leftovers, [])
+        self.assertGreater(database.stats()["last_checkpoint_duration"], 0)
+
+
+class StorageFormatTest(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def populate(self) -> tuple[Cookie, str]:
+        database = open_database(self.directory.name)
+        john = create_user(database, "john@doe.com", "John")
+        group = database.group_private_create("Chat", john.id)
+        database.message_send(john, group.id, "hello", False, None, None)
+        database.message_send(john, group.id, "world", False, "John", "hello")
+        self.assertTrue(database.checkpoint())
+        database.log.close()
+        return john, group.id
+
+    def assert_restored(self, john: Cookie, group_id: str):
+        database = open_database(self.directory.name)
+        self.assertEqual(database.users[john.id].group_ids, [group_id])
+        self.assertEqual(database.groups[group_id].name, "Chat")
+        self.assertTrue(database.user_authenticate("john@doe.com", "password"))
+        messages = database.message_get(john, group_id, None, 10)
+        self.assertEqual([message.content for message in messages], ["hello", "world"])
+        self.assertEqual([message.index for message in messages], [1, 2])
+        self.assertEqual(messages[1].reply_to_content, "hello")
+        database.log.close()
+
+    def test_snapshots_round_trip(self):
+        john, group_id = self.populate()
+        for name in ["users.dat", "groups.dat", "auth.dat", join("messages", f"{group_id}.dat")]:
+            self.assertFalse(storage.is_legacy(join(self.directory.name, name)))
+        self.assert_restored(john, group_id)
+
+    def test_records_are_read_by_name_when_fields_differ(self):
+        location = join(self.directory.name, "shard.dat")
+        message = {"id": "a", "content": "hello", "index": 3, "author_id": "x", "author_name": "X",
+                   "is_author_admin": False, "is_reply": False, "reply_to_user": None, "reply_to_content": None}
+        fields = list(message.keys())
+        with open(location, 'wb') as f:
+            f.write(storage.MAGIC)
+            f.write(msgpack.packb({"version": 1, "kind": storage.KIND_MESSAGES, "fields": fields}))
+            f.write(msgpack.packb([message[field] for field in fields]))
+        restored = storage.load_messages(location)["a"]
+        self.assertEqual((restored.index, restored.author_id, restored.content), (3, "x", "hello"))
+
+    def test_pickle_files_are_read_and_migrated(self):
+        john, group_id = self.populate()
+        database = open_database(self.directory.name)
+        shard = database.messages.shard_location(group_id)
+        legacy = [
+            (join(self.directory.name, "users.dat"), database.users),
+            (join(self.directory.name, "groups.dat"), database.groups),
+            (join(self.directory.name, "auth.dat"), database.auth),
+            (shard, dict(database.messages[group_id])),
+        ]
+        database.log.close()
+        for location, data in legacy:
+            with open(location, 'wb') as f:
+                pickle.dump(data, f)
+        self.assert_restored(john, group_id)
+
+        self.assertEqual(storage.migrate(self.directory.name), 4)
+        self.assertFalse(storage.is_legacy(shard))
+        self.assertTrue(exists(shard + ".pickle"))
+        self.assertEqual(storage.migrate(self.directory.name), 0)
+        self.assert_restored(john, group_id)
+
+
+class SlottedModelTest(TestCase):
+    def test_models_have_no_instance_dict(self):
+        for model in [Message.generate("a", "A", "hi", False, False), User("a@b.com", "A"), Group.generate("Chat")]:
+            self.assertFalse(hasattr(model, "__dict__"))
+            restored = pickle.loads(pickle.dumps(model))
+            self.assertEqual(restored.to_obj(), model.to_obj())
+
+    def test_author_fields_are_shared(self):
+        first = Message.generate("".join(["au", "thor"]), "".join(["Na", "me"]), "hi", False, False)
+        second = Message.generate("".join(["aut", "hor"]), "".join(["Nam", "e"]), "hi", False, False)
+        self.assertIs(first.author_id, second.author_id)
+        self.assertIs(first.author_name, second.author_name)
+
+    def test_pickles_from_before_slots_load(self):
+        message = Message.__new__(Message)
+        message.__setstate__({"id": "a", "index": 1, "content": "hi", "author_id": "x", "author_name": "X",
+                              "is_author_admin": False, "is_reply": False, "reply_to_user": None,
+                              "reply_to_content": None})
+        self.assertEqual((message.id, message.index, message.author_id), ("a", 1, "x"))
+
+
+class SlowDatabase(DatabaseInterop):
+    def group_get(self, cookie: Cookie, group_id: str) -> Optional[Group]:
+        sleep(0.2)
+        return None
+
+
+class ExecutorDatabaseTest(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_methods_match_the_wrapped_database(self):
+        database = open_database(self.directory.name)
+        async_database = ExecutorDatabase(database)
+
+        async def scenario():
+            token = await async_database.user_create("john@doe.com", "John", "password")
+            self.assertIsNotNone(token)
+            self.assertIsNotNone(await async_database.user_login("john@doe.com", "password"))
+            john = Cookie.from_dict(json.loads(token))
+            group = await async_database.group_private_create("Chat", john.id)
+            self.assertTrue(await async_database.message_send(john, group.id, "hello", False, None, None))
+            messages = await async_database.message_get(john, group.id, None, 10)
+            self.assertEqual([message.content for message in messages], ["hello"])
+            self.assertEqual([group.name for group in await async_database.group_search(john, "Ch")], ["Chat"])
+            await async_database.deinit()
+
+        asyncio.run(scenario())
+        database.log.close()
+
+    def test_blocking_calls_overlap(self):
+        async_database = ExecutorDatabase(SlowDatabase())
+        cookie = Cookie("john", "john@doe.com", "John")
+
+        async def scenario():
+            await asyncio.gather(*[async_database.group_get(cookie, "group") for _ in range(5)])
+
+        start = perf_counter()
+        asyncio.run(scenario())
+        self.assertLess(perf_counter() - start, 0.6)
+
+
+class FailingDatabase(DatabaseInterop):
+    def group_get(self, cookie: Cookie, group_id: str) -> Optional[Group]:
+        raise ConnectionError("unreachable")
+
+
+class InstrumentedDatabaseTest(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_calls_are_timed_per_method(self):
+        database = InstrumentedDatabase(open_database(self.directory.name, checkpoint_bytes=1))
+        john = create_user(database, "john@doe.com", "John")
+        group = database.group_private_create("Chat", john.id)
+        for _ in range(3):
+            self.assertTrue(database.message_send(john, group.id, "hello", False, None, None))
+        database.deinit()
+
+        self.assertEqual(database.calls["message_send"].count, 3)
+        self.assertIsNotNone(database.is_valid_password("short"))
+        metrics = database.metrics()
+        self.assertIn('shadowtalk_database_call_duration_seconds_count{method="message_send"} 3', metrics)
+        self.assertIn('shadowtalk_database_call_duration_seconds_bucket{method="message_send",le="+Inf"} 3', metrics)
+        self.assertIn("shadowtalk_database_persistence_checkpoints_performed 1", metrics)
+        self.assertIn("# TYPE shadowtalk_database_persistence_log_bytes_written counter", metrics)
+        self.assertIn('shadowtalk_database_calls_total{method="message_send"} 3', metrics)
+        database.close()
+
+    def test_cache_stats_are_labelled(self):
+        database = InstrumentedDatabase(CachedDatabase(open_database(self.directory.name)))
+        john = create_user(database, "john@doe.com", "John")
+        group = database.group_private_create("Chat", john.id)
+        for _ in range(2):
+            database.group_get(john, group.id)
+        metrics = database.metrics()
+        self.assertIn("# TYPE shadowtalk_database_cache_hits_total counter", metrics)
+        self.assertIn('shadowtalk_database_cache_hits_total{cache="groups"} 1', metrics)
+        self.assertIn('shadowtalk_database_cache_entries{cache="groups"} 1', metrics)
+        database.log.close()
+
+    def test_unsampled_calls_still_count_errors(self):
+        database = InstrumentedDatabase(FailingDatabase(), sample_rate=0)
+        cookie = Cookie("john", "john@doe.com", "John")
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                database.group_get(cookie, "group")
+        self.assertEqual(database.calls, {})
+        metrics = database.metrics()
+        self.assertIn('shadowtalk_database_errors_total{method="group_get"} 2', metrics)
+        self.assertIn('shadowtalk_database_calls_total{method="group_get"} 2', metrics)
+
+
+class CachedDatabaseTest(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.database = CachedDatabase(open_database(self.directory.name))
+        self.john = create_user(self.database, "john@doe.com", "John")
+        self.jane = create_user(self.database, "jane@doe.com", "Jane")
+        self.group = self.database.group_private_create("Chat", self.john.id)
+
+    def tearDown(self):
+        self.database.log.close()
+        self.directory.cleanup()
+
+    def lookups(self, outcome: str, cache: str) -> int:
+        return self.database.stats()[labelled(f"cache_{outcome}_total", cache=cache)]
+
+    def test_repeated_reads_are_served_from_the_cache(self):
+        for _ in range(3):
+            self.assertEqual(self.database.group_get(self.john, self.group.id).name, "Chat")
+            self.assertEqual(self.database.user_public_get(self.jane.id).name, "Jane")
+        self.assertEqual((self.lookups("misses", "groups"), self.lookups("hits", "groups")), (1, 2))
+        self.assertEqual((self.lookups("misses", "public_users"), self.lookups("hits", "public_users")), (1, 2))
+        self.assertEqual(self.lookups("misses", "access"), 1)
+
+        users = self.database.user_public_get_many([self.jane.id, "nobody", self.john.id])
+        self.assertEqual([user and user.name for user in users], ["Jane", None, "John"])
+        self.assertEqual(self.lookups("hits", "public_users"), 3)
+
+    def test_own_writes_are_read_back(self):
+        self.assertIsNone(self.database.group_get(self.jane, self.group.id))
+        self.assertTrue(self.database.user_join_group(self.jane, self.group.id))
+        self.assertEqual(self.database.user_has_group_access(self.jane.id, self.group.id), "member")
+        self.assertIn(self.jane.id, self.database.group_get(self.jane, self.group.id).member_ids)
+
+        self.assertTrue(self.database.group_rename(self.john, self.group.id, "Lounge"))
+        self.assertEqual(self.database.group_get_many(self.jane, [self.group.id])[0].name, "Lounge")
+
+        self.database.user_public_get(self.jane.id)
+        self.assertTrue(self.database.user_change_username(self.jane, "Janet"))
+        self.assertEqual(self.database.user_public_get(self.jane.id).name, "Janet")
+
+        self.assertTrue(self.database.user_leave_group(self.jane, self.group.id, False))
+        self.assertIsNone(self.database.group_get(self.jane, self.group.id))
+
+        self.database.group_get(self.john, self.group.id)
+        self.assertTrue(self.database.group_delete(self.john, self.group.id))
+        self.assertEqual(self.database.user_has_group_access(self.john.id, self.group.id), "none")
+        self.assertIsNone(self.database.group_get(self.john, self.group.id))
+
+    def test_entries_expire(self):
+        database = CachedDatabase(self.database.database, ttl=0.05)
+        database.user_public_get(self.jane.id)
+        # A write made behind the cache's back, as another process would
+        self.database.database.user_change_username(self.jane, "Janet")
+        self.assertEqual(database.user_public_get(self.jane.id).name, "Jane")
+        sleep(0.1)
+        self.assertEqual(database.user_public_get(self.jane.id).name, "Janet")
+
+
+class ConcurrencyTest(TestCase):
+    THREADS = 16
+    MESSAGES_PER_THREAD = 200
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.database = open_database(self.directory.name, checkpoint_bytes=1, max_resident_messages=100)
+        self.users = [create_user(self.database, f"user{i}@doe.com", f"User {i}") for i in range(4)]
+        self.groups = [self.database.group_private_create(f"Chat {i}", self.users[0].id) for i in range(4)]
+        for user in self.users[1:]:
+            for group in self.groups:
+                self.database.user_join_group(user, group.id)
+
+    def tearDown(self):
+        self.database.log.close()
+        self.directory.cleanup()
+
+    def run_threads(self, targets):
+        errors = []
+
+        def guarded(target):
+            try:
+                target()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [Thread(target=guarded, args=(target,)) for target in targets]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_hammering_from_many_threads(self):
+        def sender(n: int):
+            def send():
+                user = self.users[n % len(self.users)]
+                for i in range(self.MESSAGES_PER_THREAD):
+                    group = self.groups[(n + i) % len(self.groups)]
+                    self.assertTrue(self.database.message_send(user, group.id, f"{n}:{i}", False, None, None))
+                    if i % 50 == 0:
+                        self.database.deinit()
+            return send
+
+        def reader():
+            for i in range(self.MESSAGES_PER_THREAD):
+                group = self.groups[i % len(self.groups)]
+                page = self.database.message_get(self.users[0], group.id, None, 20)
+                indexes = [message.index for message in page]
+                self.assertEqual(indexes, sorted(indexes))
+                self.database.group_search(self.users[0], "Chat")
+
+        def checkpointer():
+            for _ in range(20):
+                self.database.checkpoint()
+
+        def renamer():
+            for i in range(self.MESSAGES_PER_THREAD):
+                self.database.group_rename(self.users[0], self.groups[0].id, f"Chat {i}")
+
+        self.run_threads(
+            [sender(n) for n in range(self.THREADS)] +
+            [reader for _ in range(4)] +
+            [checkpointer, renamer]
+        )
+        self.database.deinit()
+        self.database.checkpoint()
+        self.database.log.close()
+
+        self.database = open_database(self.directory.name)
+        total = 0
+        for group in self.groups:
+            messages = self.database.message_get(self.users[0], group.id, None, self.THREADS * self.MESSAGES_PER_THREAD)
+            self.assertEqual(len(set(message.index for message in messages)), len(messages))
+            total += len(messages)
+        self.assertEqual(total, self.THREADS * self.MESSAGES_PER_THREAD)
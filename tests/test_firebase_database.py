@@ -0,0 +1,444 @@
+from asyncio import run, sleep as async_sleep
+from threading import Thread
+from time import perf_counter, sleep
+from typing import Optional
+
+from django.test import TestCase
+
+from benchmarks.firebase_fake import Network, FakeFirestore, FakeRealtime
+from database.FirebaseDatabase import FirebaseDatabase, request_scope, WIPE_BATCH_SIZE
+from database.InstrumentedDatabase import InstrumentedDatabase
+from database.ReplicatedFirebaseDatabase import ReplicatedFirebaseDatabase
+from database.metrics import labelled
+from database.resilience import Resilience
+from database.cookie import Cookie
+from database.user import USER_GROUP_IDS, USER_INTERACTED_GROUP_IDS, USER_PINNED_GROUP_IDS, USER_REQUESTS
+from firebase_config import message_path, GROUP_COLLECTION
+
+
+def open_fake(network: Network) -> FirebaseDatabase:
+    return FirebaseDatabase(FakeFirestore(network), FakeRealtime(network))
+
+def calls(operation: str, outcome: str):
+    return labelled("firebase_calls_total", operation=operation, outcome=outcome)
+
+def create_user_document(database: FirebaseDatabase, cookie: Cookie):
+    # What user_create stores besides the Auth record, which the fake has no stand-in for
+    database.user_collection.document(cookie.id).set({
+        USER_GROUP_IDS: [],
+        USER_INTERACTED_GROUP_IDS: [],
+        USER_PINNED_GROUP_IDS: [],
+        USER_REQUESTS: []
+    })
+
+
+class FirebaseRoundTripTest(TestCase):
+    def setUp(self):
+        self.network = Network()
+        self.database = open_fake(self.network)
+        self.john = Cookie("john", "john@doe.com", "John")
+        self.jane = Cookie("jane", "jane@doe.com", "Jane")
+        create_user_document(self.database, self.john)
+        create_user_document(self.database, self.jane)
+        self.group = self.database.group_private_create("Chat", self.john.id)
+        self.assertTrue(self.database.message_send(self.john, self.group.id, "hello", False, None, None))
+        self.message = self.database.message_get(self.john, self.group.id, None, 1)[0]
+        self.network.reset()
+
+    def round_trips(self, operation) -> int:
+        self.network.reset()
+        operation()
+        return self.network.reset()
+
+    def test_access_is_a_single_read(self):
+        self.assertEqual(self.round_trips(lambda: self.database.user_has_group_access(self.john.id, self.group.id)), 1)
+        self.assertEqual(self.database.user_has_group_access(self.john.id, self.group.id), "admin")
+        self.assertEqual(self.database.user_has_group_access(self.jane.id, self.group.id), "none")
+        self.assertEqual(self.database.user_has_group_access(self.jane.id, "missing"), "none")
+
+    def test_round_trips_per_operation(self):
+        group_id, message_id = self.group.id, self.message.id
+        # The access check, then the index counter's read and conditional write
+        self.assertEqual(self.round_trips(lambda: self.database.message_send(self.john, group_id, "hi", False, None, None)), 4)
+        self.assertEqual(self.round_trips(lambda: self.database.message_get(self.john, group_id, None, 10)), 2)
+        self.assertEqual(self.round_trips(lambda: self.database.message_edit(self.john, group_id, message_id, "hey")), 3)
+        self.assertEqual(self.round_trips(lambda: self.database.group_get(self.john, group_id)), 1)
+        self.assertEqual(self.database.message_get_with_id(self.john, group_id, message_id).content, "hey")
+        self.assertEqual(self.round_trips(lambda: self.database.message_delete(self.john, group_id, message_id)), 3)
+        self.assertIsNone(self.database.message_get_with_id(self.john, group_id, message_id))
+
+    def test_access_is_reused_within_a_request(self):
+        with request_scope():
+            self.assertEqual(self.round_trips(lambda: self.database.group_get(self.john, self.group.id)), 1)
+            self.assertEqual(self.round_trips(lambda: self.database.message_get(self.john, self.group.id, None, 10)), 1)
+            self.assertEqual(
+                self.round_trips(lambda: self.database.message_send(self.john, self.group.id, "hi", False, None, None)),
+                3
+            )
+        self.assertEqual(self.round_trips(lambda: self.database.message_get(self.john, self.group.id, None, 10)), 2)
+
+    def test_reused_access_follows_membership_changes(self):
+        with request_scope():
+            self.assertIsNone(self.database.group_get(self.jane, self.group.id))
+            self.assertEqual(self.database.message_get(self.jane, self.group.id, None, 10), [])
+            self.assertTrue(self.database.user_join_group(self.jane, self.group.id))
+            self.assertEqual(len(self.database.message_get(self.jane, self.group.id, None, 10)), 1)
+            self.assertTrue(self.database.user_admin_promote_group(self.jane, self.group.id))
+            self.assertEqual(self.database.user_has_group_access(self.jane.id, self.group.id), "admin")
+            self.assertTrue(self.database.user_admin_demote_group(self.jane, self.group.id))
+            self.assertTrue(self.database.user_leave_group(self.jane, self.group.id, False))
+            self.assertEqual(self.database.user_has_group_access(self.jane.id, self.group.id), "none")
+            self.assertTrue(self.database.group_delete(self.john, self.group.id))
+            self.assertEqual(self.database.user_has_group_access(self.john.id, self.group.id), "none")
+
+    def test_outsiders_get_nothing(self):
+        self.assertFalse(self.database.message_send(self.jane, self.group.id, "mine", False, None, None))
+        self.assertFalse(self.database.message_send_many(self.jane, self.group.id, [("mine", False, None, None)]))
+        # Refused sends do not claim indexes, the group's numbering carries on without a gap
+        self.assertTrue(self.database.message_send(self.john, self.group.id, "hi", False, None, None))
+        self.assertEqual(self.database.message_get(self.john, self.group.id, None, 1)[0].index, self.message.index + 1)
+        self.assertEqual(self.database.message_get(self.jane, self.group.id, None, 10), [])
+        self.assertIsNone(self.database.message_get_with_id(self.jane, self.group.id, self.message.id))
+        self.assertFalse(self.database.message_edit(self.jane, self.group.id, self.message.id, "mine"))
+        self.assertFalse(self.database.message_delete(self.jane, self.group.id, self.message.id))
+        self.assertEqual(self.database.message_get_with_id(self.john, self.group.id, self.message.id).content, "hello")
+
+    def test_search_follows_the_users_group_order(self):
+        fake = self.database.firestore.client
+        get_all = fake.get_all
+        groups = [self.database.group_private_create(f"Chat {i}", self.john.id) for i in range(4)]
+        for group in groups:
+            self.assertTrue(self.database.user_join_group(self.jane, group.id))
+        def rotated(references, field_paths=None):
+            # Firestore answers a batched read in no particular order, here the request's moved along by one
+            snapshots = list(get_all(references, field_paths))
+            return snapshots[1:] + snapshots[:1]
+        fake.get_all = rotated
+        self.assertEqual(
+            [group.id for group in self.database.group_search(self.jane, "Chat")],
+            [group.id for group in groups]
+        )
+
+    def test_access_and_message_are_read_side_by_side(self):
+        self.network.latency = 0.1
+        start = perf_counter()
+        self.assertTrue(self.database.message_edit(self.john, self.group.id, self.message.id, "hey"))
+        # Three round trips, of which the access check and the message read overlap
+        self.assertLess(perf_counter() - start, 0.27)
+
+
+class FirebaseWipeTest(TestCase):
+    GROUPS = 8
+
+    def setUp(self):
+        self.network = Network()
+        self.database = open_fake(self.network)
+        self.john = Cookie("john", "john@doe.com", "John")
+        self.jane = Cookie("jane", "jane@doe.com", "Jane")
+        create_user_document(self.database, self.john)
+        create_user_document(self.database, self.jane)
+        self.groups = [self.database.group_private_create(f"Chat {i}", self.john.id) for i in range(self.GROUPS)]
+        for group in self.groups:
+            self.assertTrue(self.database.user_join_group(self.jane, group.id))
+            for cookie in [self.john, self.jane]:
+                messages = [(f"{cookie.name} {i}", False, None, None) for i in range(WIPE_BATCH_SIZE + 10)]
+                self.assertTrue(self.database.message_send_many(cookie, group.id, messages))
+        self.database.user_collection.document(self.jane.id).update({
+            USER_INTERACTED_GROUP_IDS: [group.id for group in self.groups]
+        })
+
+    def authors(self, group_id: str) -> set[str]:
+        messages = self.database.reference(f"messages/{group_id}").get() or {}
+        return {message["author_id"] for message in messages.values()}
+
+    def test_group_wipe_deletes_in_batches(self):
+        group_id = self.groups[0].id
+        self.network.reset()
+        self.assertTrue(self.database.user_wipe_all_group_messages(self.jane, group_id))
+        # Access, the author's messages, two batched deletes and the membership check
+        self.assertEqual(self.network.reset(), 5)
+        self.assertEqual(self.authors(group_id), {self.john.id})
+        self.assertEqual(self.authors(self.groups[1].id), {self.john.id, self.jane.id})
+
+    def test_wipe_of_every_group_runs_in_parallel(self):
+        self.network.latency = 0.05
+        start = perf_counter()
+        self.assertTrue(self.database.user_wipe_all_messages(self.jane))
+        # Three round trips per group, four groups at a time, plus reading and updating the user
+        self.assertLess(perf_counter() - start, 0.05 * (3 * self.GROUPS / 4 + 2) + 0.15)
+        for group in self.groups:
+            self.assertEqual(self.authors(group.id), {self.john.id})
+
+
+class FirebasePaginationTest(TestCase):
+    def setUp(self):
+        self.network = Network()
+        self.database = open_fake(self.network)
+        self.john = Cookie("john", "john@doe.com", "John")
+        create_user_document(self.database, self.john)
+        self.group = self.database.group_private_create("Chat", self.john.id)
+
+    def test_indexes_increase_and_pages_follow_the_cursor(self):
+        for i in range(5):
+            self.assertTrue(self.database.message_send(self.john, self.group.id, f"{i}", False, None, None))
+        self.assertTrue(self.database.message_send_many(
+            self.john,
+            self.group.id,
+            [(f"{i}", False, None, None) for i in range(5, 10)]
+        ))
+
+        newest = self.database.message_get(self.john, self.group.id, None, 3)
+        self.assertEqual([message.index for message in newest], [8, 9, 10])
+        self.assertEqual([message.content for message in newest], ["7", "8", "9"])
+        older = self.database.message_get(self.john, self.group.id, newest[0].id, 3)
+        self.assertEqual([message.index for message in older], [5, 6, 7])
+        newer = self.database.message_get(self.john, self.group.id, older[-1].id, 2, after=True)
+        self.assertEqual([message.index for message in newer], [8, 9])
+        oldest = self.database.message_get(self.john, self.group.id, None, 2, after=True)
+        self.assertEqual([message.index for message in oldest], [1, 2])
+        self.assertEqual(self.database.message_get(self.john, self.group.id, oldest[0].id, 5), [])
+        self.assertEqual(self.database.message_get(self.john, self.group.id, "missing", 5), [])
+
+    def test_concurrent_senders_never_share_an_index(self):
+        threads = [
+            Thread(target=lambda n=n: [
+                self.database.message_send(self.john, self.group.id, f"{n}:{i}", False, None, None)
+                for i in range(10)
+            ])
+            for n in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        messages = self.database.message_get(self.john, self.group.id, None, 100)
+        self.assertEqual([message.index for message in messages], list(range(1, 81)))
+
+    def test_a_page_downloads_only_its_messages(self):
+        self.assertTrue(self.database.message_send_many(
+            self.john,
+            self.group.id,
+            [(f"{i}", False, None, None) for i in range(1000)]
+        ))
+        newest = self.database.message_get(self.john, self.group.id, None, 20)
+        self.assertEqual(len(newest), 20)
+        self.network.reset()
+        older = self.database.message_get(self.john, self.group.id, newest[0].id, 20)
+        self.assertEqual([message.index for message in older], list(range(961, 981)))
+        # Access next to the cursor's index, followed by the page itself
+        self.assertEqual(self.network.reset(), 3)
+
+
+class FirebaseReplicaTest(TestCase):
+    def setUp(self):
+        self.network = Network()
+        self.firestore = FakeFirestore(self.network)
+        self.realtime = FakeRealtime(self.network)
+        self.database = ReplicatedFirebaseDatabase(self.firestore, self.realtime, max_groups=2, max_messages=10)
+        # Another server writing to the same Firebase project
+        self.other = FirebaseDatabase(self.firestore, self.realtime)
+        self.john = Cookie("john", "john@doe.com", "John")
+        self.jane = Cookie("jane", "jane@doe.com", "Jane")
+        create_user_document(self.database, self.john)
+        create_user_document(self.database, self.jane)
+        self.group = self.database.group_private_create("Chat", self.john.id)
+        self.assertTrue(self.database.message_send_many(
+            self.john,
+            self.group.id,
+            [(f"{i}", False, None, None) for i in range(5)]
+        ))
+
+    def tearDown(self):
+        self.database.close()
+
+    def round_trips(self, operation) -> int:
+        self.network.reset()
+        operation()
+        return self.network.reset()
+
+    def contents(self, cookie: Cookie, cursor: Optional[str] = None, amount: int = 20) -> list[str]:
+        return [message.content for message in self.database.message_get(cookie, self.group.id, cursor, amount)]
+
+    def test_warm_reads_stay_local(self):
+        self.database.user_has_group_access(self.john.id, self.group.id)
+        self.assertEqual(self.round_trips(lambda: self.database.user_has_group_access(self.john.id, self.group.id)), 0)
+        self.assertEqual(self.round_trips(lambda: self.database.group_get(self.john, self.group.id)), 0)
+        self.assertEqual(self.round_trips(lambda: self.contents(self.john)), 0)
+        self.assertEqual(self.contents(self.john), ["0", "1", "2", "3", "4"])
+        self.assertIsNone(self.database.group_get(self.jane, self.group.id))
+        self.assertEqual(self.contents(self.jane), [])
+
+    def test_outsiders_do_not_get_groups_mirrored(self):
+        self.database.group_get(self.john, self.group.id)
+        groups = [self.database.group_private_create(f"Chat {i}", self.john.id) for i in range(3)]
+        for group in groups:
+            self.assertIsNone(self.database.group_get(self.jane, group.id))
+            self.assertEqual(self.database.message_get(self.jane, group.id, None, 10), [])
+            self.assertEqual(self.database.user_has_group_access(self.jane.id, group.id), "none")
+        self.assertEqual(list(self.database.replicas), [self.group.id])
+        self.assertTrue(all(message_path(group.id) not in self.realtime.listeners for group in groups))
+
+    def test_writes_of_other_servers_arrive_through_listeners(self):
+        self.database.group_get(self.john, self.group.id)
+        self.assertTrue(self.other.message_send(self.john, self.group.id, "5", False, None, None))
+        self.assertTrue(self.other.user_join_group(self.jane, self.group.id))
+        self.assertTrue(self.other.group_rename(self.john, self.group.id, "Lounge"))
+        self.network.reset()
+        self.assertEqual(self.contents(self.jane)[-1], "5")
+        self.assertEqual(self.database.group_get(self.jane, self.group.id).name, "Lounge")
+        self.assertEqual(self.network.reset(), 0)
+
+    def test_own_writes_are_seen_before_their_events(self):
+        self.database.group_get(self.john, self.group.id)
+        self.network.hold_events = True
+        self.assertTrue(self.database.message_send(self.john, self.group.id, "5", False, None, None))
+        self.assertEqual(self.contents(self.john)[-1], "5")
+        self.assertTrue(self.database.user_join_group(self.jane, self.group.id))
+        self.assertEqual(self.database.user_has_group_access(self.jane.id, self.group.id), "member")
+        (newest,) = self.database.message_get(self.john, self.group.id, None, 1)
+        self.assertTrue(self.database.message_delete(self.john, self.group.id, newest.id))
+        self.assertEqual(self.contents(self.john)[-1], "4")
+        # The events arriving late change nothing
+        self.network.deliver()
+        self.assertEqual(self.contents(self.john)[-1], "4")
+        self.assertEqual(self.database.user_has_group_access(self.jane.id, self.group.id), "member")
+
+    def test_pages_older_than_the_mirror_come_from_firebase(self):
+        self.assertTrue(self.database.message_send_many(
+            self.john,
+            self.group.id,
+            [(f"{i}", False, None, None) for i in range(5, 30)]
+        ))
+        newest = self.database.message_get(self.john, self.group.id, None, 5)
+        self.assertEqual([message.content for message in newest], ["25", "26", "27", "28", "29"])
+        self.assertEqual(self.round_trips(lambda: self.contents(self.john, newest[0].id, 5)), 0)
+        self.assertEqual(self.contents(self.john, newest[0].id, 5), ["20", "21", "22", "23", "24"])
+        oldest = self.database.message_get(self.john, self.group.id, None, 3, after=True)
+        self.assertEqual([message.content for message in oldest], ["0", "1", "2"])
+        self.assertEqual(self.contents(self.john, newest[0].id, 15)[0], "10")
+        self.assertEqual(len(self.database.replicas[self.group.id].messages), 10)
+
+    def test_idle_and_surplus_groups_are_unsubscribed(self):
+        self.database.idle_seconds = 0.05
+        groups = [self.database.group_private_create(f"Chat {i}", self.john.id) for i in range(3)]
+        for group in groups:
+            self.database.group_get(self.john, group.id)
+        self.assertEqual(list(self.database.replicas), [groups[1].id, groups[2].id])
+        self.assertEqual(self.realtime.listeners[message_path(groups[0].id)], [])
+        sleep(0.1)
+        self.database.deinit()
+        self.assertEqual(len(self.database.replicas), 0)
+        self.assertEqual(sum(len(listeners) for listeners in self.realtime.listeners.values()), 0)
+        self.assertEqual(
+            sum(len(listeners) for listeners in self.firestore.collection(GROUP_COLLECTION).listeners.values()),
+            0
+        )
+
+
+class FirebaseResilienceTest(TestCase):
+    def setUp(self):
+        self.network = Network()
+        self.resilience = Resilience(deadline=0.5, backoff=0.01, failure_threshold=3, reset_timeout=0.2)
+        self.database = FirebaseDatabase(FakeFirestore(self.network), FakeRealtime(self.network), resilience=self.resilience)
+        self.john = Cookie("john", "john@doe.com", "John")
+        create_user_document(self.database, self.john)
+        self.group = self.database.group_private_create("Chat", self.john.id)
+
+    def test_transient_read_failures_are_retried(self):
+        self.network.fail(2, "get")
+        self.assertEqual(self.database.user_has_group_access(self.john.id, self.group.id), "admin")
+        stats = self.database.stats()
+        self.assertEqual(stats[calls("firestore_get", "retry")], 2)
+        self.assertEqual(stats[calls("firestore_get", "success")], 1)
+
+    def test_writes_are_not_retried(self):
+        self.network.fail(1, "update")
+        self.assertFalse(self.database.group_rename(self.john, self.group.id, "Lounge"))
+        self.assertEqual(self.database.group_get(self.john, self.group.id).name, "Chat")
+        stats = self.database.stats()
+        self.assertEqual(stats[calls("firestore_write", "failure")], 1)
+        self.assertNotIn(calls("firestore_write", "retry"), stats)
+
+    def test_stalled_calls_give_up_at_their_deadline(self):
+        self.network.stall(1, 2, "get")
+        start = perf_counter()
+        self.assertEqual(self.database.user_has_group_access(self.john.id, self.group.id), "admin")
+        # The stalled attempt is abandoned, the retry answers
+        self.assertLess(perf_counter() - start, 1)
+        self.assertEqual(self.database.stats()[calls("firestore_get", "timeout")], 1)
+
+        self.network.stall(10, 2, "update")
+        start = perf_counter()
+        self.assertFalse(self.database.group_rename(self.john, self.group.id, "Lounge"))
+        self.assertLess(perf_counter() - start, 1)
+
+    def test_hedged_reads_cut_the_tail(self):
+        self.resilience.hedge_after = 0.05
+        self.network.stall(1, 2, "get")
+        start = perf_counter()
+        self.assertIsNotNone(self.database.group_get(self.john, self.group.id))
+        self.assertLess(perf_counter() - start, 0.3)
+        stats = self.database.stats()
+        self.assertEqual(stats[calls("firestore_get", "hedge")], 1)
+        self.assertNotIn(calls("firestore_get", "timeout"), stats)
+
+    def test_open_circuit_fails_fast_and_serves_stale_reads(self):
+        self.database.user_collection.document(self.john.id).update({USER_GROUP_IDS: [self.group.id]})
+        self.assertEqual([group.name for group in self.database.group_search(self.john, "Chat")], ["Chat"])
+        self.assertEqual(self.database.user_has_group_access(self.john.id, self.group.id), "admin")
+        self.network.fail(1000)
+        # Three failing attempts open the circuit, later calls do not reach the network
+        self.assertEqual([group.name for group in self.database.group_search(self.john, "Chat")], ["Chat"])
+        self.network.reset()
+        start = perf_counter()
+        self.assertEqual([group.name for group in self.database.group_search(self.john, "Chat")], ["Chat"])
+        # Access is never answered stale, a member removed during the outage could otherwise still act as one
+        self.assertEqual(self.database.user_has_group_access(self.john.id, self.group.id), "none")
+        self.assertIsNone(self.database.group_get(self.john, self.group.id))
+        self.assertEqual(self.database.group_get_many(self.john, [self.group.id]), [None])
+        self.assertFalse(self.database.group_rename(self.john, self.group.id, "Lounge"))
+        self.assertLess(perf_counter() - start, 0.05)
+        self.assertEqual(self.network.reset(), 0)
+        stats = self.database.stats()
+        self.assertEqual(stats[labelled("firebase_circuit_open", service="firestore")], 1)
+        # The user document and both batched reads of each search
+        self.assertEqual(stats[calls("firestore_get", "stale")], 2)
+        self.assertEqual(stats[calls("firestore_get_all", "stale")], 4)
+
+        # Once reset_timeout passed a trial call goes through and closes the circuit
+        self.network.heal()
+        sleep(0.25)
+        self.assertTrue(self.database.group_rename(self.john, self.group.id, "Lounge"))
+        self.assertEqual(self.database.group_get(self.john, self.group.id).name, "Lounge")
+        self.assertEqual(self.database.stats()[labelled("firebase_circuit_open", service="firestore")], 0)
+
+    def test_async_calls_are_retried_and_bounded(self):
+        attempts = []
+        async def flaky():
+            attempts.append(len(attempts))
+            if len(attempts) < 3:
+                raise ConnectionError()
+            return "done"
+        async def stalled():
+            await async_sleep(10)
+        self.assertEqual(run(self.resilience.call_async("firestore", "firestore_get", flaky, True)), "done")
+        start = perf_counter()
+        with self.assertRaises(TimeoutError):
+            run(self.resilience.call_async("firestore", "firestore_write", stalled, False))
+        self.assertLess(perf_counter() - start, 1)
+        stats = self.database.stats()
+        self.assertEqual(stats[calls("firestore_get", "retry")], 2)
+        self.assertEqual(stats[calls("firestore_get", "success")], 1)
+        self.assertEqual(stats[calls("firestore_write", "timeout")], 1)
+
+    def test_outcomes_reach_the_metrics_page(self):
+        database = InstrumentedDatabase(self.database)
+        self.network.fail(1, "get")
+        database.group_get(self.john, self.group.id)
+        metrics = database.metrics()
+        self.assertIn("# TYPE shadowtalk_database_firebase_calls_total counter", metrics)
+        self.assertIn(
+            'shadowtalk_database_firebase_calls_total{operation="firestore_get",outcome="retry"} 1',
+            metrics
+        )
+        self.assertIn('shadowtalk_database_firebase_circuit_open{service="firestore"} 0', metrics)
@@ -0,0 +1,38 @@
+from random import Random
+from tempfile import TemporaryDirectory
+
+from django.test import TestCase
+
+from benchmarks.login import open_database
+from benchmarks.workload import generate, replay, Dataset, Zipf, MUTATIONS
+from database.Interop import DatabaseInterop
+from database.cookie import Cookie
+
+
+class WorkloadTest(TestCase):
+    def test_zipf_favours_low_ranks(self):
+        zipf = Zipf(10, 1.1)
+        random = Random(0)
+        picks = [zipf(random) for _ in range(10_000)]
+        self.assertGreater(picks.count(0), picks.count(9) * 5)
+
+    def test_replay_reports_every_method(self):
+        with TemporaryDirectory() as directory:
+            database = open_database(directory)
+            dataset = generate(database, users=4, groups=3, messages=50)
+            result = replay(database, dataset, operations=300, threads=2)
+            database.close()
+        self.assertEqual(result["operations"], sum(stats["calls"] for stats in result["methods"].values()))
+        self.assertIn("message_send", result["methods"])
+        for stats in result["methods"].values():
+            self.assertEqual(stats["errors"], 0)
+            self.assertLessEqual(stats["p50_us"], stats["p99_us"])
+
+    def test_rejected_mutations_count_as_errors(self):
+        # DatabaseInterop's own methods do nothing and return None, as a backend rejecting everything would
+        cookies = [Cookie(str(i), f"user{i}@doe.com", f"User {i}") for i in range(4)]
+        dataset = Dataset(cookies, ["group"], [{0, 1}])
+        result = replay(DatabaseInterop(), dataset, operations=200)
+        for method, stats in result["methods"].items():
+            self.assertEqual(stats["errors"], stats["calls"] if method in MUTATIONS else 0)
+        self.assertGreater(result["methods"]["message_send"]["errors"], 0)